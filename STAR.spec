@@ -39,10 +39,27 @@ module STAR {
                             either a SingleEnd/PairedEnd reads, or a ReadsSet input
         string output_workspace - name or id of the WS to save the results to, provided by the narrative for housing output in KBase
         string output_name - name of the output ReadsAlignment or ReadsAlignmentSet object
-        int runThreadN - the number of threads for STAR to use (default to 2)
+        int runThreadN - the number of threads for STAR to use (default: all CPUs)
         string outFileNamePrefix: you can change the file prefixes using --outFileNamePrefix /path/to/output/dir/prefix
                                 By default, this parameter is ./, i.e. all output files are written in current directory without a prefix
         string quantMode: types of quantification requested--none/TranscriptomeSAM/GeneCounts
+        string strandedness: the ReadsPerGene counts used in the gene count matrix--
+                                unstranded/forward/reverse, or auto to pick them for each sample
+                                (default unstranded)
+        int genomeSAindexNbases: length (bases) of the SA pre-indexing string of the genome index,
+                                derived from the genome length when not set
+        int genomeChrBinNbits: log2 of the size of the bins the genome is stored in,
+                                derived from the genome length and number of contigs when not set
+        int genomeSAsparseD: suffix array sparsity of the genome index, larger values use less
+                                memory and map slower (default 1)
+        string twopassMode: None (default), Basic for STAR's two-pass mode in each mapping, or Batch
+                                to map all the reads of a set once, insert the novel junctions
+                                found in any of them into the genome index and map them again
+        int read_shards: split each reads library into this many shards, mapped concurrently and
+                                merged into one alignment, to use more CPUs than one STAR run
+                                scales to (default 1); only with outFilterType Normal and
+                                without twopassMode Basic, which both need the junctions of
+                                the whole library
         int outFilterMultimapNmax: max number of multiple alignments allowed for a read: if exceeded,
                                 the read is considered unmapped, default to 20
         int alignSJoverhangMin: minimum overhang for unannotated junctions, default to 8
@@ -60,6 +77,7 @@ module STAR {
         @optional alignSJoverhangMin
         @optional alignSJDBoverhangMin
         @optional quantMode
+        @optional strandedness
         @optional outFilterType
         @optional outFilterMultimapNmax
         @optional outSAMtype
@@ -68,6 +86,11 @@ module STAR {
         @optional outFilterMismatchNmax
         @optional outFileNamePrefix
         @optional runThreadN
+        @optional genomeSAindexNbases
+        @optional genomeChrBinNbits
+        @optional genomeSAsparseD
+        @optional twopassMode
+        @optional read_shards
     */
     typedef structure {
         obj_ref readsset_ref;
@@ -88,6 +111,7 @@ module STAR {
         int alignSJoverhangMin;
         int alignSJDBoverhangMin;
         string quantMode;
+        string strandedness;
         string outFilterType;
         int outFilterMultimapNmax;
         string outSAMtype;
@@ -96,6 +120,11 @@ module STAR {
         int outFilterMismatchNmax;
         string outFileNamePrefix;
         int runThreadN;
+        int genomeSAindexNbases;
+        int genomeChrBinNbits;
+        int genomeSAsparseD;
+        string twopassMode;
+        int read_shards;
     } AlignReadsParams;
 
     /*
@@ -132,4 +161,54 @@ module STAR {
 
     funcdef run_star(AlignReadsParams params)
         returns (AlignReadsResult returnVal) authentication required;
+
+    /*
+        The plan of a run_star request, as estimated by plan_star from the metadata of the genome
+        and the reads (none of them is downloaded), for a node like the one plan_star ran on.
+        Sizes are in bytes and times in seconds.
+
+        feasible: whether run_star would fit the node; if not, problems says why
+        problems: what would make run_star fail, e.g. running out of memory
+        warnings: what the estimates could not take into account
+        genome_length, n_contigs: the length (in bases) and number of contigs of the genome
+        n_reads_libraries, reads_bytes: the number of reads libraries and their total size on scratch
+        index_ram: the memory genomeGenerate needs
+        mapping_ram: the memory each mapping needs, besides sorting BAM
+        bam_sort_ram: the memory each mapping needs to sort its BAM
+        peak_ram: the most memory the run needs at once
+        peak_scratch: the most scratch disk the run takes at once
+        wall_time: how long the run takes
+        available_memory, available_scratch, cpus: the resources of the node planned for
+        genomeSAsparseD, runThreadN, concurrent_local_tasks: the execution plan, as run_star would
+                        pick it
+    */
+    typedef structure {
+        bool feasible;
+        list<string> problems;
+        list<string> warnings;
+        int genome_length;
+        int n_contigs;
+        int n_reads_libraries;
+        int reads_bytes;
+        int index_ram;
+        int mapping_ram;
+        int bam_sort_ram;
+        int peak_ram;
+        int peak_scratch;
+        float wall_time;
+        int available_memory;
+        int available_scratch;
+        int cpus;
+        int genomeSAsparseD;
+        int runThreadN;
+        int concurrent_local_tasks;
+    } StarPlan;
+
+    /*
+        Estimate the memory, scratch disk and time run_star needs for the same params, and how it
+        would run, without running it, so that requests that would run out of memory or disk are
+        turned away before they take a queue slot.
+    */
+    funcdef plan_star(AlignReadsParams params)
+        returns (StarPlan returnVal) authentication required;
 };
@@ -48,12 +48,29 @@ class STAR(object):
            provided by the narrative for housing output in KBase string
            output_name - name of the output ReadsAlignment or
            ReadsAlignmentSet object int runThreadN - the number of threads
-           for STAR to use (default to 2) string outFileNamePrefix: you can
+           for STAR to use (default: all CPUs) string outFileNamePrefix: you can
            change the file prefixes using --outFileNamePrefix
            /path/to/output/dir/prefix By default, this parameter is ./, i.e.
            all output files are written in current directory without a prefix
            string quantMode: types of quantification
-           requested--none/TranscriptomeSAM/GeneCounts int
+           requested--none/TranscriptomeSAM/GeneCounts string strandedness:
+           the ReadsPerGene counts used in the gene count matrix--
+           unstranded/forward/reverse, or auto to pick them for each sample
+           (default unstranded) int
+           genomeSAindexNbases: length (bases) of the SA pre-indexing string
+           of the genome index, derived from the genome length when not set
+           int genomeChrBinNbits: log2 of the size of the bins the genome is
+           stored in, derived from the genome length and number of contigs
+           when not set int genomeSAsparseD: suffix array sparsity of the
+           genome index, larger values use less memory and map slower
+           (default 1) string twopassMode: None (default), Basic for STAR's
+           two-pass mode in each mapping, or Batch to map all the reads of a
+           set once, insert the novel junctions found in any of them into the
+           genome index and map them again int read_shards: split each reads
+           library into this many shards, mapped concurrently and merged into
+           one alignment, to use more CPUs than one STAR run scales to
+           (default 1); only with outFilterType Normal and without twopassMode
+           Basic, which both need the junctions of the whole library int
            outFilterMultimapNmax: max number of multiple alignments allowed
            for a read: if exceeded, the read is considered unmapped, default
            to 20 int alignSJoverhangMin: minimum overhang for unannotated
@@ -68,11 +85,15 @@ class STAR(object):
            - mainly used for subtasks) @optional alignmentset_suffix
            @optional alignIntronMin @optional alignIntronMax @optional
            alignMatesGapMax @optional alignSJoverhangMin @optional
-           alignSJDBoverhangMin @optional quantMode @optional outFilterType
+           alignSJDBoverhangMin @optional quantMode @optional
+           strandedness @optional outFilterType
            @optional outFilterMultimapNmax @optional outSAMtype @optional
            outSAMattrIHstart @optional outSAMstrandField @optional
            outFilterMismatchNmax @optional outFileNamePrefix @optional
-           runThreadN) -> structure: parameter "readsset_ref" of type
+           runThreadN @optional genomeSAindexNbases @optional
+           genomeChrBinNbits @optional genomeSAsparseD @optional
+           twopassMode @optional read_shards) -> structure:
+           parameter "readsset_ref" of type
            "obj_ref" (An X/Y/Z style reference), parameter "genome_ref" of
            type "obj_ref" (An X/Y/Z style reference), parameter
            "output_workspace" of String, parameter "output_name" of String,
@@ -85,12 +106,16 @@ class STAR(object):
            Long, parameter "alignIntronMax" of Long, parameter
            "alignMatesGapMax" of Long, parameter "alignSJoverhangMin" of
            Long, parameter "alignSJDBoverhangMin" of Long, parameter
-           "quantMode" of String, parameter "outFilterType" of String,
+           "quantMode" of String, parameter "strandedness" of String,
+           parameter "outFilterType" of String,
            parameter "outFilterMultimapNmax" of Long, parameter "outSAMtype"
            of String, parameter "outSAMattrIHstart" of Long, parameter
            "outSAMstrandField" of String, parameter "outFilterMismatchNmax"
            of Long, parameter "outFileNamePrefix" of String, parameter
-           "runThreadN" of Long
+           "runThreadN" of Long, parameter "genomeSAindexNbases" of Long,
+           parameter "genomeChrBinNbits" of Long, parameter "genomeSAsparseD"
+           of Long, parameter "twopassMode" of String, parameter "read_shards"
+           of Long
         :returns: instance of type "AlignReadsResult" (Here is the definition
            of the output of the function.  The output can be used by other
            SDK modules which call your code, or the output visualizations in
@@ -116,6 +141,127 @@ class STAR(object):
             'STAR.run_star',
             [params], self._service_ver, context)
 
+    def plan_star(self, params, context=None):
+        """
+        Estimate the memory, scratch disk and time run_star needs for the
+        same params, and how it would run, without running it, so that
+        requests that would run out of memory or disk are turned away
+        before they take a queue slot.
+        :param params: instance of type "AlignReadsParams" (Will align the
+           input reads (or set of reads specified in a SampleSet) to the
+           specified assembly or assembly for the specified Genome (accepts
+           Assembly, ContigSet, or Genome types) and produces a
+           ReadsAlignment object, or in the case of a SampleSet, a
+           ReadsAlignmentSet object obj_ref genome_ref: KBase workspace
+           reference Genome obj_ref readsset_ref: the workspace reference for
+           the set of reads to align, referring to either a
+           SingleEnd/PairedEnd reads, or a ReadsSet input string
+           output_workspace - name or id of the WS to save the results to,
+           provided by the narrative for housing output in KBase string
+           output_name - name of the output ReadsAlignment or
+           ReadsAlignmentSet object int runThreadN - the number of threads
+           for STAR to use (default: all CPUs) string outFileNamePrefix: you can
+           change the file prefixes using --outFileNamePrefix
+           /path/to/output/dir/prefix By default, this parameter is ./, i.e.
+           all output files are written in current directory without a prefix
+           string quantMode: types of quantification
+           requested--none/TranscriptomeSAM/GeneCounts string strandedness:
+           the ReadsPerGene counts used in the gene count matrix--
+           unstranded/forward/reverse, or auto to pick them for each sample
+           (default unstranded) int
+           genomeSAindexNbases: length (bases) of the SA pre-indexing string
+           of the genome index, derived from the genome length when not set
+           int genomeChrBinNbits: log2 of the size of the bins the genome is
+           stored in, derived from the genome length and number of contigs
+           when not set int genomeSAsparseD: suffix array sparsity of the
+           genome index, larger values use less memory and map slower
+           (default 1) string twopassMode: None (default), Basic for STAR's
+           two-pass mode in each mapping, or Batch to map all the reads of a
+           set once, insert the novel junctions found in any of them into the
+           genome index and map them again int read_shards: split each reads
+           library into this many shards, mapped concurrently and merged into
+           one alignment, to use more CPUs than one STAR run scales to
+           (default 1); only with outFilterType Normal and without twopassMode
+           Basic, which both need the junctions of the whole library int
+           outFilterMultimapNmax: max number of multiple alignments allowed
+           for a read: if exceeded, the read is considered unmapped, default
+           to 20 int alignSJoverhangMin: minimum overhang for unannotated
+           junctions, default to 8 int alignSJDBoverhangMin: minimum overhang
+           for annotated junctions, default to 1 int outFilterMismatchNmax:
+           maximum number of mismatches per pair, large number switches off
+           this filter, default to 999 int alignIntronMin: minimum intron
+           length, default to 20 int alignIntronMax: maximum intron length,
+           default to 1000000 int alignMatesGapMax: maximum genomic distance
+           between mates, default to 1000000 int create_report: = 1 if we
+           build a report, 0 otherwise. (default 1) (shouldn not be user set
+           - mainly used for subtasks) @optional alignmentset_suffix
+           @optional alignIntronMin @optional alignIntronMax @optional
+           alignMatesGapMax @optional alignSJoverhangMin @optional
+           alignSJDBoverhangMin @optional quantMode @optional
+           strandedness @optional outFilterType
+           @optional outFilterMultimapNmax @optional outSAMtype @optional
+           outSAMattrIHstart @optional outSAMstrandField @optional
+           outFilterMismatchNmax @optional outFileNamePrefix @optional
+           runThreadN @optional genomeSAindexNbases @optional
+           genomeChrBinNbits @optional genomeSAsparseD @optional
+           twopassMode @optional read_shards) -> structure:
+           parameter "readsset_ref" of type
+           "obj_ref" (An X/Y/Z style reference), parameter "genome_ref" of
+           type "obj_ref" (An X/Y/Z style reference), parameter
+           "output_workspace" of String, parameter "output_name" of String,
+           parameter "alignment_suffix" of String, parameter "condition" of
+           String, parameter "concurrent_njsw_tasks" of Long, parameter
+           "concurrent_local_tasks" of Long, parameter "outSAMunmapped" of
+           String, parameter "create_report" of type "bool" (A boolean - 0
+           for false, 1 for true. @range (0, 1)), parameter
+           "alignmentset_suffix" of String, parameter "alignIntronMin" of
+           Long, parameter "alignIntronMax" of Long, parameter
+           "alignMatesGapMax" of Long, parameter "alignSJoverhangMin" of
+           Long, parameter "alignSJDBoverhangMin" of Long, parameter
+           "quantMode" of String, parameter "strandedness" of String,
+           parameter "outFilterType" of String,
+           parameter "outFilterMultimapNmax" of Long, parameter "outSAMtype"
+           of String, parameter "outSAMattrIHstart" of Long, parameter
+           "outSAMstrandField" of String, parameter "outFilterMismatchNmax"
+           of Long, parameter "outFileNamePrefix" of String, parameter
+           "runThreadN" of Long, parameter "genomeSAindexNbases" of Long,
+           parameter "genomeChrBinNbits" of Long, parameter "genomeSAsparseD"
+           of Long, parameter "twopassMode" of String, parameter "read_shards"
+           of Long
+        :returns: instance of type "StarPlan" (The plan of a run_star request,
+           as estimated by plan_star from the metadata of the genome and the
+           reads (none of them is downloaded), for a node like the one
+           plan_star ran on. Sizes are in bytes and times in seconds.
+           feasible: whether run_star would fit the node; if not, problems
+           says why problems: what would make run_star fail, e.g. running out
+           of memory warnings: what the estimates could not take into account
+           genome_length, n_contigs: the length (in bases) and number of
+           contigs of the genome n_reads_libraries, reads_bytes: the number of
+           reads libraries and their total size on scratch index_ram: the
+           memory genomeGenerate needs mapping_ram: the memory each mapping
+           needs, besides sorting BAM bam_sort_ram: the memory each mapping
+           needs to sort its BAM peak_ram: the most memory the run needs at
+           once peak_scratch: the most scratch disk the run takes at once
+           wall_time: how long the run takes available_memory,
+           available_scratch, cpus: the resources of the node planned for
+           genomeSAsparseD, runThreadN, concurrent_local_tasks: the execution
+           plan, as run_star would pick it) -> structure: parameter "feasible"
+           of type "bool" (A boolean - 0 for false, 1 for true. @range (0,
+           1)), parameter "problems" of list of String, parameter "warnings"
+           of list of String, parameter "genome_length" of Long, parameter
+           "n_contigs" of Long, parameter "n_reads_libraries" of Long,
+           parameter "reads_bytes" of Long, parameter "index_ram" of Long,
+           parameter "mapping_ram" of Long, parameter "bam_sort_ram" of Long,
+           parameter "peak_ram" of Long, parameter "peak_scratch" of Long,
+           parameter "wall_time" of Double, parameter "available_memory" of
+           Long, parameter "available_scratch" of Long, parameter "cpus" of
+           Long, parameter "genomeSAsparseD" of Long, parameter "runThreadN"
+           of Long, parameter "concurrent_local_tasks" of Long
+        """
+        return self._client.call_method(
+            'STAR.plan_star',
+            [params], self._service_ver, context)
+
     def status(self, context=None):
         return self._client.call_method('STAR.status',
                                         [], self._service_ver, context)
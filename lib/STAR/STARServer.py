@@ -337,6 +337,10 @@ class Application(object):
                              name='STAR.run_star',
                              types=[dict])
         self.method_authentication['STAR.run_star'] = 'required'  # noqa
+        self.rpc_service.add(impl_STAR.plan_star,
+                             name='STAR.plan_star',
+                             types=[dict])
+        self.method_authentication['STAR.plan_star'] = 'required'  # noqa
         self.rpc_service.add(impl_STAR.status,
                              name='STAR.status',
                              types=[dict])
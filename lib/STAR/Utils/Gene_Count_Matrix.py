@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+
+from STAR.Utils.file_util import (
+    read_geneCount_file,
+    select_strandedness,
+    write_geneCount_matrix
+)
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Gene_Count_Matrix:
+    """
+    Gene_Count_Matrix: assembles the gene count matrix of a sample set one sample at a time, as
+    the mapping of each sample finishes, instead of reading all the ReadsPerGene.out.tab files
+    once every sample is done.
+    Every added sample is checkpointed into CHECKPOINT_DIR under output_dir, so that a matrix
+    can pick up the samples counted by an earlier, interrupted run of the same request, as told
+    by run_key, the key of its Run_Journal. While samples are still
+    missing, PARTIAL_FILE_NAME is rewritten with the samples counted so far at most every
+    PARTIAL_WRITE_INTERVAL seconds.
+    """
+    FILE_NAME = 'ReadsPerGene_matrix.tsv'
+    PARTIAL_FILE_NAME = 'ReadsPerGene_matrix.partial.tsv'
+    CHECKPOINT_DIR = 'ReadsPerGene_matrix.checkpoint'
+    PARTIAL_WRITE_INTERVAL = 300
+
+    def __init__(self, output_dir, sample_names, strandedness='unstranded', run_key=None,
+                 resume=True):
+        """
+        run_key: the key of the request the counts are of, the counts checkpointed for another
+        request are discarded
+        resume: False to discard the checkpointed counts whatever request they are of
+        """
+        self.output_dir = output_dir
+        self.sample_names = list(sample_names)
+        self.sample_idx = dict([(name, i) for (i, name) in enumerate(self.sample_names)])
+        self.strandedness = strandedness
+        self.run_key = run_key
+        self.gene_ids = None
+        self.gene_index = None
+        self.matrix = None
+        self.counted = [False] * len(self.sample_names)
+        self.lock = threading.Lock()
+        self.last_partial_write = time.time()
+        self.checkpoint_dir = os.path.join(output_dir, self.CHECKPOINT_DIR)
+        self._load_checkpoint(resume)
+
+    def _save_atomic(self, file_name, save_func):
+        file_path = os.path.join(self.checkpoint_dir, file_name)
+        with open(file_path + '.tmp', 'wb') as f:
+            save_func(f)
+        os.rename(file_path + '.tmp', file_path)
+
+    def _save_gene_ids(self):
+        self._save_atomic('gene_ids.json', lambda f: f.write(json.dumps(self.gene_ids)))
+
+    def _load_checkpoint(self, resume):
+        info = {'strandedness': self.strandedness, 'run_key': self.run_key}
+        info_file = os.path.join(self.checkpoint_dir, 'info.json')
+        if os.path.isfile(info_file):
+            with open(info_file) as f:
+                checkpoint_info = json.load(f)
+            if not resume or checkpoint_info != info:
+                log('Discarding the gene counts checkpointed by another run ' +
+                    json.dumps(checkpoint_info, sort_keys=True))
+                shutil.rmtree(self.checkpoint_dir)
+        elif os.path.isdir(self.checkpoint_dir):
+            # interrupted before it could tell which run it is of
+            shutil.rmtree(self.checkpoint_dir)
+
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+            self._save_atomic('info.json', lambda f: f.write(json.dumps(info)))
+            return
+
+        gene_ids_file = os.path.join(self.checkpoint_dir, 'gene_ids.json')
+        if not os.path.isfile(gene_ids_file):
+            return
+        with open(gene_ids_file) as f:
+            self.gene_ids = [str(gid) for gid in json.load(f)]
+        self.gene_index = dict([(gid, i) for (i, gid) in enumerate(self.gene_ids)])
+        self.matrix = np.zeros((len(self.gene_ids), len(self.sample_names)), dtype=np.int32,
+                               order='F')
+        for (idx, name) in enumerate(self.sample_names):
+            column_file = os.path.join(self.checkpoint_dir, name + '.npy')
+            if os.path.isfile(column_file):
+                # a column covers the genes known when it was saved, later genes are appended
+                column = np.load(column_file)
+                self.matrix[:len(column), idx] = column
+                self.counted[idx] = True
+        log('Loaded the gene counts of {} samples from {}'.format(sum(self.counted),
+                                                                  self.checkpoint_dir))
+
+    def _set_column(self, idx, gene_ids, column):
+        if self.gene_ids is None:
+            self.gene_ids = list(gene_ids)
+            self.gene_index = dict([(gid, i) for (i, gid) in enumerate(self.gene_ids)])
+            self.matrix = np.zeros((len(self.gene_ids), len(self.sample_names)),
+                                   dtype=np.int32, order='F')
+            self._save_gene_ids()
+
+        if gene_ids == self.gene_ids:
+            self.matrix[:, idx] = column
+            return
+
+        new_gene_ids = [gid for gid in gene_ids if gid not in self.gene_index]
+        if new_gene_ids:
+            for gid in new_gene_ids:
+                self.gene_index[gid] = len(self.gene_ids)
+                self.gene_ids.append(gid)
+            self.matrix = np.asfortranarray(np.vstack([
+                            self.matrix,
+                            np.zeros((len(new_gene_ids), self.matrix.shape[1]), dtype=np.int32)]))
+            self._save_gene_ids()
+        rows = np.array([self.gene_index[gid] for gid in gene_ids], dtype=np.int64)
+        self.matrix[:, idx] = 0
+        self.matrix[rows, idx] = column
+
+    def add_sample(self, sample_name, geneCount_file):
+        """
+        add_sample: add the counts in the ReadsPerGene.out.tab file of sample_name to the matrix
+        """
+        (gene_ids, counts) = read_geneCount_file(geneCount_file)
+        (strandedness, column) = select_strandedness(counts, self.strandedness)
+        if self.strandedness == 'auto':
+            log('{}: using the {} counts'.format(sample_name, strandedness))
+
+        with self.lock:
+            idx = self.sample_idx[sample_name]
+            self._set_column(idx, gene_ids, column)
+            self._save_atomic(sample_name + '.npy',
+                              lambda f: np.save(f, np.ascontiguousarray(self.matrix[:, idx])))
+            self.counted[idx] = True
+            log('Gene counts of {} of {} samples assembled'.format(sum(self.counted),
+                                                                   len(self.sample_names)))
+
+            if (not self.is_complete() and
+                    time.time() - self.last_partial_write > self.PARTIAL_WRITE_INTERVAL):
+                self._write(os.path.join(self.output_dir, self.PARTIAL_FILE_NAME))
+                self.last_partial_write = time.time()
+
+    def has_sample(self, sample_name):
+        return self.counted[self.sample_idx[sample_name]]
+
+    def is_complete(self):
+        return all(self.counted)
+
+    def _write(self, output_filename):
+        counted_idx = [i for i in range(len(self.sample_names)) if self.counted[i]]
+        return write_geneCount_matrix(output_filename,
+                                      [self.sample_names[i] for i in counted_idx],
+                                      self.gene_ids or [],
+                                      self.matrix[:, counted_idx] if self.matrix is not None
+                                      else np.zeros((0, 0), np.int32))
+
+    def write(self):
+        """
+        write: write the matrix of all the samples to FILE_NAME in output_dir, and remove the
+        partial matrix and the checkpoint. Returns the path of the matrix file.
+        """
+        with self.lock:
+            if not self.is_complete():
+                raise RuntimeError('Gene counts are missing for samples ' + ', '.join(
+                    [n for (n, c) in zip(self.sample_names, self.counted) if not c]))
+            output_filename = self._write(os.path.join(self.output_dir, self.FILE_NAME))
+            partial_file = os.path.join(self.output_dir, self.PARTIAL_FILE_NAME)
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            return output_filename
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Genome_Index_Cache:
+    """
+    Genome_Index_Cache: a persistent, content-addressed store of STAR genome index directories.
+    Each entry lives in <cache_dir>/<key>, where key is a hash of everything that determines the
+    content of the index (the genome FASTA bytes, the GTF bytes, sjdbOverhang and the STAR
+    version, and the genomeGenerate parameters the index was built with), so an entry can be
+    reused by any run that would otherwise rebuild the same index.
+    An entry built without annotations (no GTF) doubles as the base of the annotated indexes of
+    the same genome: those are derived from it by inserting the junctions of their annotations,
+    and cached as entries of their own with the key of the base entry as base_key in their info.
+    Indexes are built in staging directories, under the lock of their key; those left behind by
+    builds that crashed or were killed are removed by sweep_staging.
+    """
+    INFO_FILE = 'cache_info.json'
+    STAGING_PREFIX = '.staging_'
+    READ_BLOCK_SIZE = 4 * 1024 * 1024
+    DEFAULT_SJDB_OVERHANG = 100
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _hash_file(self, hasher, file_path):
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(self.READ_BLOCK_SIZE)
+                if not block:
+                    break
+                hasher.update(block)
+
+    def make_key(self, fasta_files, gtf_file, sjdb_overhang, star_version, genome_params=None):
+        """
+        make_key: compute the cache key of the index built from the given inputs
+        genome_params: the other genomeGenerate parameters (e.g. genomeSAindexNbases), as a dict
+        """
+        hasher = hashlib.sha256()
+        hasher.update(star_version.encode('utf-8'))
+        for fasta_file in fasta_files:
+            hasher.update(b'\0fasta\0')
+            self._hash_file(hasher, fasta_file)
+        if gtf_file:
+            hasher.update(b'\0gtf\0')
+            self._hash_file(hasher, gtf_file)
+            if sjdb_overhang is None or sjdb_overhang <= 0:
+                sjdb_overhang = self.DEFAULT_SJDB_OVERHANG
+            hasher.update('\0sjdbOverhang\0{}'.format(sjdb_overhang).encode('utf-8'))
+        for name in sorted(genome_params or {}):
+            if genome_params[name] is not None:
+                hasher.update('\0{}\0{}'.format(name, genome_params[name]).encode('utf-8'))
+
+        return hasher.hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        """
+        lookup: return the index directory cached under key, or None on a miss
+        """
+        entry_dir = self.get_entry_dir(key)
+        if (os.path.isfile(os.path.join(entry_dir, self.INFO_FILE)) and
+                os.path.isfile(os.path.join(entry_dir, 'genomeParameters.txt'))):
+            # bump the modification time so that old entries can be told apart from used ones
+            os.utime(entry_dir, None)
+            return entry_dir
+        return None
+
+    def get_info(self, key):
+        with open(os.path.join(self.get_entry_dir(key), self.INFO_FILE)) as f:
+            return json.load(f)
+
+    @contextmanager
+    def lock(self, key):
+        """
+        lock: hold an exclusive lock on key so that concurrent jobs on the same node wait for
+        the one that builds the index instead of building it again
+        """
+        lock_file = open(os.path.join(self.cache_dir, key + '.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def acquire(self, key):
+        """
+        acquire: hold a shared lock on the entry key while a run maps against it, so that it is
+        not evicted under the run. Call with the lock of key held, returns the handle to release.
+        """
+        use_file = open(os.path.join(self.cache_dir, key + '.use'), 'w')
+        fcntl.flock(use_file, fcntl.LOCK_SH)
+        return use_file
+
+    def release(self, use_file):
+        '''release: stop using the entry acquired as use_file'''
+        fcntl.flock(use_file, fcntl.LOCK_UN)
+        use_file.close()
+
+    def list_entries(self):
+        """
+        list_entries: the (key, entry directory, last used time) of every entry in the cache, the
+        least recently used first
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            entry_dir = self.get_entry_dir(name)
+            if name.startswith(self.STAGING_PREFIX) or not os.path.isdir(entry_dir):
+                continue
+            entries.append((name, entry_dir, os.path.getmtime(entry_dir)))
+        return sorted(entries, key=lambda e: e[2])
+
+    def sweep_staging(self):
+        """
+        sweep_staging: remove the staging directories whose key is not locked, which no build
+        is using any more: those of builds that crashed or were killed, and the removals of
+        evicted entries that were cut short. Returns the directories removed.
+        """
+        swept = list()
+        for name in os.listdir(self.cache_dir):
+            staging_dir = os.path.join(self.cache_dir, name)
+            if not name.startswith(self.STAGING_PREFIX) or not os.path.isdir(staging_dir):
+                continue
+            # <STAGING_PREFIX><key>_<uuid>
+            key = name[len(self.STAGING_PREFIX):].rsplit('_', 1)[0]
+            lock_file = open(os.path.join(self.cache_dir, key + '.lock'), 'w')
+            try:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # being built
+                    continue
+                if os.path.isdir(staging_dir):
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    swept.append(staging_dir)
+                    log('Removed the abandoned staging directory {}'.format(staging_dir))
+            finally:
+                lock_file.close()
+        return swept
+
+    def evict(self, key):
+        """
+        evict: remove the entry key and its zipped index from the cache, unless it is being built
+        or used by a run. Returns whether it was removed.
+        """
+        lock_file = open(os.path.join(self.cache_dir, key + '.lock'), 'w')
+        use_file = open(os.path.join(self.cache_dir, key + '.use'), 'w')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(use_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            entry_dir = self.get_entry_dir(key)
+            if not os.path.isdir(entry_dir):
+                return False
+            # moved out of the way first, so that no run finds a partly removed entry
+            trash_dir = os.path.join(self.cache_dir,
+                                     self.STAGING_PREFIX + key + '_' + str(uuid.uuid4()))
+            os.rename(entry_dir, trash_dir)
+            shutil.rmtree(trash_dir, ignore_errors=True)
+            if os.path.isfile(entry_dir + '.zip'):
+                os.remove(entry_dir + '.zip')
+            log('Evicted STAR genome index {} from the cache'.format(key))
+            return True
+        finally:
+            use_file.close()
+            lock_file.close()
+
+    def new_staging_dir(self, key):
+        """
+        new_staging_dir: create an empty directory inside the cache to build the index for key
+        """
+        staging_dir = os.path.join(self.cache_dir,
+                                   self.STAGING_PREFIX + key + '_' + str(uuid.uuid4()))
+        os.makedirs(staging_dir)
+        return staging_dir
+
+    def publish(self, key, staging_dir, info):
+        """
+        publish: atomically move a completely built index from staging_dir into the cache
+        """
+        info = dict(info)
+        info['key'] = key
+        info['created'] = time.time()
+        with open(os.path.join(staging_dir, self.INFO_FILE), 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+
+        entry_dir = self.get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(staging_dir, entry_dir)
+        log('Cached STAR genome index {} in {}'.format(key, entry_dir))
+
+        return entry_dir
+
+    def discard(self, staging_dir):
+        shutil.rmtree(staging_dir, ignore_errors=True)
@@ -0,0 +1,48 @@
+import threading
+
+
+class Object_Info_Cache:
+    """
+    Object_Info_Cache: serves Workspace object infos (as returned by get_object_info3) from
+    memory once they have been looked up. It is meant to live for a single run_star request, so
+    that the refs the run resolves over and over (the genome, the reads set and its reads) are
+    only looked up once. The infos of all the refs missing from the cache in a call are looked up
+    with a single get_object_info3 call.
+    Unversioned refs are cached as they were first resolved, so objects that get new versions
+    during the run should be looked up with versioned refs.
+    """
+    def __init__(self, ws_client):
+        self.ws_client = ws_client
+        self.infos = dict()
+        self.lock = threading.Lock()
+
+    def get_infos(self, refs):
+        """
+        get_infos: return the object infos of refs, in the same order
+        """
+        with self.lock:
+            missing_refs = list()
+            for ref in refs:
+                if ref not in self.infos and ref not in missing_refs:
+                    missing_refs.append(ref)
+
+        if missing_refs:
+            infos = self.ws_client.get_object_info3(
+                        {'objects': [{'ref': ref} for ref in missing_refs]})['infos']
+            with self.lock:
+                for (ref, info) in zip(missing_refs, infos):
+                    self.infos[ref] = info
+                    # the same object may be asked for by its versioned ref later
+                    self.infos['{}/{}/{}'.format(info[6], info[0], info[4])] = info
+
+        with self.lock:
+            return [self.infos[ref] for ref in refs]
+
+    def get_info(self, ref):
+        return self.get_infos([ref])[0]
+
+    def get_type(self, ref):
+        return self.get_info(ref)[2]
+
+    def get_name(self, ref):
+        return self.get_info(ref)[1]
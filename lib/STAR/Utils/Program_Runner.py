@@ -1,33 +1,142 @@
-
+import os
+import time
+import signal
+import threading
 import subprocess
+from collections import deque, namedtuple
+
+
+# the outcome of a run: peak_rss is in bytes, output_tail holds the last lines of its output,
+# cpu_time is the user and system CPU time of the program in seconds
+Run_Result = namedtuple('Run_Result',
+                        ['exit_code', 'wall_time', 'peak_rss', 'timed_out', 'output_tail',
+                         'cpu_time'])
+Run_Result.__new__.__defaults__ = (None,)
 
 
 class Program_Runner:
+    # seconds between checks of the process and its progress file
+    POLL_INTERVAL = 1
+    OUTPUT_TAIL_LINES = 200
 
-    def __init__(self, cmd, scratch_dir):
+    def __init__(self, cmd, scratch_dir, inactivity_timeout=None):
+        """
+        inactivity_timeout: kill the program if it neither writes output nor updates its
+        progress file for this many seconds (None or 0 to wait forever)
+        """
         self.scratch_dir = scratch_dir
         self.executableName = cmd
+        self.inactivity_timeout = inactivity_timeout
+
+    def _stream_output(self, stream, prefix, output_tail, last_activity):
+        """
+        print the lines of stream as they come. Whatever the bytes, the stream is drained to its
+        end, as the program would block on writing to a full pipe otherwise.
+        """
+        for line in iter(stream.readline, b''):
+            last_activity[0] = time.time()
+            try:
+                # ASCII only, which prints whatever the encoding of a redirected stdout
+                line = line.rstrip().decode('utf-8', 'replace').encode('ascii', 'replace')
+                line = line.decode('ascii')
+                print(prefix + line)
+                output_tail.append(line)
+            except Exception as e:
+                output_tail.append(u'[unprintable output: {}]'.format(repr(e)))
+        stream.close()
 
-    def run(self, command, cwd_dir=None):
+    def _tail_progress_file(self, progress_file, progress_state, last_activity):
+        """
+        print whatever was appended to progress_file since the last call
+        """
+        if not progress_file or not os.path.isfile(progress_file):
+            return
+        size = os.path.getsize(progress_file)
+        if size < progress_state['offset']:
+            # the file was recreated
+            progress_state['offset'] = 0
+        if size == progress_state['offset']:
+            return
+        with open(progress_file) as f:
+            f.seek(progress_state['offset'])
+            new_content = f.read()
+            progress_state['offset'] = f.tell()
+        for line in new_content.splitlines():
+            print('[progress] ' + line)
+        last_activity[0] = time.time()
+
+    def run(self, command, cwd_dir=None, progress_file=None):
+        return self.execute(command, cwd_dir, progress_file).exit_code
+
+    def execute(self, command, cwd_dir=None, progress_file=None):
+        """
+        execute: run command, streaming its stdout/stderr and the lines appended to its
+        progress_file (if any) to the log while it runs. Returns a Run_Result.
+        """
         cmmd = command
 
         if not cwd_dir:
             cwd_dir = self.scratch_dir
 
-        # print('\nRunning: ' + ' '.join(cmmd))
+        print('\nRunning: ' + ' '.join(cmmd))
+        start_time = time.time()
+        # run in its own process group, so that a stuck program is killed with its children
         p = subprocess.Popen(cmmd, cwd=cwd_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, close_fds=True)
-        exitCode = p.wait()
+                             stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        p.stdin.close()
+
+        output_tail = deque(maxlen=self.OUTPUT_TAIL_LINES)
+        last_activity = [start_time]
+        readers = [threading.Thread(target=self._stream_output,
+                                    args=(p.stdout, '', output_tail, last_activity)),
+                   threading.Thread(target=self._stream_output,
+                                    args=(p.stderr, '[stderr] ', output_tail, last_activity))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        progress_state = {'offset': 0}
+        timed_out = False
+        while True:
+            # os.wait4 reaps the process and reports its resource usage, incl. the peak RSS
+            (pid, status, rusage) = os.wait4(p.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            self._tail_progress_file(progress_file, progress_state, last_activity)
+            if (self.inactivity_timeout and not timed_out and
+                    time.time() - last_activity[0] > self.inactivity_timeout):
+                print('No activity from {} for {} seconds, killing it'.format(
+                      cmmd[0], self.inactivity_timeout))
+                timed_out = True
+                os.killpg(p.pid, signal.SIGKILL)
+            time.sleep(self.POLL_INTERVAL)
+
+        if os.WIFSIGNALED(status):
+            exitCode = -os.WTERMSIG(status)
+        else:
+            exitCode = os.WEXITSTATUS(status)
+        # the process is already reaped, let Popen know
+        p.returncode = exitCode
+
+        for reader in readers:
+            reader.join()
+        self._tail_progress_file(progress_file, progress_state, last_activity)
+
+        result = Run_Result(exit_code=exitCode,
+                            wall_time=time.time() - start_time,
+                            # ru_maxrss is in kilobytes on Linux
+                            peak_rss=rusage.ru_maxrss * 1024,
+                            timed_out=timed_out,
+                            output_tail=list(output_tail),
+                            cpu_time=rusage.ru_utime + rusage.ru_stime)
 
         if (exitCode == 0):
             print('\n' + ' '.join(cmmd) + ' was executed successfully, exit code was: ' +
                   str(exitCode))
         else:
-            star_msg = ''
-            for line in p.stdout:
-                line = line.rstrip() + '\n'
-                star_msg += line
+            star_msg = '\n'.join(result.output_tail)
             print('Error running command: ' + ' '.join(cmmd) + 'Exit Code: ' +
                   str(exitCode) + '\n\n******STAR run report******\n' + star_msg)
-        return exitCode
-
+        print('Wall time: {:.1f}s, CPU time: {:.1f}s, peak RSS: {} bytes'.format(
+              result.wall_time, result.cpu_time, result.peak_rss))
+        return result
@@ -0,0 +1,89 @@
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Reads_Prefetcher:
+    """
+    Reads_Prefetcher: downloads the reads libraries of a sample set in a background thread pool,
+    up to depth libraries ahead of the one being aligned, and hands them out in their original
+    order. A new download is only started while the scratch disk has room for it, estimated from
+    the size of the libraries downloaded so far.
+    """
+    # free space kept on scratch on top of the estimated size of the downloads in flight
+    MIN_FREE_BYTES = 1024 * 1024 * 1024
+
+    def __init__(self, fetch_func, reads_refs, depth, scratch_dir):
+        """
+        fetch_func: called with a reads dict from reads_refs, returns a reads info dict as
+                    returned by STARUtils.get_reads_info
+        """
+        self.fetch_func = fetch_func
+        self.reads_refs = reads_refs
+        self.depth = max(1, depth)
+        self.scratch_dir = scratch_dir
+        self.largest_reads_size = 0
+
+    def _get_reads_size(self, reads_info):
+        reads_size = 0
+        for key in ['file_fwd', 'file_rev']:
+            if reads_info.get(key, None) is not None and os.path.isfile(reads_info[key]):
+                reads_size += os.path.getsize(reads_info[key])
+        return reads_size
+
+    def _has_room(self, n_in_flight):
+        """
+        _has_room: check if scratch can hold one more download besides the ones in flight
+        """
+        stat = os.statvfs(self.scratch_dir)
+        free_bytes = stat.f_bavail * stat.f_frsize
+        # the alignment output of a library is about as big as the library itself
+        needed_bytes = (self.MIN_FREE_BYTES +
+                        2 * self.largest_reads_size * (n_in_flight + 1))
+        return free_bytes >= needed_bytes
+
+    def _remove_reads_files(self, reads_info):
+        for key in ['file_fwd', 'file_rev']:
+            if reads_info.get(key, None) is not None and os.path.isfile(reads_info[key]):
+                os.remove(reads_info[key])
+
+    def __iter__(self):
+        """
+        yields (reads, reads_info) for every reads in reads_refs, re-raising the error of a failed
+        download when its turn comes
+        """
+        pool = ThreadPool(self.depth)
+        pending = dict()
+        next_idx = 0
+        try:
+            for idx in range(len(self.reads_refs)):
+                if idx not in pending:
+                    pending[idx] = pool.apply_async(self.fetch_func, (self.reads_refs[idx],))
+                    next_idx = idx + 1
+                reads_info = pending.pop(idx).get()
+                self.largest_reads_size = max(self.largest_reads_size,
+                                              self._get_reads_size(reads_info))
+
+                # keep downloading the next libraries while this one is being aligned
+                while (next_idx < len(self.reads_refs) and len(pending) < self.depth and
+                        self._has_room(len(pending))):
+                    log('Prefetching reads {}'.format(self.reads_refs[next_idx]['ref']))
+                    pending[next_idx] = pool.apply_async(self.fetch_func,
+                                                         (self.reads_refs[next_idx],))
+                    next_idx += 1
+
+                yield (self.reads_refs[idx], reads_info)
+        finally:
+            # the consumer stopped early, so discard whatever was downloaded ahead of it
+            for idx in pending:
+                try:
+                    self._remove_reads_files(pending[idx].get())
+                except Exception:
+                    pass
+            pool.close()
+            pool.join()
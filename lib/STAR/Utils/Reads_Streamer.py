@@ -0,0 +1,197 @@
+import os
+import time
+import uuid
+import shutil
+import bz2
+import zlib
+import threading
+import requests
+
+from Workspace.WorkspaceClient import Workspace
+from STAR.Utils.file_util import READ_LENGTH_SAMPLE_SIZE, sample_read_lengths
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Reads_Streamer:
+    """
+    Reads_Streamer: feeds the FASTQ file(s) of a reads library to STAR through named pipes, as
+    they are downloaded from Shock, instead of materializing them in scratch first.
+    Compressed sources are decompressed on the fly while streaming, and STAR reads the pipes
+    through READ_FILES_COMMAND (gunzip/bunzip2 open their input non-blocking and cannot be
+    pointed at a pipe directly).
+    Only non-interleaved KBaseFile reads libraries can be streamed, everything else has to go
+    through ReadsUtils.download_reads.
+    """
+    STREAMABLE_TYPES = ['KBaseFile.SingleEndLibrary', 'KBaseFile.PairedEndLibrary']
+    COMPRESSION_EXTENSIONS = ['.gz', '.bz2']
+    READ_FILES_COMMAND = 'cat'
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, ws_url, scratch_dir):
+        self.ws_client = Workspace(ws_url)
+        self.scratch = scratch_dir
+        self.token = os.environ.get('KB_AUTH_TOKEN')
+        self.fifo_dir = None
+        self.writers = list()
+        self.errors = list()
+
+    def _get_reads_data(self, ref):
+        ret = self.ws_client.get_objects2({'objects': [{
+            'ref': ref,
+            'included': ['/lib', '/lib1', '/lib2', '/interleaved']}]})['data'][0]
+        return (ret['info'], ret['data'])
+
+    def _get_compression(self, file_name):
+        ext = os.path.splitext(file_name)[1]
+        if ext in self.COMPRESSION_EXTENSIONS:
+            return ext
+        return ''
+
+    def get_stream_sources(self, ref):
+        """
+        get_stream_sources: returns the reads info of ref, where file_fwd and file_rev are the
+        Shock file handles to stream from, or None if the reads cannot be streamed
+        """
+        (info, data) = self._get_reads_data(ref)
+        obj_type = info[2].split('-')[0]
+        if obj_type not in self.STREAMABLE_TYPES or data.get('interleaved', 0) == 1:
+            return None
+
+        if obj_type == 'KBaseFile.SingleEndLibrary':
+            libs = [data['lib']]
+            style = 'single'
+        else:
+            libs = [data['lib1'], data['lib2']]
+            style = 'paired'
+
+        # STAR applies the same readFilesCommand to both mates
+        compressions = set([self._get_compression(lib['file']['file_name']) for lib in libs])
+        if len(compressions) != 1:
+            return None
+
+        sources = {'object_ref': ref,
+                   'style': style,
+                   'name': libs[0]['file']['file_name'],
+                   'compression': compressions.pop(),
+                   'file_fwd': libs[0]['file']}
+        if len(libs) > 1:
+            sources['file_rev'] = libs[1]['file']
+        return sources
+
+    def _get_decompressor(self, compression):
+        if compression == '.gz':
+            # accept the gzip header and concatenated gzip members
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if compression == '.bz2':
+            return bz2.BZ2Decompressor()
+        return None
+
+    def _stream(self, shock_file, compression):
+        '''yield the content of shock_file, decompressed, as it is downloaded'''
+        url = '{}/node/{}?download_raw'.format(shock_file['url'], shock_file['id'])
+        headers = {'Authorization': 'OAuth ' + self.token}
+        resp = requests.get(url, headers=headers, stream=True)
+        try:
+            resp.raise_for_status()
+            decompressor = self._get_decompressor(compression)
+            for chunk in resp.iter_content(self.CHUNK_SIZE):
+                while decompressor is not None and chunk:
+                    try:
+                        yield decompressor.decompress(chunk)
+                    except EOFError:
+                        # the last bzip2 stream ended right at the end of the previous chunk
+                        decompressor = self._get_decompressor(compression)
+                        continue
+                    # a new gzip member (or bzip2 stream) may follow the one just ended
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        decompressor = self._get_decompressor(compression)
+                if decompressor is None:
+                    yield chunk
+        finally:
+            # stop downloading when the consumer stops early
+            resp.close()
+
+    def _write_to_fifo(self, shock_file, compression, fifo_path):
+        try:
+            stream = self._stream(shock_file, compression)
+            # opening the pipe blocks until STAR opens it for reading
+            with open(fifo_path, 'wb') as fifo:
+                for data in stream:
+                    fifo.write(data)
+        except Exception as e:
+            log('Streaming {} into {} failed: {}'.format(shock_file['id'], fifo_path, repr(e)))
+            self.errors.append(e)
+
+    def sample_read_lengths(self, sources, n_reads=READ_LENGTH_SAMPLE_SIZE):
+        """
+        sample_read_lengths: the read length distribution ({read length: number of reads}) of
+        the first n_reads reads of each mate of the reads in sources (see get_stream_sources),
+        downloading only as much of them as those reads take
+        """
+        distribution = dict()
+        for key in ['file_fwd', 'file_rev']:
+            if sources.get(key, None) is None:
+                continue
+            stream = self._stream(sources[key], sources['compression'])
+            try:
+                for (length, count) in sample_read_lengths(stream, n_reads).items():
+                    distribution[length] = distribution.get(length, 0) + count
+            finally:
+                stream.close()
+        return distribution
+
+    def open(self, sources):
+        """
+        open: create the named pipes for the reads in sources and start streaming into them.
+        Returns the reads info as returned by STARUtils.get_reads_info, with the pipes as files.
+        """
+        self.fifo_dir = os.path.join(self.scratch, 'reads_fifo_' + str(uuid.uuid4()))
+        os.makedirs(self.fifo_dir)
+
+        reads_info = {'object_ref': sources['object_ref'],
+                      'style': sources['style'],
+                      'name': sources['name'],
+                      'readFilesCommand': self.READ_FILES_COMMAND}
+        for key in ['file_fwd', 'file_rev']:
+            if sources.get(key, None) is None:
+                continue
+            fifo_path = os.path.join(self.fifo_dir, key + '.fastq')
+            os.mkfifo(fifo_path)
+            writer = threading.Thread(target=self._write_to_fifo,
+                                      args=(sources[key], sources['compression'], fifo_path))
+            writer.daemon = True
+            writer.start()
+            self.writers.append((writer, fifo_path))
+            reads_info[key] = fifo_path
+
+        return reads_info
+
+    def close(self):
+        """
+        close: wait for the streams to end and remove the pipes. Raises a RuntimeError if any of
+        the reads could not be streamed completely, as STAR would then have seen truncated input.
+        """
+        for (writer, fifo_path) in self.writers:
+            writer.join(1)
+            while writer.is_alive():
+                # STAR never opened the pipe (e.g. it failed early), so unblock the writer
+                try:
+                    os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                writer.join(1)
+        self.writers = list()
+
+        if self.fifo_dir is not None:
+            shutil.rmtree(self.fifo_dir, ignore_errors=True)
+            self.fifo_dir = None
+
+        if self.errors:
+            errors = self.errors
+            self.errors = list()
+            raise RuntimeError('Failed to stream reads into STAR: ' + repr(errors))
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Run_Journal:
+    """
+    Run_Journal: a persistent record of the samples of a sample set run that got through each
+    stage (downloaded, first_pass, aligned, uploaded), so that running the same request again
+    skips the work an interrupted run got done instead of starting over.
+    The journal of a request lives in <journal_dir>/<key>.jsonl, where key is a hash of the
+    parameters that determine the results. Each stage a sample gets through is appended to it as
+    a JSON line and synced to disk right away, so a crash loses at most the stages in progress.
+    A stage can come with the files it produced; it only counts as done while they still exist.
+    """
+    DIR_NAME = 'run_journal'
+    STAGES = ['downloaded', 'first_pass', 'aligned', 'uploaded']
+    # parameters that do not change the results, left out of the key
+    IGNORED_PARAMS = ['runThreadN', 'outBAMsortingThreadN', 'concurrent_local_tasks',
+                      'concurrent_njsw_tasks', 'create_report']
+
+    def __init__(self, journal_dir, params):
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        self.key = self.make_key(params)
+        self.journal_file = os.path.join(journal_dir, self.key + '.jsonl')
+        # the info recorded for each stage of each sample
+        self.records = dict()
+        # whether an earlier run of the same request left records to resume from
+        self.resumed = False
+        self.lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def make_key(cls, params):
+        '''make_key: the key of the journal of a request with the given (validated) params'''
+        key_params = dict([(k, v) for (k, v) in params.items() if k not in cls.IGNORED_PARAMS])
+        return hashlib.sha256(json.dumps(key_params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.isfile(self.journal_file):
+            return
+        n_records = 0
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a run killed while writing it
+                    continue
+                self.records.setdefault(record['sample'], dict())[record['stage']] = record
+                n_records += 1
+        self.resumed = n_records > 0
+        log('Resuming from run journal {} ({} records)'.format(self.journal_file, n_records))
+
+    def record(self, sample, stage, info=None, files=None):
+        """
+        record: record that sample got through stage, with the info to pick it up from and the
+        files it produced
+        """
+        if stage not in self.STAGES:
+            raise ValueError('Unknown run journal stage ' + str(stage))
+        record = {'sample': sample, 'stage': stage, 'info': info,
+                  'files': [f for f in files or [] if f], 'time': time.time()}
+        with self.lock:
+            self.records.setdefault(sample, dict())[stage] = record
+            with open(self.journal_file, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, sample, stage):
+        """
+        get: the info recorded for sample at stage, or None if it has not got through stage or
+        the files the stage produced are gone
+        """
+        with self.lock:
+            record = self.records.get(sample, dict()).get(stage, None)
+        if record is None:
+            return None
+        for file_path in record['files']:
+            if not os.path.isfile(file_path):
+                log('{} of {} is gone, redoing {}'.format(file_path, sample, stage))
+                return None
+        return record['info']
+
+    def discard(self):
+        '''discard: remove the journal, once the request it records has completed'''
+        with self.lock:
+            self.records = dict()
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+# the CPU usage of the calling thread only (Linux), not exposed by the python 2 resource module
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def _thread_cpu_time():
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        # no per thread accounting, fall back to the whole process
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _process_peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    """
+    Span: the measurements of one stage of a run, filled in while the stage runs
+    """
+    def __init__(self, name, label=None):
+        self.name = name
+        self.label = label
+        self.start = time.time()
+        self.wall_time = None
+        self.cpu_time = 0.0
+        self.bytes = 0
+        self.peak_rss = None
+        self.process_peak_rss = None
+        self.error = None
+        self._cpu_start = _thread_cpu_time()
+
+    def add_bytes(self, n_bytes):
+        '''count n_bytes as moved (downloaded, uploaded or written) by the stage'''
+        self.bytes += n_bytes or 0
+
+    def add_file(self, file_path):
+        '''count the size of file_path as moved by the stage'''
+        if file_path and os.path.isfile(file_path):
+            self.add_bytes(os.path.getsize(file_path))
+
+    def add_run(self, run_result):
+        '''account for a program run by the stage, given its Program_Runner Run_Result'''
+        if run_result.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, run_result.peak_rss)
+        if run_result.cpu_time is not None:
+            self.cpu_time += run_result.cpu_time
+
+    def finish(self, error=None):
+        self.wall_time = time.time() - self.start
+        self.cpu_time += _thread_cpu_time() - self._cpu_start
+        self.process_peak_rss = _process_peak_rss()
+        self.error = error
+
+    def to_dict(self):
+        return {'name': self.name,
+                'label': self.label,
+                'start': self.start,
+                'wall_time': self.wall_time,
+                'cpu_time': self.cpu_time,
+                'bytes': self.bytes,
+                'peak_rss': self.peak_rss,
+                'process_peak_rss': self.process_peak_rss,
+                'error': self.error}
+
+
+class Run_Manifest:
+    """
+    Run_Manifest: records a span for every stage of a run_star request (wall time, CPU time,
+    bytes moved and peak RSS), along with the settings chosen for the run, and writes them as a
+    machine readable JSON manifest.
+    The CPU time of a span is the CPU time of the thread running it, plus the CPU time of the
+    programs (STAR) it ran; its peak_rss is the peak RSS of those programs. process_peak_rss is
+    the peak RSS of this process so far, as of the end of the span.
+    """
+    FILE_NAME = 'run_manifest.json'
+    # the stages of a run, in the order they are summarized in
+    STAGES = ['process_params', 'fetch_fasta', 'convert_gtf', 'indexing', 'download_reads',
+              'mapping', 'upload', 'qualimap', 'packaging', 'report']
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = list()
+        self.settings = dict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, label=None):
+        """
+        span: measure the stage name (of e.g. the reads label) run in the with block, the
+        Span is given to the block to add the bytes moved and the programs run
+        """
+        span = Span(name, label)
+        try:
+            yield span
+        except Exception as e:
+            span.finish(repr(e))
+            raise
+        else:
+            span.finish()
+        finally:
+            with self.lock:
+                self.spans.append(span)
+
+    def set(self, key, value):
+        '''record a setting chosen for the run'''
+        with self.lock:
+            self.settings[key] = value
+
+    def summarize(self):
+        """
+        summarize: returns the totals of each stage (number of spans, wall time, CPU time and
+        bytes moved) and the largest peak RSS of its programs, in the order of STAGES
+        """
+        with self.lock:
+            spans = list(self.spans)
+        names = self.STAGES + sorted(set([s.name for s in spans]) - set(self.STAGES))
+        summary = list()
+        for name in names:
+            stage_spans = [s for s in spans if s.name == name]
+            if not stage_spans:
+                continue
+            peak_rss = [s.peak_rss for s in stage_spans if s.peak_rss is not None]
+            summary.append({'name': name,
+                            'count': len(stage_spans),
+                            'wall_time': sum([s.wall_time for s in stage_spans]),
+                            'cpu_time': sum([s.cpu_time for s in stage_spans]),
+                            'bytes': sum([s.bytes for s in stage_spans]),
+                            'peak_rss': max(peak_rss) if peak_rss else None,
+                            'errors': len([s for s in stage_spans if s.error])})
+        return summary
+
+    def format_summary(self):
+        '''the summary as a text table, for the report and the log'''
+        lines = ['{:<16}{:>6}{:>12}{:>12}{:>14}{:>14}'.format(
+                    'Stage', 'Runs', 'Wall (s)', 'CPU (s)', 'Bytes', 'Peak RSS')]
+        for stage in self.summarize():
+            lines.append('{:<16}{:>6}{:>12.1f}{:>12.1f}{:>14}{:>14}'.format(
+                stage['name'], stage['count'], stage['wall_time'], stage['cpu_time'],
+                stage['bytes'], stage['peak_rss'] if stage['peak_rss'] is not None else '-'))
+        lines.append('Total wall time: {:.1f}s'.format(time.time() - self.start))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        with self.lock:
+            spans = [s.to_dict() for s in self.spans]
+            settings = dict(self.settings)
+        return {'start': self.start,
+                'wall_time': time.time() - self.start,
+                'settings': settings,
+                'stages': self.summarize(),
+                'spans': spans}
+
+    def write(self, output_dir):
+        """
+        write: write the manifest as FILE_NAME into output_dir, returns the path of the file
+        """
+        manifest_file = os.path.join(output_dir, self.FILE_NAME)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+        os.rename(manifest_file + '.tmp', manifest_file)
+        return manifest_file
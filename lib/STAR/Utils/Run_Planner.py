@@ -0,0 +1,211 @@
+import os
+import copy
+import time
+
+from STAR.Utils.STARUtils import STARUtils
+from STAR.Utils import resource_util
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Run_Planner:
+    """
+    Run_Planner: estimates the memory, scratch disk and wall time a run_star request needs from
+    the metadata of its genome (the length of its assembly) and of its reads (the size of their
+    files), without downloading any of them, and picks how run_align would run it on this node:
+    the genomeSAsparseD of the index, the number of concurrent mappings and their threads.
+    A request that would run out of memory or scratch is reported as not feasible, with the
+    reasons, before it takes a queue slot to find out.
+    The estimates are rough: they model STAR's data structures and a typical throughput, not the
+    particulars of the reads.
+    """
+    # the metadata of the reads libraries the estimates are made from
+    READS_PATHS = ['/lib/file/file_name', '/lib/size', '/lib1/file/file_name', '/lib1/size',
+                   '/lib2/file/file_name', '/lib2/size', '/total_bases']
+    COMPRESSION_EXTENSIONS = ['.gz', '.bz2']
+    # uncompressed FASTQ bytes per byte of a gzipped or bzipped reads file
+    COMPRESSION_RATIO = 4
+    # FASTQ bytes per base: the base, its quality and a share of the record header
+    FASTQ_BYTES_PER_BASE = 2.5
+    # BAM bytes per FASTQ byte of the reads aligned
+    BAM_BYTES_PER_FASTQ_BYTE = 0.25
+    # typical throughputs, for the wall time estimate
+    INDEX_BASES_PER_THREAD_SECOND = 50000
+    MAPPING_BASES_PER_THREAD_SECOND = 1500000
+    TRANSFER_BYTES_PER_SECOND = 50000000
+    # a single STAR run stops scaling at about this many threads
+    MAX_MAPPING_THREADS = 16
+
+    def __init__(self, star_utils, mapping_overhead_ram, parallel_bam_sort_ram):
+        self.star_utils = star_utils
+        self.ws_client = star_utils.ws_client
+        self.mapping_overhead_ram = mapping_overhead_ram
+        self.parallel_bam_sort_ram = parallel_bam_sort_ram
+
+    def _get_type(self, ref):
+        return self.star_utils.get_type_from_obj_info(self.star_utils.get_obj_infos(ref)[0])
+
+    def _get_data(self, ref, included):
+        return self.ws_client.get_objects2(
+                    {'objects': [{'ref': ref, 'included': included}]})['data'][0]['data']
+
+    def get_genome_stats(self, genome_ref):
+        """
+        get_genome_stats: the length (in bases) and number of contigs of the assembly of the
+        genome or assembly genome_ref, from the metadata of the assembly
+        """
+        ref = genome_ref
+        obj_type = self._get_type(ref)
+        if obj_type == 'KBaseGenomes.Genome':
+            data = self._get_data(genome_ref, ['/assembly_ref', '/contigset_ref'])
+            assembly_ref = data.get('assembly_ref', None) or data.get('contigset_ref', None)
+            if assembly_ref is None:
+                raise ValueError('Genome {} has no assembly'.format(genome_ref))
+            ref = genome_ref + ';' + assembly_ref
+            obj_type = self._get_type(ref)
+
+        if obj_type == 'KBaseGenomeAnnotations.Assembly':
+            data = self._get_data(ref, ['/dna_size', '/num_contigs'])
+            return (data['dna_size'], data['num_contigs'])
+        if obj_type == 'KBaseGenomes.ContigSet':
+            data = self._get_data(ref, ['/contigs/[*]/length'])
+            return (sum([c['length'] for c in data['contigs']]), len(data['contigs']))
+        raise ValueError('Unable to get the genome length of an object of type ' + obj_type)
+
+    def get_reads_stats(self, reads_refs):
+        """
+        get_reads_stats: the size of the reads on scratch (uncompressed, as they are downloaded)
+        and their number of bases, for each of reads_refs. Either is None if the metadata of the
+        reads does not tell.
+        """
+        if not reads_refs:
+            return list()
+        objs = self.ws_client.get_objects2(
+                    {'objects': [{'ref': r['ref'], 'included': self.READS_PATHS}
+                                 for r in reads_refs]})['data']
+        reads_stats = list()
+        for (r, obj) in zip(reads_refs, objs):
+            data = obj['data'] or {}
+            libs = [data[lib] for lib in ['lib', 'lib1', 'lib2'] if data.get(lib, None)]
+            fastq_bytes = None
+            if libs and all([lib.get('size', None) is not None for lib in libs]):
+                fastq_bytes = 0
+                for lib in libs:
+                    file_name = lib.get('file', {}).get('file_name', '') or ''
+                    compressed = os.path.splitext(file_name)[1] in self.COMPRESSION_EXTENSIONS
+                    fastq_bytes += lib['size'] * (self.COMPRESSION_RATIO if compressed else 1)
+            bases = data.get('total_bases', None)
+            if bases is None and fastq_bytes is not None:
+                bases = int(fastq_bytes / self.FASTQ_BYTES_PER_BASE)
+            if fastq_bytes is None and bases is not None:
+                fastq_bytes = int(bases * self.FASTQ_BYTES_PER_BASE)
+            reads_stats.append({'ref': r['ref'], 'bytes': fastq_bytes, 'bases': bases})
+        return reads_stats
+
+    def plan(self, params, reads_refs, n_tasks, max_jobs, plan_jobs, prefetch_depth=0):
+        """
+        plan: estimate the resources the request in (validated) params needs and pick how to run
+        it, returns a StarPlan (see the spec).
+        n_tasks: the mappings the request splits into (reads libraries, or shards of one)
+        max_jobs: how many of them may run at once
+        plan_jobs: splits the CPUs and memory between concurrent mappings, as
+                   STAR_Aligner._plan_local_jobs(n_tasks, max_jobs, shared_genome, genome_ram)
+        prefetch_depth: how many reads libraries are downloaded ahead of the one being mapped
+        """
+        params = copy.deepcopy(params)
+        problems = list()
+        warnings = list()
+        available_memory = resource_util.get_available_memory()
+        available_scratch = resource_util.get_free_disk_space(self.star_utils.scratch)
+
+        (genome_length, n_contigs) = self.get_genome_stats(params[STARUtils.PARAM_IN_GENOME])
+        log('Planning for a genome of {} bases in {} contigs'.format(genome_length, n_contigs))
+        reads_stats = self.get_reads_stats(reads_refs)
+        for s in reads_stats:
+            if s['bytes'] is None:
+                warnings.append('The size of reads {} is unknown, '.format(s['ref']) +
+                                'it is left out of the estimates')
+        reads_bytes = [s['bytes'] for s in reads_stats if s['bytes'] is not None]
+        reads_bases = sum([s['bases'] for s in reads_stats if s['bases'] is not None])
+
+        # 1. Index: with the sparse suffix array run_align would pick to fit genomeGenerate
+        self.star_utils.derive_genome_generate_params(params, genome_length, n_contigs)
+        sparse_d = params.get('genomeSAsparseD', None) or 1
+        index_ram = self.star_utils.estimate_genome_generate_ram(
+                        genome_length, params['genomeSAindexNbases'], sparse_d)
+        if index_ram > available_memory:
+            problems.append('Indexing needs about {} bytes of memory with genomeSAsparseD {}, '
+                            '{} bytes are available'.format(index_ram, sparse_d,
+                                                            available_memory))
+        # the genome and its suffix arrays, as mapping holds them in memory and on disk
+        genome_ram = int(index_ram / STARUtils.INDEX_RAM_OVERHEAD)
+
+        # 2. Mapping: the concurrent mappings and the memory they need
+        (n_jobs, n_threads, job_ram) = plan_jobs(n_tasks, max_jobs, max_jobs > 1, genome_ram)
+        sorts_bam = params.get('outSAMtype', None) == 'BAM'
+        if n_jobs > 1:
+            # sharing one genome in memory
+            mapping_ram = self.mapping_overhead_ram
+            bam_sort_ram = self.parallel_bam_sort_ram if sorts_bam else 0
+            total_mapping_ram = genome_ram + n_jobs * (mapping_ram + bam_sort_ram)
+        else:
+            n_threads = params[STARUtils.PARAM_IN_THREADN]
+            mapping_ram = genome_ram + self.mapping_overhead_ram
+            # STAR sorts BAM in as much memory as the genome takes, unless told otherwise
+            bam_sort_ram = (params.get('limitBAMsortRAM', None) or genome_ram) if sorts_bam else 0
+            total_mapping_ram = mapping_ram + bam_sort_ram
+        if total_mapping_ram > available_memory:
+            problems.append('Mapping needs about {} bytes of memory, {} bytes are '
+                            'available'.format(total_mapping_ram, available_memory))
+
+        # 3. Scratch: the index, and the reads and the outputs of the mappings in flight, whose
+        # intermediates are deleted once their alignments are uploaded
+        largest_reads = max(reads_bytes) if reads_bytes else 0
+        n_bams = 2 if params.get('quantMode', None) in ['TranscriptomeSAM', 'Both'] else 1
+        # the BAM, the same again while sorting it, and the transcriptome BAM
+        sample_scratch = largest_reads * (1 + (1 + n_bams) * self.BAM_BYTES_PER_FASTQ_BYTE)
+        if len(reads_refs) == 1:
+            # the shards are a copy of the reads
+            in_flight = sample_scratch + (largest_reads if n_jobs > 1 else 0)
+        elif n_jobs > 1:
+            in_flight = n_jobs * sample_scratch
+        else:
+            in_flight = sample_scratch + min(prefetch_depth, len(reads_refs) - 1) * largest_reads
+        peak_scratch = int(genome_ram + in_flight)
+        if peak_scratch > available_scratch:
+            problems.append('The run needs about {} bytes of scratch, {} bytes are '
+                            'free'.format(peak_scratch, available_scratch))
+
+        # 4. Wall time: download, index, map and upload
+        n_passes = 2 if params.get('twopassMode', None) in ['Basic', 'Batch'] else 1
+        n_indexes = 2 if params.get('twopassMode', None) == 'Batch' else 1
+        mapping_rate = (self.MAPPING_BASES_PER_THREAD_SECOND *
+                        min(n_threads, self.MAX_MAPPING_THREADS) * n_jobs)
+        wall_time = (sum(reads_bytes) * (1 + n_bams * self.BAM_BYTES_PER_FASTQ_BYTE) /
+                     self.TRANSFER_BYTES_PER_SECOND +
+                     n_indexes * genome_length / float(self.INDEX_BASES_PER_THREAD_SECOND *
+                                                       params[STARUtils.PARAM_IN_THREADN]) +
+                     n_passes * reads_bases / float(mapping_rate))
+
+        return {'feasible': 0 if problems else 1,
+                'problems': problems,
+                'warnings': warnings,
+                'genome_length': genome_length,
+                'n_contigs': n_contigs,
+                'n_reads_libraries': len(reads_refs),
+                'reads_bytes': sum(reads_bytes),
+                'index_ram': index_ram,
+                'mapping_ram': mapping_ram,
+                'bam_sort_ram': bam_sort_ram,
+                'peak_ram': max(index_ram, total_mapping_ram),
+                'peak_scratch': peak_scratch,
+                'wall_time': wall_time,
+                'available_memory': available_memory,
+                'available_scratch': available_scratch,
+                'cpus': resource_util.get_cpu_count(),
+                'genomeSAsparseD': sparse_d,
+                'runThreadN': n_threads,
+                'concurrent_local_tasks': n_jobs}
@@ -1,12 +1,20 @@
 import time
 import os
 import re
+import math
 import copy
 import uuid
+import shutil
 import zipfile
+from multiprocessing.pool import ThreadPool
 from pprint import pprint, pformat
 
 from STAR.Utils.Program_Runner import Program_Runner
+from STAR.Utils.STAR_Executor import STAR_Executor
+from STAR.Utils.Genome_Index_Cache import Genome_Index_Cache
+from STAR.Utils.Object_Info_Cache import Object_Info_Cache
+from STAR.Utils.Run_Manifest import Run_Manifest
+from STAR.Utils import resource_util
 from DataFileUtil.DataFileUtilClient import DataFileUtil
 from Workspace.WorkspaceClient import Workspace
 from KBaseReport.KBaseReportClient import KBaseReport
@@ -23,7 +31,10 @@ from file_util import (
     get_unique_names,
     fetch_fasta_from_object,
     fetch_reads_refs_from_sampleset,
-    fetch_reads_from_reference
+    fetch_reads_from_reference,
+    get_fasta_stats,
+    merge_geneCount_files,
+    merge_sj_files
 )
 
 
@@ -35,6 +46,7 @@ def log(message, prefix_newline=False):
 class STARUtils:
     STAR_VERSION = 'STAR 2.6.1a'
     STAR_BIN = '/kb/deployment/bin/STAR'
+    SAMTOOLS_BIN = '/kb/deployment/bin/samtools'
     STAR_IDX_DIR = 'STAR_Genome_index'
     STAR_OUT_DIR = 'STAR_Output'
     PARAM_IN_WS = 'output_workspace'
@@ -47,8 +59,46 @@ class STARUtils:
     PARAM_IN_GENOME = 'genome_ref'
     # holding a list of all reads objects that are a part of a sample/reads set object
     SET_READS = 'set_reads_refs'
-
-    def __init__(self, scratch_dir, workspace_url, callback_url, srv_wiz_url, provenance):
+    # RAM (in bytes) for sorting BAM, required by STAR when the genome is in shared memory
+    SHARED_GENOME_BAM_SORT_RAM = 10000000000
+    # files that are compressed already, and are stored as they are when zipping results
+    COMPRESSED_EXTENSIONS = ['.bam', '.cram', '.gz', '.bz2', '.zip']
+    # the bulk of a genome index: packed sequence and suffix arrays that deflate takes long to
+    # shrink by little, so they are stored as they are when zipping results
+    DENSE_INDEX_FILES = ['Genome', 'SA', 'SAindex']
+    # genomeGenerate parameters that are derived from the genome when not given
+    GENOME_GENERATE_PARAMS = ['genomeSAindexNbases', 'genomeChrBinNbits', 'genomeSAsparseD']
+    # read length assumed for sizing the genome bins when sjdbOverhang is not given
+    DEFAULT_READ_LENGTH = 101
+    # fraction of the memory limit of the container genomeGenerate may use
+    INDEX_RAM_FRACTION = 0.9
+    # the limitGenomeGenerateRAM of STAR when none is given
+    DEFAULT_GENOME_GENERATE_RAM = 31000000000
+    # room for the sorting buffers of genomeGenerate, on top of the index itself
+    INDEX_RAM_OVERHEAD = 1.1
+    # the genomeSAsparseD values tried, from the fastest to the smallest index
+    SPARSE_SA_STEPS = [1, 2, 3, 4, 6, 8, 12, 16]
+    # the filters of the junctions in SJ.out.tab that depend on the reads of the whole library,
+    # with their STAR defaults: by motif (non-canonical, GT/AG, GC/AG, AT/AC), except for the
+    # longest intron by number of reads
+    SJ_COUNT_FILTERS = {'outSJfilterOverhangMin': [30, 12, 12, 12],
+                        'outSJfilterCountUniqueMin': [3, 1, 1, 1],
+                        'outSJfilterCountTotalMin': [3, 1, 1, 1],
+                        'outSJfilterIntronMaxVsReadN': [50000, 100000, 200000]}
+    # the same filters letting every junction through, for mapping a part of a library
+    SJ_COUNT_FILTERS_OFF = {'outSJfilterOverhangMin': [1, 1, 1, 1],
+                            'outSJfilterCountUniqueMin': [1, 1, 1, 1],
+                            'outSJfilterCountTotalMin': [1, 1, 1, 1],
+                            'outSJfilterIntronMaxVsReadN': [2147483647]}
+    # None: one pass, Basic: STAR's two passes per mapping, Batch: two passes per reads set
+    TWOPASS_MODES = ['None', 'Basic', 'Batch']
+    # the read mapped to have STAR insert junctions into a genome (it inserts them before mapping)
+    JUNCTION_INSERTION_READ = '@sjdb_insert\n' + 'N' * 50 + '\n+\n' + 'I' * 50 + '\n'
+
+    def __init__(self, scratch_dir, workspace_url, callback_url, srv_wiz_url, provenance,
+                 config=None):
+        if config is None:
+            config = {}
         self.workspace_url = workspace_url
         self.callback_url = callback_url
         self.srv_wiz_url = srv_wiz_url
@@ -56,9 +106,22 @@ class STARUtils:
         self.dfu = DataFileUtil(self.callback_url, service_ver='release')
         self.scratch = scratch_dir
         self.working_dir = scratch_dir
-        self.prog_runner = Program_Runner(self.STAR_BIN, self.scratch)
+        # STAR runs that show no sign of progress for this many seconds are killed
+        self.prog_runner = Program_Runner(self.STAR_BIN, self.scratch,
+                                          int(config.get('star-inactivity-timeout', 0)))
+        # STAR runs that fail for lack of memory or disk, or that got stuck, are retried
+        self.star_executor = STAR_Executor(int(config.get('star-max-retries', 2)),
+                                           int(config.get('star-retry-backoff', 30)))
         self.provenance = provenance
         self.ws_client = Workspace(self.workspace_url)
+        # the infos of the objects this run looks up
+        self.info_cache = Object_Info_Cache(self.ws_client)
+        # the spans of the stages of this run
+        self.run_manifest = Run_Manifest()
+        # whether the thread counts were sized from the CPUs, rather than given as runThreadN
+        self.auto_threads = False
+        # whether to attach the zipped genome index to the report
+        self.package_index = config.get('package-star-index', 'true').lower() == 'true'
 
         self.parallel_runner = KBParallel(self.callback_url)
         self.qualimap = kb_QualiMap(self.callback_url, service_ver='release')
@@ -117,12 +180,54 @@ class STARUtils:
         if params.get('sjdbGTFfile', None) is not None:
             idx_cmd.append('--sjdbGTFfile')
             idx_cmd.append(params['sjdbGTFfile'])
+        # junctions found by mapping, inserted along with the annotated ones
+        if params.get('sjdbFileChrStartEnd', None) is not None:
+            idx_cmd.append('--sjdbFileChrStartEnd')
+            idx_cmd.append(params['sjdbFileChrStartEnd'])
         if (params.get('sjdbOverhang', None) is not None and params['sjdbOverhang'] > 0):
             idx_cmd.append('--sjdbOverhang')
             idx_cmd.append(str(params['sjdbOverhang']))
+        for genome_param in self.GENOME_GENERATE_PARAMS:
+            if params.get(genome_param, None) is not None:
+                idx_cmd.append('--' + genome_param)
+                idx_cmd.append(str(params[genome_param]))
+        if params.get('limitGenomeGenerateRAM', None) is not None:
+            idx_cmd.append('--limitGenomeGenerateRAM')
+            idx_cmd.append(str(params['limitGenomeGenerateRAM']))
 
         return idx_cmd
 
+    def _construct_junction_insertion_cmd(self, params):
+        # map a placeholder read against the genome, having STAR insert the junctions on the fly
+        # and save the genome with them inserted (all of it) into <outFileNamePrefix>_STARgenome
+        ins_cmd = [self.STAR_BIN]
+        ins_cmd.append('--genomeDir')
+        ins_cmd.append(params[self.STAR_IDX_DIR])
+        ins_cmd.append('--' + self.PARAM_IN_STARMODE)
+        ins_cmd.append('alignReads')
+        ins_cmd.append('--' + self.PARAM_IN_THREADN)
+        ins_cmd.append(str(params[self.PARAM_IN_THREADN]))
+        ins_cmd.append('--' + self.PARAM_IN_READS_FILES)
+        ins_cmd.extend(params[self.PARAM_IN_READS_FILES])
+        ins_cmd.append('--' + self.PARAM_IN_OUTFILE_PREFIX)
+        ins_cmd.append(params[self.PARAM_IN_OUTFILE_PREFIX])
+        ins_cmd.append('--outSAMtype')
+        ins_cmd.append('None')
+        ins_cmd.append('--sjdbInsertSave')
+        ins_cmd.append('All')
+
+        if params.get('sjdbGTFfile', None) is not None:
+            ins_cmd.append('--sjdbGTFfile')
+            ins_cmd.append(params['sjdbGTFfile'])
+        if params.get('sjdbFileChrStartEnd', None) is not None:
+            ins_cmd.append('--sjdbFileChrStartEnd')
+            ins_cmd.append(params['sjdbFileChrStartEnd'])
+        if (params.get('sjdbOverhang', None) is not None and params['sjdbOverhang'] > 0):
+            ins_cmd.append('--sjdbOverhang')
+            ins_cmd.append(str(params['sjdbOverhang']))
+
+        return ins_cmd
+
     def _construct_mapping_cmd(self, params):
         if params.get(self.PARAM_IN_STARMODE, None) is None:
             params[self.PARAM_IN_STARMODE] = 'alignReads'
@@ -143,22 +248,39 @@ class STARUtils:
         mp_cmd.append('--' + self.PARAM_IN_THREADN)
         mp_cmd.append(str(params[self.PARAM_IN_THREADN]))
 
+        # a genome in shared memory cannot have junctions inserted on the fly, so it is only
+        # shared when the annotations are in the index already, and the sjdb options are left out
+        shared_genome = params.get('genomeLoad', 'NoSharedMemory') != 'NoSharedMemory'
+        if shared_genome and self.needs_sjdb_insertion(params[self.STAR_IDX_DIR], params):
+            raise ValueError('Mapping with twopassMode Basic, or with annotations that are not '
+                             'in the genome index, cannot use a genome in shared memory '
+                             '(genomeLoad ' + params['genomeLoad'] + ')')
+        if shared_genome:
+            mp_cmd.append('--genomeLoad')
+            mp_cmd.append(params['genomeLoad'])
+
         if params.get(self.PARAM_IN_READS_FILES, None) is not None:
             # print('Input reads files:\n' + pformat(params[self.PARAM_IN_READS_FILES]))
             mp_cmd.append('--' + self.PARAM_IN_READS_FILES)
             for reads_file in params[self.PARAM_IN_READS_FILES]:
                 mp_cmd.append(reads_file)
-                readName, readsExtension = os.path.splitext(reads_file)
-                # print ('Reads file name-- {}/extension-- {}:'.format(readName, readsExtension))
-                if readsExtension == '.gz':
-                    mp_cmd.append('--readFilesCommand')
-                    mp_cmd.append('gunzip')
-                    mp_cmd.append('-c')
-
-                if readsExtension == '.bz2':
-                    mp_cmd.append('--readFilesCommand')
-                    mp_cmd.append('bunzip2')
-                    mp_cmd.append('-c')
+
+            # the same --readFilesCommand is applied to all the reads files (mates)
+            readName, readsExtension = os.path.splitext(params[self.PARAM_IN_READS_FILES][0])
+            # print ('Reads file name-- {}/extension-- {}:'.format(readName, readsExtension))
+            if params.get('readFilesCommand', None) is not None:
+                mp_cmd.append('--readFilesCommand')
+                mp_cmd.extend(params['readFilesCommand'].split())
+
+            elif readsExtension == '.gz':
+                mp_cmd.append('--readFilesCommand')
+                mp_cmd.append('gunzip')
+                mp_cmd.append('-c')
+
+            elif readsExtension == '.bz2':
+                mp_cmd.append('--readFilesCommand')
+                mp_cmd.append('bunzip2')
+                mp_cmd.append('-c')
 
         # STEP 3: appending the advanced optional inputs
         if params.get(self.PARAM_IN_OUTFILE_PREFIX, None) is not None:
@@ -168,18 +290,26 @@ class STARUtils:
         if params.get('outSAMunmapped', None) is not None:
             mp_cmd.append('--outSAMunmapped')
             mp_cmd.append(str(params['outSAMunmapped']))
-        if params.get('sjdbGTFfile', None) is not None:
+        if params.get('sjdbGTFfile', None) is not None and not shared_genome:
             mp_cmd.append('--sjdbGTFfile')
             mp_cmd.append(params['sjdbGTFfile'])
         if (params.get('sjdbOverhang', None) is not None
-                and params['sjdbOverhang'] > 0):
+                and params['sjdbOverhang'] > 0 and not shared_genome):
             mp_cmd.append('--sjdbOverhang')
             mp_cmd.append(str(params['sjdbOverhang']))
+        # the junctions found by the first pass are inserted on the fly for the second one
+        if params.get('twopassMode', None) == 'Basic':
+            mp_cmd.append('--twopassMode')
+            mp_cmd.append('Basic')
 
         if (params.get('outFilterType', None) is not None
                 and isinstance(params['outFilterType'], str)):
             mp_cmd.append('--outFilterType')
             mp_cmd.append(params['outFilterType'])
+        for sj_filter in sorted(self.SJ_COUNT_FILTERS):
+            if params.get(sj_filter, None) is not None:
+                mp_cmd.append('--' + sj_filter)
+                mp_cmd.extend([str(v) for v in params[sj_filter]])
         if (params.get('outFilterMultimapNmax', None) is not None
                 and isinstance(params['outFilterMultimapNmax'], int)
                 and params['outFilterMultimapNmax'] >= 0):
@@ -193,6 +323,13 @@ class STARUtils:
             mp_cmd.append(params['outSAMtype'])
             if params.get('outSAMtype', None) == 'BAM':
                 mp_cmd.append('SortedByCoordinate')
+                if params.get('outBAMsortingThreadN', None):
+                    mp_cmd.append('--outBAMsortingThreadN')
+                    mp_cmd.append(str(params['outBAMsortingThreadN']))
+                if shared_genome:
+                    mp_cmd.append('--limitBAMsortRAM')
+                    mp_cmd.append(str(params.get('limitBAMsortRAM',
+                                                 self.SHARED_GENOME_BAM_SORT_RAM)))
 
         # 'It is recommended to remove the non-canonical junctions for Cnks runs using
         # --outFilterIntronMotifs RemoveNoncanonical'
@@ -222,7 +359,7 @@ class STARUtils:
             # Count genes option requires the annotations (GTF/GFF with -sjdbGTFfile option) file
             if ((params['quantMode'] == 'Both' or
                 params['quantMode'] == 'GeneCounts') and
-                    '--sjdbGTFfile' not in mp_cmd):
+                    '--sjdbGTFfile' not in mp_cmd and not shared_genome):
                 mp_cmd.append('--sjdbGTFfile')
                 mp_cmd.append(params['sjdbGTFfile'])
 
@@ -264,24 +401,235 @@ class STARUtils:
         # print ' '.join(mp_cmd)
         return mp_cmd
 
-    def exec_indexing(self, params):
+    def run_indexing(self, params):
+        '''run STAR genomeGenerate and return the Program_Runner Run_Result'''
         log('Running STAR index generating with params:\n' + pformat(params))
 
         idx_cmd = self._construct_indexing_cmd(params)
 
-        exitCode = self.prog_runner.run(idx_cmd, self.scratch)
+        # STAR logs the progress of genomeGenerate to Log.out in its working directory
+        with self.run_manifest.span('indexing') as span:
+            run_result = self.prog_runner.execute(idx_cmd, self.scratch,
+                                                  os.path.join(self.scratch, 'Log.out'))
+            span.add_run(run_result)
+        return run_result
 
-        return exitCode
+    def exec_indexing(self, params):
+        return self.run_indexing(params).exit_code
 
-    def exec_mapping(self, params):
+    def run_mapping(self, params):
+        '''run STAR alignReads and return the Program_Runner Run_Result'''
         log('Running STAR mapping with params:\n' + pformat(params))
 
         mp_cmd = self._construct_mapping_cmd(params)
 
-        exitCode = self.prog_runner.run(mp_cmd, self.scratch)
+        with self.run_manifest.span('mapping', params.get(self.PARAM_IN_OUTFILE_PREFIX)) as span:
+            run_result = self.prog_runner.execute(
+                            mp_cmd, self.scratch,
+                            self._get_mapping_log_file(params, 'Log.progress.out'))
+            span.add_run(run_result)
+        return run_result
+
+    def exec_mapping(self, params):
+        return self.run_mapping(params).exit_code
+
+    def run_junction_insertion(self, params):
+        '''run STAR to insert junctions into a genome and return the Program_Runner Run_Result'''
+        log('Running STAR junction insertion with params:\n' + pformat(params))
+
+        ins_cmd = self._construct_junction_insertion_cmd(params)
+
+        with self.run_manifest.span('junction_insertion') as span:
+            run_result = self.prog_runner.execute(
+                            ins_cmd, self.scratch,
+                            params[self.PARAM_IN_OUTFILE_PREFIX] + 'Log.progress.out')
+            span.add_run(run_result)
+        return run_result
+
+    def insert_junctions(self, idx_dir, params, out_dir):
+        '''
+        insert_junctions: insert the junctions of the annotations (sjdbGTFfile) and/or of the
+        junctions file (sjdbFileChrStartEnd) in params into the genome index in idx_dir, the way
+        STAR inserts them on the fly when mapping, which leaves the suffix array of the genome
+        as it is instead of generating it again.
+        Returns the directory of the index with the junctions inserted, made in out_dir; raises
+        a RuntimeError if STAR does not succeed.
+        '''
+        self._mkdir_p(out_dir)
+        reads_file = os.path.join(out_dir, 'sjdb_insert.fastq')
+        with open(reads_file, 'w') as f:
+            f.write(self.JUNCTION_INSERTION_READ)
+
+        params_ins = {self.STAR_IDX_DIR: idx_dir,
+                      self.PARAM_IN_THREADN: params[self.PARAM_IN_THREADN],
+                      self.PARAM_IN_READS_FILES: [reads_file],
+                      self.PARAM_IN_OUTFILE_PREFIX: os.path.join(out_dir, '')}
+        for sjdb_param in ['sjdbGTFfile', 'sjdbFileChrStartEnd', 'sjdbOverhang']:
+            if params.get(sjdb_param, None) is not None:
+                params_ins[sjdb_param] = params[sjdb_param]
+
+        self.star_executor.execute(self.run_junction_insertion, params_ins,
+                                   os.path.join(out_dir, 'Log.out'))
+        inserted_idx_dir = os.path.join(out_dir, '_STARgenome')
+        if not os.path.isfile(os.path.join(inserted_idx_dir, 'genomeParameters.txt')):
+            raise RuntimeError('STAR did not save the genome with the junctions inserted into ' +
+                               inserted_idx_dir)
+        return inserted_idx_dir
+
+    def _get_mapping_log_file(self, params, log_name):
+        if params.get(self.PARAM_IN_OUTFILE_PREFIX, None) is None:
+            return None
+        return os.path.join(params.get('align_output', None) or self.scratch,
+                            params[self.PARAM_IN_OUTFILE_PREFIX] + log_name)
+
+    def run_indexing_with_retry(self, params):
+        '''
+        run STAR genomeGenerate, retrying the failures worth retrying; raises a RuntimeError if
+        STAR does not succeed
+        '''
+        return self.star_executor.execute(self.run_indexing, params,
+                                          os.path.join(self.scratch, 'Log.out'))
 
+    def run_mapping_with_retry(self, params, retry=True):
+        '''
+        run STAR alignReads, retrying the failures worth retrying unless retry is False (e.g.
+        when the reads come through pipes that can only be read once); raises a RuntimeError if
+        STAR does not succeed
+        '''
+        return self.star_executor.execute(self.run_mapping, params,
+                                          self._get_mapping_log_file(params, 'Log.out'),
+                                          None if retry else 0)
+
+    def _exec_genome_load(self, idx_dir, genome_load):
+        # STAR writes its logs for the genomeLoad runs next to the index, not into the outputs
+        load_cmd = [self.STAR_BIN,
+                    '--genomeDir', idx_dir,
+                    '--genomeLoad', genome_load,
+                    '--outFileNamePrefix',
+                    os.path.join(self.scratch, 'STAR_genomeLoad_' + genome_load + '_')]
+        return self.prog_runner.run(load_cmd, self.scratch)
+
+    def load_shared_genome(self, idx_dir, params):
+        """
+        load_shared_genome: load the genome in idx_dir into shared memory once, so that subsequent
+        mappings with params run with genomeLoad=LoadAndKeep attach to it instead of reading it
+        from disk. Returns True if the genome was loaded, False if it could not be or if the
+        mappings need junctions inserted on the fly, which a shared genome cannot have.
+        """
+        if self.needs_sjdb_insertion(idx_dir, params):
+            log('Mapping against genome index {} inserts junctions on the fly, '.format(idx_dir) +
+                'so it cannot be shared across mappings.')
+            return False
+
+        log('Loading genome {} into shared memory'.format(idx_dir))
+        exitCode = self._exec_genome_load(idx_dir, 'LoadAndExit')
+        if exitCode != 0:
+            log('Failed to load genome into shared memory, exit code was: ' + str(exitCode))
+            return False
+        return True
+
+    def remove_shared_genome(self, idx_dir):
+        """
+        remove_shared_genome: release the shared memory held by the genome in idx_dir
+        """
+        log('Removing genome {} from shared memory'.format(idx_dir))
+        exitCode = self._exec_genome_load(idx_dir, 'Remove')
+        if exitCode != 0:
+            log('Failed to remove genome from shared memory, exit code was: ' + str(exitCode))
         return exitCode
 
+    def get_genome_ram(self, idx_dir):
+        '''get the memory (in bytes) STAR needs to hold the genome in idx_dir'''
+        genome_ram = 0
+        for idx_file in ['Genome', 'SA', 'SAindex']:
+            idx_file = os.path.join(idx_dir, idx_file)
+            if os.path.isfile(idx_file):
+                genome_ram += os.path.getsize(idx_file)
+        return genome_ram
+
+    def index_has_annotations(self, idx_dir):
+        '''check if the annotation junctions have been inserted into the index in idx_dir'''
+        return os.path.isfile(os.path.join(idx_dir, 'sjdbList.out.tab'))
+
+    def filters_alignments_by_junctions(self, params):
+        '''
+        filters_alignments_by_junctions: whether the alignments STAR keeps with params depend on
+        the junctions found in the whole library (outFilterType BySJout, the default), so that
+        mapping parts of it separately would keep other alignments
+        '''
+        return 'BySJout' in str(params.get('outFilterType', None) or 'BySJout')
+
+    def get_sj_filters(self, params):
+        '''get_sj_filters: the SJ_COUNT_FILTERS STAR applies with params'''
+        return dict([(sj_filter, params.get(sj_filter, None) or default)
+                     for (sj_filter, default) in self.SJ_COUNT_FILTERS.items()])
+
+    def uses_sjdb(self, params):
+        '''
+        check if indexing or mapping with params inserts splice junctions, for which STAR needs
+        sjdbOverhang: the annotations (sjdbGTFfile), a junctions file (sjdbFileChrStartEnd) or the
+        junctions of a first pass (twopassMode)
+        '''
+        return (params.get('sjdbGTFfile', None) is not None or
+                params.get('sjdbFileChrStartEnd', None) is not None or
+                params.get('twopassMode', None) in ['Basic', 'Batch'])
+
+    def needs_sjdb_insertion(self, idx_dir, params):
+        '''
+        check if mapping with params against the index in idx_dir inserts junctions on the fly:
+        STAR's two-pass mode inserts the junctions of its first pass, and the annotations
+        (sjdbGTFfile) need to be when they are not in the index already
+        '''
+        if params.get('twopassMode', None) == 'Basic':
+            return True
+        return (params.get('sjdbGTFfile', None) is not None and
+                not self.index_has_annotations(idx_dir))
+
+    def _exec_samtools(self, args):
+        run_result = self.prog_runner.execute([self.SAMTOOLS_BIN] + args, self.scratch)
+        if run_result.exit_code != 0:
+            raise RuntimeError('samtools {} failed with exit code {}:\n'.format(
+                               args[0], run_result.exit_code) +
+                               '\n'.join(run_result.output_tail[-20:]))
+        return run_result
+
+    def merge_shard_outputs(self, shard_prefixes, output_prefix, idx_dir, n_threads=1,
+                            sj_filters=None):
+        '''
+        merge_shard_outputs: merge the outputs of the STAR runs that mapped the shards of one
+        reads library (written with the outFileNamePrefix in shard_prefixes) into the outputs of
+        the whole library, written with output_prefix as if it had been mapped in one run:
+        the coordinate sorted BAMs are merged, the unsorted transcriptome BAMs concatenated and
+        the gene counts and junctions added up. The junctions are filtered with sj_filters, see
+        merge_sj_files.
+        '''
+        def shard_files(suffix):
+            return [prefix + suffix for prefix in shard_prefixes
+                    if os.path.isfile(prefix + suffix)]
+
+        with self.run_manifest.span('merge_shards', os.path.basename(output_prefix)) as span:
+            bam_suffix = 'Aligned.sortedByCoord.out.bam'
+            if shard_files(bam_suffix):
+                span.add_run(self._exec_samtools(
+                    ['merge', '-f', '-@', str(n_threads), output_prefix + bam_suffix] +
+                    shard_files(bam_suffix)))
+            transcriptome_suffix = 'Aligned.toTranscriptome.out.bam'
+            if shard_files(transcriptome_suffix):
+                span.add_run(self._exec_samtools(
+                    ['cat', '-o', output_prefix + transcriptome_suffix] +
+                    shard_files(transcriptome_suffix)))
+            if shard_files('ReadsPerGene.out.tab'):
+                merge_geneCount_files(shard_files('ReadsPerGene.out.tab'),
+                                      output_prefix + 'ReadsPerGene.out.tab')
+            if shard_files('SJ.out.tab'):
+                chrom_names = None
+                if os.path.isfile(os.path.join(idx_dir, 'chrName.txt')):
+                    with open(os.path.join(idx_dir, 'chrName.txt')) as f:
+                        chrom_names = f.read().split()
+                merge_sj_files(shard_files('SJ.out.tab'), output_prefix + 'SJ.out.tab',
+                               chrom_names, sj_filters)
+            span.add_file(output_prefix + bam_suffix)
+
     def _exec_star_pipeline(self, params, rds_files, rds_name, idx_dir, out_dir):
         params = self.convert_params(self.process_params(params))
         # build the parameters
@@ -292,19 +640,13 @@ class STARUtils:
         # execute indexing and then mapping
         try:
             if params[self.PARAM_IN_STARMODE] == 'genomeGenerate':
-                ret = self.exec_indexing(params_idx)
-            else:
-                ret = 0
-            while(ret != 0):
-                time.sleep(1)
+                self.run_indexing_with_retry(params_idx)
         except Exception as eidx:
             raise RuntimeError('STAR genome indexing raised error:\n' + repr(eidx))
         else:  # no exception raised by genome indexing and returns 0, then run mapping
             params_mp[self.PARAM_IN_STARMODE] = 'alignReads'
             try:
-                ret = self.exec_mapping(params_mp)
-                while(ret != 0):
-                    time.sleep(1)
+                self.run_mapping_with_retry(params_mp)
             except Exception as emp:
                 raise RuntimeError('STAR mapping raised error:\n' + repr(emp))
             else:  # no exception raised by STAR mapping and returns 0, move to saving and reporting
@@ -339,7 +681,9 @@ class STARUtils:
         pprint(align_upload_params)
 
         ra_util = ReadsAlignmentUtils(self.callback_url, service_ver='beta')
-        rau_upload_ret = ra_util.upload_alignment(align_upload_params)
+        with self.run_manifest.span('upload', alignment_name) as span:
+            rau_upload_ret = ra_util.upload_alignment(align_upload_params)
+            span.add_file(output_bam_file)
         alignment_ref = rau_upload_ret["obj_ref"]
         print("STAR alignment uploaded as object {}".format(alignment_ref))
         return rau_upload_ret
@@ -348,10 +692,13 @@ class STARUtils:
         input_ref = run_output_info['upload_results']['obj_ref']
         index_dir = run_output_info['index_dir']
         output_dir = run_output_info['output_dir']
+        # the manifest of the run so far goes with the packaged outputs
+        self.run_manifest.write(output_dir)
         output_files = self._generate_output_file_list(index_dir, output_dir)
 
         # first run qualimap
-        qualimap_report = self.qualimap.run_bamqc({'input_ref': input_ref})
+        with self.run_manifest.span('qualimap'):
+            qualimap_report = self.qualimap.run_bamqc({'input_ref': input_ref})
         qc_result_zip_info = qualimap_report['qc_result_zip_info']
 
         # create report
@@ -359,19 +706,21 @@ class STARUtils:
         alignment_info = self.get_obj_infos(input_ref)[0]
         report_text = 'Created ReadsAlignment: ' + str(alignment_info[1]) + '\n'
         report_text += '                        ' + input_ref + '\n'
+        report_text += '\n' + self.run_manifest.format_summary() + '\n'
         kbr = KBaseReport(self.callback_url)
-        report_info = kbr.create_extended_report({
-                        'message': report_text,
-                        'file_links': output_files,
-                        'objects_created': [{'ref': input_ref,
-                                             'description': 'ReadsAlignment'}],
-                        'report_object_name': 'kb_STAR_report_' + str(uuid.uuid4()),
-                        'direct_html_link_index': 0,
-                        'html_links': [{'shock_id': qc_result_zip_info['shock_id'],
-                                        'name': qc_result_zip_info['index_html_file_name'],
-                                        'label': qc_result_zip_info['name']}],
-                        'html_window_height': 366,
-                        'workspace_name': params['output_workspace']})
+        with self.run_manifest.span('report'):
+            report_info = kbr.create_extended_report({
+                            'message': report_text,
+                            'file_links': output_files,
+                            'objects_created': [{'ref': input_ref,
+                                                 'description': 'ReadsAlignment'}],
+                            'report_object_name': 'kb_STAR_report_' + str(uuid.uuid4()),
+                            'direct_html_link_index': 0,
+                            'html_links': [{'shock_id': qc_result_zip_info['shock_id'],
+                                            'name': qc_result_zip_info['index_html_file_name'],
+                                            'label': qc_result_zip_info['name']}],
+                            'html_window_height': 366,
+                            'workspace_name': params['output_workspace']})
 
         return report_info  # {'report_name': report_info['name'], 'report_ref': report_info['ref']}
 
@@ -390,7 +739,10 @@ class STARUtils:
         '''
         try:
             print("Fetching FASTA file from reads reference {}".format(reads['ref']))
-            ret_reads_info = fetch_reads_from_reference(reads['ref'], self.callback_url)
+            with self.run_manifest.span('download_reads', reads['ref']) as span:
+                ret_reads_info = fetch_reads_from_reference(reads['ref'], self.callback_url)
+                span.add_file(ret_reads_info.get('file_fwd'))
+                span.add_file(ret_reads_info.get('file_rev'))
         except ValueError:
             print("Incorrect object type for fetching a FASTA file!")
             raise
@@ -413,8 +765,10 @@ class STARUtils:
         if gnm_ref is not None:
             try:
                 print("Fetching FASTA file from object {}".format(gnm_ref))
-                genome_fasta_file = fetch_fasta_from_object(
-                    gnm_ref, self.workspace_url, self.callback_url)
+                with self.run_manifest.span('fetch_fasta', gnm_ref) as span:
+                    genome_fasta_file = fetch_fasta_from_object(
+                        gnm_ref, self.workspace_url, self.callback_url, self.info_cache)
+                    span.add_file(genome_fasta_file.get('path'))
                 print("Done fetching FASTA file! Path = {}".format(
                     genome_fasta_file.get("path", None)))
             except ValueError:
@@ -440,11 +794,108 @@ class STARUtils:
 
         if params.get('sjdbGTFfile', None) is not None:
             params_idx['sjdbGTFfile'] = params['sjdbGTFfile']
+        if params.get('sjdbFileChrStartEnd', None) is not None:
+            params_idx['sjdbFileChrStartEnd'] = params['sjdbFileChrStartEnd']
         if params.get('sjdbOverhang', None) is not None:
             params_idx['sjdbOverhang'] = params['sjdbOverhang']
+        for genome_param in self.GENOME_GENERATE_PARAMS:
+            if params.get(genome_param, None) is not None:
+                params_idx[genome_param] = params[genome_param]
+        if params.get('limitGenomeGenerateRAM', None) is not None:
+            params_idx['limitGenomeGenerateRAM'] = params['limitGenomeGenerateRAM']
 
         return params_idx
 
+    def estimate_genome_generate_ram(self, genome_length, sa_index_nbases, sa_sparse_d):
+        '''
+        estimate_genome_generate_ram: the memory (in bytes) genomeGenerate needs for a genome of
+        genome_length bases: the genome, its suffix array (an entry of log2(2 * genome length)
+        + 2 bits for every sa_sparse_d-th suffix of both strands) and the SA pre-index
+        '''
+        sa_bits = int(math.log(2 * genome_length, 2)) + 2
+        sa_ram = 2 * genome_length * sa_bits // 8 // sa_sparse_d
+        sa_index_ram = 8 * (4 ** (sa_index_nbases + 1) - 1) // 3
+        return int((genome_length + sa_ram + sa_index_ram) * self.INDEX_RAM_OVERHEAD)
+
+    def _select_sparse_sa(self, params, genome_length):
+        '''
+        _select_sparse_sa: pick the smallest genomeSAsparseD, unless one is given, that makes
+        genomeGenerate fit in the memory of this container (its cgroup limit), and set
+        limitGenomeGenerateRAM to that memory, only when the full suffix array would not fit in
+        it. A sparse suffix array makes the index (and the memory mapping needs) smaller, at the
+        cost of slower mapping. The memory limit, unlike the memory free at the time, is the same
+        for every run on a node, so are the indexes (and their keys in the index cache).
+        '''
+        ram_budget = params.get('limitGenomeGenerateRAM', None)
+        if ram_budget is None:
+            ram_budget = int(resource_util.get_memory_limit() * self.INDEX_RAM_FRACTION)
+
+        sparse_d = params.get('genomeSAsparseD', None) or 1
+        index_ram = self.estimate_genome_generate_ram(genome_length,
+                                                      params['genomeSAindexNbases'], sparse_d)
+        if index_ram > ram_budget and params.get('genomeSAsparseD', None) is None:
+            for sparse_d in self.SPARSE_SA_STEPS:
+                index_ram = self.estimate_genome_generate_ram(
+                                genome_length, params['genomeSAindexNbases'], sparse_d)
+                if index_ram <= ram_budget:
+                    break
+            log('Not enough memory for a full suffix array, indexing with genomeSAsparseD ' +
+                '{}: mapping will need less memory but run slower'.format(sparse_d))
+            params['genomeSAsparseD'] = sparse_d
+
+        log('genomeGenerate needs about {} bytes, {} bytes available'.format(index_ram,
+                                                                            ram_budget))
+        # STAR refuses to use more than its default limitGenomeGenerateRAM otherwise
+        if index_ram > min(ram_budget, self.DEFAULT_GENOME_GENERATE_RAM):
+            params['limitGenomeGenerateRAM'] = ram_budget
+            self.run_manifest.set('limitGenomeGenerateRAM', ram_budget)
+        if index_ram > ram_budget:
+            log('WARNING: genomeGenerate is unlikely to fit in the available memory')
+        self.run_manifest.set('genome_generate_ram_estimate', index_ram)
+
+    def tune_genome_generate_params(self, params):
+        '''
+        tune_genome_generate_params: set the genomeGenerate parameters not given in params from
+        the length and number of contigs of the genome FASTA, as the STAR manual recommends for
+        small and fragmented genomes (for which the defaults waste memory, or crash STAR):
+            genomeSAindexNbases = min(14, log2(genome length) / 2 - 1)
+            genomeChrBinNbits = min(18, log2(max(genome length / number of contigs, read length)))
+        For large genomes these are the STAR defaults. genomeSAsparseD is raised from 1 only when
+        the index would not fit in memory otherwise.
+        '''
+        (genome_length, n_contigs) = get_fasta_stats(params[self.PARAM_IN_FASTA_FILES])
+        log('Genome of {} bases in {} contigs'.format(genome_length, n_contigs))
+        if genome_length == 0 or n_contigs == 0:
+            raise ValueError('The genome FASTA file(s) {} hold no sequence'.format(
+                             ', '.join(params[self.PARAM_IN_FASTA_FILES])))
+
+        return self.derive_genome_generate_params(params, genome_length, n_contigs)
+
+    def derive_genome_generate_params(self, params, genome_length, n_contigs):
+        '''
+        derive_genome_generate_params: set the genomeGenerate parameters not given in params for a
+        genome of genome_length bases in n_contigs contigs, as tune_genome_generate_params does
+        '''
+        if params.get('genomeSAindexNbases', None) is None:
+            params['genomeSAindexNbases'] = max(
+                1, min(14, int(math.log(genome_length, 2) / 2 - 1)))
+        if params.get('genomeChrBinNbits', None) is None:
+            read_length = self.DEFAULT_READ_LENGTH
+            if params.get('sjdbOverhang', None):
+                read_length = params['sjdbOverhang'] + 1
+            params['genomeChrBinNbits'] = max(
+                1, min(18, int(math.log(max(genome_length // n_contigs, read_length), 2))))
+        self._select_sparse_sa(params, genome_length)
+
+        for genome_param in self.GENOME_GENERATE_PARAMS:
+            if params.get(genome_param, None) is not None:
+                log('Using {} {}'.format(genome_param, params[genome_param]))
+                self.run_manifest.set(genome_param, params[genome_param])
+        self.run_manifest.set('genome_length', genome_length)
+        self.run_manifest.set('genome_contigs', n_contigs)
+
+        return params
+
     def get_mapping_params(self, params, rds_files, rds_name, idx_dir, out_dir):
         ''' build the mapping parameters'''
         params_mp = copy.deepcopy(params)
@@ -469,6 +920,22 @@ class STARUtils:
 
         return params_mp
 
+    def set_auto_threads(self, params, n_concurrent=1):
+        '''
+        set_auto_threads: set runThreadN, and outBAMsortingThreadN, to the CPUs this process can
+        use (within the CPU quota of its cgroup) split between n_concurrent mappings. STAR would
+        otherwise sort BAM with at most 6 threads, whatever runThreadN is.
+        '''
+        n_cpus = resource_util.get_cpu_count()
+        n_threads = max(1, n_cpus // max(1, n_concurrent))
+        log('Using {} threads of {} CPUs for each of {} concurrent run(s)'.format(
+            n_threads, n_cpus, n_concurrent))
+        params[self.PARAM_IN_THREADN] = n_threads
+        params['outBAMsortingThreadN'] = n_threads
+        self.run_manifest.set('cpu_count', n_cpus)
+
+        return params
+
     def process_params(self, params):
         """
         process_params: checks params passed to run_star method and set default values
@@ -493,10 +960,17 @@ class STARUtils:
                                  "reference, not {}".format(params.get(self.PARAM_IN_READS, None)))
 
         if params.get(self.PARAM_IN_THREADN, None) is not None:
-            if not isinstance(params[self.PARAM_IN_THREADN], int):
-                raise ValueError(self.PARAM_IN_HASH_THREADN + ' must be of type int')
-        else:
-            params[self.PARAM_IN_THREADN] = 2
+            if (not isinstance(params[self.PARAM_IN_THREADN], int) or
+                    params[self.PARAM_IN_THREADN] < 0):
+                raise ValueError(self.PARAM_IN_THREADN + ' must be a non-negative int')
+        # 0 (or no runThreadN) sizes the thread counts from the CPUs of this node
+        self.auto_threads = not params.get(self.PARAM_IN_THREADN, None)
+        if self.auto_threads:
+            self.set_auto_threads(params)
+        self.run_manifest.set('auto_threads', self.auto_threads)
+        self.run_manifest.set('indexing_threads', params[self.PARAM_IN_THREADN])
+        self.run_manifest.set('mapping_threads', params[self.PARAM_IN_THREADN])
+        self.run_manifest.set('bam_sorting_threads', params.get('outBAMsortingThreadN'))
 
         if ("alignment_suffix" not in params or not valid_string(params["alignment_suffix"])):
             raise ValueError("Parameter alignment_suffix must be a valid Workspace object string, "
@@ -511,12 +985,29 @@ class STARUtils:
         if params.get('create_report', None) is None:
             params['create_report'] = 0
 
+        for genome_param in self.GENOME_GENERATE_PARAMS:
+            if params.get(genome_param, None) is not None:
+                if not isinstance(params[genome_param], int) or params[genome_param] < 1:
+                    raise ValueError(genome_param + ' must be a positive int')
+
+        if params.get('twopassMode', None) not in [None] + self.TWOPASS_MODES:
+            raise ValueError('twopassMode must be one of ' + ', '.join(self.TWOPASS_MODES))
+
+        if params.get('read_shards', None) is not None:
+            if not isinstance(params['read_shards'], int) or params['read_shards'] < 1:
+                raise ValueError('read_shards must be a positive int')
+
+        strandedness_modes = ['unstranded', 'forward', 'reverse', 'auto']
+        if params.get('strandedness', None) not in [None] + strandedness_modes:
+            raise ValueError('strandedness must be one of ' + ', '.join(strandedness_modes))
+
         return self._setDefaultParameters(params)
 
-    def convert_params(self, validated_params):
+    def convert_params(self, validated_params, tune=True):
         """
         Convert input parameters with KBase ref format into STAR parameters,
-        and add the advanced options.
+        and add the advanced options. With tune=False the genomeGenerate parameters are left
+        to the caller, see tune_genome_generate_params.
         """
         params = copy.deepcopy(validated_params)
         params['runMode'] = 'genomeGenerate'
@@ -530,6 +1021,8 @@ class STARUtils:
         if params.get(self.PARAM_IN_FASTA_FILES, None) is None:
             params[self.PARAM_IN_FASTA_FILES] = self.get_genome_fasta(
                                                     params.get(self.PARAM_IN_GENOME))
+        if tune:
+            params = self.tune_genome_generate_params(params)
 
         # Add advanced options from validated_params to params
         quant_modes = ["TranscriptomeSAM", "GeneCounts", "Both"]
@@ -571,21 +1064,18 @@ class STARUtils:
         return info[1]
 
     def get_obj_infos(self, ref):
-        return self.ws_client.get_object_info3({'objects': [{'ref': ref}]})['infos']
+        return self.info_cache.get_infos([ref])
 
     def get_object_names(self, ref_list):
         """
         From a list of workspace references, returns a mapping from ref -> name of the object.
         """
-        obj_ids = list()
-        for ref in ref_list:
-            obj_ids.append({"ref": ref})
-        info = self.ws_client.get_object_info3({"objects": obj_ids})
+        infos = self.info_cache.get_infos(ref_list)
         name_map = dict()
         # we already have the refs as passed previously, so use those for mapping, as they're in
         # the same order as what's returned.
-        for i in range(len(info["infos"])):
-            name_map[ref_list[i]] = info["infos"][i][1]
+        for i in range(len(infos)):
+            name_map[ref_list[i]] = infos[i][1]
         return name_map
 
     def _fill_html_trs(self, col_caption, obj_data):
@@ -594,14 +1084,22 @@ class STARUtils:
         '''
         tr_html_str = '<tr><th>{}</th><th>Condition</th></tr>'.format(col_caption)
 
-        for item in obj_data['items']:
-            item_obj = self.ws_client.get_objects2({'objects': [{'ref': item['ref']}]})['data'][0]
-            item_obj_info = item_obj['info']
-            item_obj_data = item_obj['data']
+        item_refs = [item['ref'] for item in obj_data['items']]
+        if not item_refs:
+            return tr_html_str
+
+        # look up the names and conditions of all the items at once, fetching only the
+        # condition out of the data of each item
+        item_infos = self.info_cache.get_infos(item_refs)
+        item_objs = self.ws_client.get_objects2(
+                        {'objects': [{'ref': ref, 'included': ['/condition']}
+                                     for ref in item_refs]})['data']
+
+        for (ref, item_obj_info, item_obj) in zip(item_refs, item_infos, item_objs):
             obj_name = item_obj_info[1]
 
-            tr_html_str += '<tr><td>{} ({})</td>'.format(obj_name, item['ref'])
-            tr_html_str += '<td>{}</td></tr>'.format(item_obj_data['condition'])
+            tr_html_str += '<tr><td>{} ({})</td>'.format(obj_name, ref)
+            tr_html_str += '<td>{}</td></tr>'.format(item_obj['data'].get('condition', ''))
 
         return tr_html_str
 
@@ -614,7 +1112,8 @@ class STARUtils:
                                     readsSet_ref,
                                     self.workspace_url,
                                     self.callback_url,
-                                    params)
+                                    params,
+                                    self.info_cache)
             # print(
             #   "\nDone fetching reads ref(s) from readsSet {}--\nDetails:\n".format(readsSet_ref))
         except ValueError:
@@ -636,16 +1135,31 @@ class STARUtils:
         self._mkdir_p(output_directory)
         star_index = os.path.join(output_directory, 'star_index.zip')
         star_output = os.path.join(output_directory, 'star_output.zip')
-        self._zip_folder(idx_dir, star_index)
-        self._zip_folder(out_dir, star_output)
+
+        # zip the index and the outputs at the same time, zlib runs outside of the GIL
+        pool = ThreadPool(2)
+        try:
+            with self.run_manifest.span('packaging') as span:
+                zip_results = [pool.apply_async(self._zip_folder, (out_dir, star_output))]
+                if self.package_index:
+                    zip_results.append(pool.apply_async(self._get_index_zip,
+                                                        (idx_dir, star_index)))
+                pool.close()
+                for zip_result in zip_results:
+                    zip_result.get()
+                span.add_file(star_output)
+                span.add_file(star_index)
+        finally:
+            pool.terminate()
 
         # star_index = self._zip_folder_withDFU(idx_dir, 'star_index')
         # star_output = self._zip_folder_withDFU(out_dir, 'star_output')
 
-        output_files.append({'path': star_index,
-                             'name': os.path.basename(star_index),
-                             'label': os.path.basename(star_index),
-                             'description': 'Index file(s) generated by STAR'})
+        if self.package_index:
+            output_files.append({'path': star_index,
+                                 'name': os.path.basename(star_index),
+                                 'label': os.path.basename(star_index),
+                                 'description': 'Index file(s) generated by STAR'})
 
         output_files.append({'path': star_output,
                              'name': os.path.basename(star_output),
@@ -654,6 +1168,34 @@ class STARUtils:
 
         return output_files
 
+    def _get_index_zip(self, idx_dir, output_path):
+        """
+        _get_index_zip: zip the index in idx_dir to output_path. An index from the
+        Genome_Index_Cache is zipped only once, into <idx_dir>.zip next to it, and that archive is
+        linked (or copied) to output_path by later runs.
+        """
+        index_zip = idx_dir.rstrip('/') + '.zip'
+        if (not os.path.isfile(index_zip) and
+                os.path.isfile(os.path.join(idx_dir, Genome_Index_Cache.INFO_FILE))):
+            staging_zip = '{}.{}.tmp'.format(index_zip, uuid.uuid4())
+            try:
+                self._zip_folder(idx_dir, staging_zip)
+                os.rename(staging_zip, index_zip)
+            finally:
+                if os.path.isfile(staging_zip):
+                    os.remove(staging_zip)
+
+        if not os.path.isfile(index_zip):
+            self._zip_folder(idx_dir, output_path)
+            return
+
+        try:
+            os.link(index_zip, output_path)
+        except OSError:
+            # the cache is on another file system
+            shutil.copyfile(index_zip, output_path)
+        log("{} reused for {}.".format(index_zip, output_path))
+
     def _zip_folder_withDFU(self, folder_path, output_name):
         """
         _zip_folder_withDFU: Zip the contents of an entire folder (with that folder
@@ -676,13 +1218,24 @@ class STARUtils:
         '''
         return output_path
 
+    def _stores_file(self, file_name):
+        """
+        _stores_file: whether file_name is added to a zip file as it is, rather than compressed
+        """
+        return (os.path.splitext(file_name)[1].lower() in self.COMPRESSED_EXTENSIONS or
+                file_name in self.DENSE_INDEX_FILES)
+
     def _zip_folder(self, folder_path, output_path):
         """
         _zip_folder: Zip the contents of an entire folder (with that folder included in the
          archive). Empty subfolders could be included in the archive as well if the 'Included
          all subfolders, including empty ones' portion.
          portion is used.
+         Files that are compressed already (see COMPRESSED_EXTENSIONS) and the dense files of a
+         genome index (see DENSE_INDEX_FILES) are stored as they are.
         """
+        n_entries = 0
+        n_stored = 0
         with zipfile.ZipFile(output_path, 'w',
                              zipfile.ZIP_DEFLATED,
                              allowZip64=True) as ziph:
@@ -691,24 +1244,30 @@ class STARUtils:
                 for folder_name in folders:
                     absolute_fpath = os.path.join(root, folder_name)
                     relative_fpath = os.path.join(os.path.basename(root), folder_name)
-                    log("Adding {} to archive.".format(absolute_fpath))
                     ziph.write(absolute_fpath, relative_fpath)
+                    n_entries += 1
                 for f in files:
                     absolute_path = os.path.join(root, f)
                     relative_path = os.path.join(os.path.basename(root), f)
-                    log("Adding {} to archive.".format(absolute_path))
-                    ziph.write(absolute_path, relative_path)
+                    if self._stores_file(f):
+                        ziph.write(absolute_path, relative_path, zipfile.ZIP_STORED)
+                        n_stored += 1
+                    else:
+                        ziph.write(absolute_path, relative_path)
+                    n_entries += 1
 
-        log("{} created successfully.".format(output_path))
+        log("{} created successfully with {} entries ({} stored without compression), "
+            "{} bytes.".format(output_path, n_entries, n_stored, os.path.getsize(output_path)))
 
         # with zipfile.ZipFile(output_path, "r") as f:
         #    print 'Checking the zipped file......\n'
         #    for info in f.infolist():
         #        print info.filename, info.date_time, info.file_size, info.compress_size
 
-    def _generate_html_report(self, out_dir, obj_ref):
+    def _generate_html_report(self, out_dir, obj_ref, star_obj=None):
         """
         _generate_html_report: generate html summary report
+        star_obj: the object at obj_ref as returned by get_objects2, if it was fetched already
         """
 
         log('start generating html report')
@@ -718,8 +1277,9 @@ class STARUtils:
         self._mkdir_p(output_directory)
         result_file_path = os.path.join(output_directory, 'report.html')
 
-        star_obj = self.ws_client.get_objects2({'objects':
-                                                [{'ref': obj_ref}]})['data'][0]
+        if star_obj is None:
+            star_obj = self.ws_client.get_objects2({'objects':
+                                                    [{'ref': obj_ref}]})['data'][0]
         star_obj_info = star_obj['info']
         star_obj_data = star_obj['data']
         star_obj_type = star_obj_info[2]
@@ -781,11 +1341,14 @@ class STARUtils:
         """
         log('creating STAR report')
 
+        star_obj = self.ws_client.get_objects2({'objects': [{'ref': obj_ref}]})['data'][0]
+
+        # the manifest of the run so far goes with the packaged outputs
+        self.run_manifest.write(output_dir)
         output_files = self._generate_output_file_list(index_dir, output_dir)
-        output_html_files = self._generate_html_report(output_dir, obj_ref)
+        output_html_files = self._generate_html_report(output_dir, obj_ref, star_obj)
         output_html_files += html_links
 
-        star_obj = self.ws_client.get_objects2({'objects': [{'ref': obj_ref}]})['data'][0]
         star_obj_info = star_obj['info']
         star_obj_data = star_obj['data']
 
@@ -814,6 +1377,8 @@ class STARUtils:
                 objects_created.append({'ref': item['ref'],
                                         'description': 'Expression generated by STAR'})
 
+        report_text += '\n' + self.run_manifest.format_summary() + '\n'
+
         report_params = {'message': report_text,
                          'workspace_name': workspace_name,
                          'file_links': output_files,
@@ -824,7 +1389,8 @@ class STARUtils:
                          'report_object_name': 'kb_STAR_report_' + str(uuid.uuid4())}
 
         kbase_report_client = KBaseReport(self.callback_url)
-        report_output = kbase_report_client.create_extended_report(report_params)
+        with self.run_manifest.span('report'):
+            report_output = kbase_report_client.create_extended_report(report_params)
 
         return report_output
 
@@ -870,9 +1436,11 @@ class STARUtils:
         log("Converting genome {0} to GFF file in folder {1}".format(gnm_ref, gtf_file_dir))
         gfu = GenomeFileUtil(self.callback_url)
         try:
-            gfu_ret = gfu.genome_to_gff({self.PARAM_IN_GENOME: gnm_ref,
-                                         'is_gtf': 1,
-                                         'target_dir': gtf_file_dir})
+            with self.run_manifest.span('convert_gtf', gnm_ref) as span:
+                gfu_ret = gfu.genome_to_gff({self.PARAM_IN_GENOME: gnm_ref,
+                                             'is_gtf': 1,
+                                             'target_dir': gtf_file_dir})
+                span.add_file(gfu_ret.get('file_path'))
         except ValueError as egfu:
             log('GFU getting GTF file raised error:\n')
             pprint(egfu)
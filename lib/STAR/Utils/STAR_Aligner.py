@@ -4,16 +4,31 @@ import os
 import re
 import time
 import copy
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 import traceback
 
 from KBParallel.KBParallelClient import KBParallel
 from STAR.Utils.STARUtils import STARUtils
+from STAR.Utils.Genome_Index_Cache import Genome_Index_Cache
+from STAR.Utils.Reads_Prefetcher import Reads_Prefetcher
+from STAR.Utils.Reads_Streamer import Reads_Streamer
+from STAR.Utils.Gene_Count_Matrix import Gene_Count_Matrix
+from STAR.Utils.Run_Journal import Run_Journal
+from STAR.Utils.Scratch_Manager import Scratch_Manager
+from STAR.Utils.Run_Planner import Run_Planner
+from STAR.Utils import resource_util
+from STAR.Utils import http_session
 from kb_QualiMap.kb_QualiMapClient import kb_QualiMap
 from SetAPI.SetAPIServiceClient import SetAPI
 
 from file_util import (
-    extract_geneCount_matrix
+    extract_geneCount_matrix,
+    merge_junction_files,
+    split_fastq_files,
+    READ_LENGTH_SAMPLE_SIZE
 )
 
 
@@ -23,6 +38,22 @@ def log(message, prefix_newline=False):
 
 
 class STAR_Aligner(object):
+    # each concurrent mapping gets at least this many threads
+    MIN_THREADS_PER_JOB = 2
+    # memory (in bytes) a mapping needs besides the genome and sorting BAM
+    MAPPING_OVERHEAD_RAM = 2000000000
+    # limitBAMsortRAM of each concurrent mapping
+    PARALLEL_BAM_SORT_RAM = 4000000000
+    # where the first pass of the batch two-pass mode writes its outputs, in the output dir
+    FIRST_PASS_DIR = 'first_pass'
+    # the outputs of STAR for a sample (by suffix of its output file name prefix) that are not
+    # needed once its alignment is uploaded
+    MAPPING_INTERMEDIATES = ['Aligned.sortedByCoord.out.bam', 'Aligned.out.bam',
+                             'Aligned.out.sam', 'Aligned.toTranscriptome.out.bam',
+                             'Unmapped.out.mate1', 'Unmapped.out.mate2',
+                             '_STARtmp', '_STARgenome', '_STARpass1']
+    # reads libraries whose read lengths are sampled at once
+    READ_SAMPLING_THREADS = 4
 
     def __init__(self, config, provenance):
         self.config = config
@@ -30,16 +61,40 @@ class STAR_Aligner(object):
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.scratch = config['scratch']
         self.srv_wiz_url = config['srv-wiz-url']
+        # the service clients reuse kept-alive connections
+        http_session.install()
         self.parallel_runner = KBParallel(self.callback_url)
         self.provenance = provenance
         self.star_utils = STARUtils(self.scratch,
                                     self.workspace_url,
                                     self.callback_url,
-                                    self.srv_wiz_url, provenance)
+                                    self.srv_wiz_url, provenance, config)
         self.set_api_client = SetAPI(self.srv_wiz_url, service_ver='dev')
         self.qualimap = kb_QualiMap(self.callback_url, service_ver='dev')
         self.star_idx_dir = None
         self.star_out_dir = None
+        # the gene count matrix of a sample set, filled in as its samples finish mapping
+        self.gene_count_matrix = None
+        # the stages the samples of a sample set got through, to resume an interrupted run from
+        self.run_journal = None
+
+        # the persistent genome index cache is only used when configured in deploy.cfg
+        self.index_cache = None
+        if config.get('star-index-cache-dir'):
+            self.index_cache = Genome_Index_Cache(config['star-index-cache-dir'])
+        # the shared lock held on the cached index mapped against, so that it is not evicted
+        self.index_cache_use = None
+        # evict what is not needed any more from scratch when its disk fills up
+        self.scratch_manager = Scratch_Manager(
+                                self.scratch, float(config.get('scratch-high-water-mark', 0)),
+                                self.index_cache)
+        # how many reads libraries of a set to download ahead of the one being aligned
+        self.prefetch_depth = int(config.get('reads-prefetch-depth', 2))
+        # stream the reads into STAR through named pipes instead of downloading them first
+        self.stream_reads = config.get('stream-reads', 'false').lower() == 'true'
+        # reads sampled from each library to set sjdbOverhang from their length
+        self.read_length_sample_size = int(config.get('read-length-sample-size',
+                                                      READ_LENGTH_SAMPLE_SIZE))
 
         # from the provenance, extract out the version to run by exact hash if possible
         self.my_version = STARUtils.STAR_VERSION
@@ -49,10 +104,12 @@ class STAR_Aligner(object):
                                     'kb_STAR', provenance[0]['subactions'])
         print('Running STAR version = ' + self.my_version)
 
-    def _star_run_single(self, single_input_params):
+    def _star_run_single(self, single_input_params, prefetched_reads_info=None, in_set=False):
         """
         _star_run_single: Performs a single run of STAR against a single reads reference.
          The rest of the info is taken from the params dict - see the spec for details.
+         If the reads have already been downloaded, their info is given as prefetched_reads_info.
+         in_set: the reads are a member of a sample set, whose report packages the outputs
         """
         log('--->\nrunning STAR_Aligner._star_run_single\n' +
             'params:\n{}'.format(json.dumps(single_input_params, indent=1)))
@@ -64,6 +121,8 @@ class STAR_Aligner(object):
         rds_files = list()
         reads_info = None
         ret_fwd = None
+        reads_streamer = None
+        aligned = None
 
         # 1. Prepare for mapping
         rds = None
@@ -71,24 +130,56 @@ class STAR_Aligner(object):
         for r in setreads_refs:
             if r['ref'] == single_input_params[STARUtils.PARAM_IN_READS]:
                 rds = r
-                reads_info = self.star_utils.get_reads_info(rds, rds['ref'])
+                # an uploaded alignment is not needed on scratch any more
+                aligned = (self._get_journaled(rds, 'uploaded') or
+                           self._get_journaled(rds, 'aligned'))
+                if aligned is not None:
+                    # mapped by an earlier run of the same request, the reads are not needed
+                    log('Reads {} were aligned by an earlier run'.format(rds['ref']))
+                    reads_info = aligned['reads_info']
+                elif prefetched_reads_info is not None:
+                    reads_info = prefetched_reads_info
+                else:
+                    (reads_streamer, reads_info) = self._open_reads_stream(rds)
+                    if reads_streamer is None:
+                        reads_info = self._fetch_reads(rds)
                 rds_name = rds['alignment_output_name'].replace(
                                 single_input_params['alignment_suffix'], '')
 
-                ret_fwd = reads_info["file_fwd"]
+                ret_fwd = reads_info.get("file_fwd", None)
                 if ret_fwd is not None:
                     rds_files.append(ret_fwd)
                     if reads_info.get('file_rev', None) is not None:
                         rds_files.append(reads_info['file_rev'])
 
                 single_input_params[STARUtils.PARAM_IN_OUTFILE_PREFIX] = rds_name + '_'
+                if reads_info.get('readFilesCommand', None) is not None:
+                    # streamed reads come with the command STAR has to read them through
+                    single_input_params = copy.deepcopy(single_input_params)
+                    single_input_params['readFilesCommand'] = reads_info['readFilesCommand']
                 break
 
         # 2. After all is set, perform the alignment and upload the output.
         if reads_info:
             try:
-                star_mp_ret = self._run_star_mapping(
-                            single_input_params, rds_files, rds_name)
+                if aligned is None:
+                    self.scratch_manager.make_room()
+                if aligned is not None:
+                    star_mp_ret = {'star_idx': self.star_idx_dir,
+                                   'star_output': aligned['star_output']}
+                elif self._shards_reads(single_input_params, reads_streamer is not None):
+                    star_mp_ret = self._run_star_mapping_sharded(
+                                single_input_params, rds_files, rds_name,
+                                self._get_records_per_file(reads_info))
+                else:
+                    # streamed reads cannot be read again by a retried STAR run
+                    star_mp_ret = self._run_star_mapping(
+                                single_input_params, rds_files, rds_name,
+                                retry=reads_streamer is None)
+                if reads_streamer is not None:
+                    # make sure STAR got the complete reads before uploading its results
+                    reads_streamer.close()
+                    reads_streamer = None
             except RuntimeError as rerr:
                 log("Caught error from STAR mapping!\n")
                 raise
@@ -98,14 +189,36 @@ class STAR_Aligner(object):
                     bam_sort = 'sortedByCoord'
                 output_bam_file = '{}_Aligned.{}.out.bam'.format(rds_name, bam_sort)
                 output_bam_file = os.path.join(star_mp_ret['star_output'], output_bam_file)
-
-                # Upload the alignment
-                upload_results = self.star_utils.upload_STARalignment(
-                                            single_input_params,
-                                            rds,
-                                            reads_info,
-                                            output_bam_file)
+                for suffix in self.MAPPING_INTERMEDIATES:
+                    self.scratch_manager.track(
+                        os.path.join(star_mp_ret['star_output'], rds_name + '_' + suffix),
+                        'mapping', rds['ref'])
+                if aligned is None:
+                    aligned = {'star_output': star_mp_ret['star_output'],
+                               'reads_info': dict([(k, v) for (k, v) in reads_info.items()
+                                                   if k not in ['file_fwd', 'file_rev']])}
+                    self._journal(rds, 'aligned', aligned, [output_bam_file])
+
+                # Upload the alignment, unless an earlier run of the same request did
+                upload_results = aligned.get('upload_results', None)
+                if upload_results is None:
+                    upload_results = self.star_utils.upload_STARalignment(
+                                                single_input_params,
+                                                rds,
+                                                reads_info,
+                                                output_bam_file)
+                    self._journal(rds, 'uploaded', dict(aligned, upload_results=upload_results))
                 alignment_ref = upload_results['obj_ref']
+
+                if (self.gene_count_matrix is not None and
+                        not self.gene_count_matrix.has_sample(rds_name)):
+                    try:
+                        self.gene_count_matrix.add_sample(
+                            rds_name, os.path.join(star_mp_ret['star_output'],
+                                                   rds_name + '_ReadsPerGene.out.tab'))
+                    except (IOError, ValueError) as gcerr:
+                        # the counts are extracted from the files at the end instead
+                        log('Failed to add the gene counts of {}: {}'.format(rds_name, gcerr))
                 alignment_obj = {
                     'ref': alignment_ref,
                     'name': rds['alignment_output_name']
@@ -135,16 +248,83 @@ class STAR_Aligner(object):
                 else:
                     ret_val['report_name'] = None
                     ret_val['report_ref'] = None
+
+                # the alignment is in the workspace now, the intermediates are only kept for the
+                # report of the sample set, which packages them, and may be evicted before it
+                if in_set:
+                    self.scratch_manager.release_owned(rds['ref'])
+                else:
+                    self.scratch_manager.delete_owned(rds['ref'])
             finally:
-                if ret_fwd is not None:
-                    os.remove(ret_fwd)
-                    if reads_info.get('file_rev', None) is not None:
-                        os.remove(reads_info["file_rev"])
+                if reads_streamer is not None:
+                    try:
+                        reads_streamer.close()
+                    except RuntimeError as serr:
+                        log(str(serr))
+                elif ret_fwd is not None:
+                    self.scratch_manager.delete(ret_fwd)
+                    self.scratch_manager.delete(reads_info.get('file_rev', None))
         else:
             raise RuntimeError("Failed to get reads info.")
 
         return ret_val
 
+    def _journal(self, rds, stage, info=None, files=None):
+        '''record in the run journal, if there is one, that the reads rds got through stage'''
+        if self.run_journal is not None:
+            self.run_journal.record(rds['ref'], stage, info, files)
+
+    def _get_journaled(self, rds, stage):
+        '''the info the run journal, if there is one, has recorded for the reads rds at stage'''
+        if self.run_journal is None:
+            return None
+        return self.run_journal.get(rds['ref'], stage)
+
+    def _fetch_reads(self, rds):
+        """
+        _fetch_reads: download the reads rds, unless an earlier run of the same request has
+        aligned them already or left them downloaded on scratch. Returns their reads info.
+        """
+        aligned = self._get_journaled(rds, 'uploaded') or self._get_journaled(rds, 'aligned')
+        if aligned is not None:
+            return aligned['reads_info']
+        reads_info = self._get_journaled(rds, 'downloaded')
+        if reads_info is not None:
+            log('Reusing the reads {} downloaded before'.format(rds['ref']))
+        else:
+            self.scratch_manager.make_room()
+            reads_info = self.star_utils.get_reads_info(rds, rds['ref'])
+            self._journal(rds, 'downloaded', reads_info,
+                          [reads_info.get('file_fwd', None), reads_info.get('file_rev', None)])
+        for reads_file in [reads_info.get('file_fwd', None), reads_info.get('file_rev', None)]:
+            self.scratch_manager.track(reads_file, 'download_reads', rds['ref'])
+        return reads_info
+
+    def _open_reads_stream(self, rds):
+        '''
+        _open_reads_stream: start streaming the reads rds into named pipes if streaming is
+        enabled and possible for this reads library.
+        Returns (the Reads_Streamer to close after mapping, the reads info) or (None, None) if the
+        reads have to be downloaded.
+        '''
+        if not self.stream_reads:
+            return (None, None)
+        if self._get_journaled(rds, 'downloaded') is not None:
+            log('Reads {} are on scratch already, not streaming them'.format(rds['ref']))
+            return (None, None)
+
+        streamer = Reads_Streamer(self.workspace_url, self.scratch)
+        sources = streamer.get_stream_sources(rds['ref'])
+        if sources is None:
+            log('Reads {} cannot be streamed, downloading them instead'.format(rds['ref']))
+            return (None, None)
+
+        log('Streaming reads {} into STAR'.format(rds['ref']))
+        reads_info = streamer.open(sources)
+        reads_info['condition'] = rds.get('condition', 'unspecified')
+
+        return (streamer, reads_info)
+
     def _star_run_batch_sequential(self, input_params):
         """
         _star_run_batch_sequential: running the STAR align by looping
@@ -155,38 +335,70 @@ class STAR_Aligner(object):
         reads_refs = input_params[STARUtils.SET_READS]
         single_input_params = copy.deepcopy(input_params)
 
-        # 1. Run the mapping one by one
+        # 1. Load the genome into shared memory once for all the mappings
+        shared_genome = False
+        if len(reads_refs) > 1:
+            shared_genome = self.star_utils.load_shared_genome(self.star_idx_dir,
+                                                               single_input_params)
+        if shared_genome:
+            single_input_params['genomeLoad'] = 'LoadAndKeep'
+
+        # 2. Run the mapping one by one
         alignment_items = []
         alignment_objs = []
         rds_names = []
-        for r in reads_refs:
-            single_input_params[STARUtils.PARAM_IN_READS] = r['ref']
-            single_input_params['create_report'] = 0
-            try:
-                single_ret = self._star_run_single(single_input_params)
-            except RuntimeError as rer:
-                log("Error from STAR_Aligner._star_run_single().")
-                raise
-            else:
-                item = single_ret['alignment_objs'][0]
-                a_obj = item['AlignmentObj']
-                alignment_objs.append(item)
-                alignment_items.append({
-                        'ref': a_obj['ref'],
-                        'label': r.get(
-                            'condition',
-                            single_input_params.get('condition', 'unspecified'))
-                })
+        # download the reads in the background while the previous ones are being aligned
+        prefetcher = Reads_Prefetcher(self._fetch_reads, reads_refs, self.prefetch_depth,
+                                      self.scratch)
+        if self.stream_reads:
+            # the reads are streamed at mapping time, there is nothing to download ahead
+            prefetched_reads = ((r, None) for r in reads_refs)
+        else:
+            prefetched_reads = iter(prefetcher)
+        try:
+            for (r, reads_info) in prefetched_reads:
+                single_input_params[STARUtils.PARAM_IN_READS] = r['ref']
+                single_input_params['create_report'] = 0
+                try:
+                    single_ret = self._star_run_single(single_input_params, reads_info,
+                                                       in_set=True)
+                except RuntimeError as rer:
+                    log("Error from STAR_Aligner._star_run_single().")
+                    raise
+                else:
+                    item = single_ret['alignment_objs'][0]
+                    a_obj = item['AlignmentObj']
+                    alignment_objs.append(item)
+                    alignment_items.append({
+                            'ref': a_obj['ref'],
+                            'label': r.get(
+                                'condition',
+                                single_input_params.get('condition', 'unspecified'))
+                    })
+
+                    rds_names.append(r['alignment_output_name'].replace(
+                                        single_input_params['alignment_suffix'], ''))
+        finally:
+            prefetched_reads.close()
+            if shared_genome:
+                self.star_utils.remove_shared_genome(self.star_idx_dir)
 
-                rds_names.append(r['alignment_output_name'].replace(
-                                    single_input_params['alignment_suffix'], ''))
+        # 3. Process all the results after mapping is done
+        return self._build_batch_result(alignment_items, alignment_objs, rds_names, input_params)
 
-        # 2. Process all the results after mapping is done
+    def _build_batch_result(self, alignment_items, alignment_objs, rds_names, input_params):
+        """
+        _build_batch_result: save the alignment set and report of a batch run and return the
+        run_align result
+        """
         if len(alignment_items) > 0:
             (set_result, report_info) = self._batch_sequential_post_processing(
                                         alignment_items, rds_names, input_params)
 
             set_result['output_directory'] = self.star_out_dir
+            # the report has packaged the outputs of the samples
+            for alignment_obj in alignment_objs:
+                self.scratch_manager.delete_owned(alignment_obj['reads_ref'])
 
             result = {'alignmentset_ref': set_result['set_ref'],
                       'output_info': set_result,
@@ -204,6 +416,249 @@ class STAR_Aligner(object):
 
         return result
 
+    def _plan_local_jobs(self, n_samples, max_jobs, shared_genome, genome_ram=None):
+        """
+        _plan_local_jobs: split the CPUs and memory of this node between concurrent mappings.
+        genome_ram: the memory the genome takes, that of the index in star_idx_dir by default
+        Returns (number of concurrent mappings, runThreadN of each, RAM needed by each)
+        """
+        n_cpus = resource_util.get_cpu_count()
+        available_memory = resource_util.get_available_memory()
+        if genome_ram is None:
+            genome_ram = self.star_utils.get_genome_ram(self.star_idx_dir)
+
+        # with a shared genome each mapping only needs memory for sorting its BAM
+        job_ram = self.MAPPING_OVERHEAD_RAM + self.PARALLEL_BAM_SORT_RAM
+        if shared_genome:
+            available_memory -= genome_ram
+        else:
+            job_ram += genome_ram
+
+        n_jobs = min(max_jobs, n_samples, n_cpus // self.MIN_THREADS_PER_JOB,
+                     max(0, available_memory) // job_ram)
+        n_jobs = max(1, n_jobs)
+
+        return (n_jobs, max(1, n_cpus // n_jobs), job_ram)
+
+    def _star_run_batch_local_parallel(self, input_params):
+        """
+        _star_run_batch_local_parallel: running the STAR align of several reads at once on this
+        node, with the CPUs split between the concurrent mappings. Falls back to
+        _star_run_batch_sequential if there is not enough memory to run more than one at a time.
+        """
+        log('--->\nrunning STAR_Aligner._star_run_batch_local_parallel\n' +
+            'params:\n{}'.format(json.dumps(input_params, indent=1)))
+
+        reads_refs = input_params[STARUtils.SET_READS]
+        max_jobs = input_params.get('concurrent_local_tasks', None) or 1
+
+        # 1. Plan the concurrent mappings, sharing one in-memory genome between them if possible
+        shared_genome = not self.star_utils.needs_sjdb_insertion(self.star_idx_dir, input_params)
+        (n_jobs, n_threads, job_ram) = self._plan_local_jobs(
+                                            len(reads_refs), max_jobs, shared_genome)
+        if n_jobs > 1 and shared_genome:
+            shared_genome = self.star_utils.load_shared_genome(self.star_idx_dir, input_params)
+            if not shared_genome:
+                (n_jobs, n_threads, job_ram) = self._plan_local_jobs(
+                                                    len(reads_refs), max_jobs, shared_genome)
+        if n_jobs < 2:
+            log('Not enough resources to run mappings concurrently, running them one by one')
+            if shared_genome:
+                self.star_utils.remove_shared_genome(self.star_idx_dir)
+            return self._star_run_batch_sequential(input_params)
+
+        log('Running {} concurrent mappings with {} threads each'.format(n_jobs, n_threads))
+        run_manifest = self.star_utils.run_manifest
+        run_manifest.set('concurrent_mappings', n_jobs)
+        run_manifest.set('mapping_threads', n_threads)
+        if self.star_utils.auto_threads:
+            run_manifest.set('bam_sorting_threads', n_threads)
+        try:
+            # 2. Run the mappings in a pool of n_jobs workers
+            memory_cond = threading.Condition()
+            running = [0]
+
+            def run_task(r):
+                task_params = copy.deepcopy(input_params)
+                task_params[STARUtils.PARAM_IN_READS] = r['ref']
+                task_params[STARUtils.PARAM_IN_THREADN] = n_threads
+                if self.star_utils.auto_threads:
+                    task_params['outBAMsortingThreadN'] = n_threads
+                # the CPUs are split between the reads libraries already
+                task_params['read_shards'] = 1
+                task_params['create_report'] = 0
+                if shared_genome:
+                    task_params['genomeLoad'] = 'LoadAndKeep'
+                    task_params['limitBAMsortRAM'] = self.PARALLEL_BAM_SORT_RAM
+
+                # under memory pressure, wait for the running mappings to finish first
+                with memory_cond:
+                    while (running[0] > 0 and
+                            resource_util.get_available_memory() < job_ram):
+                        memory_cond.wait(10)
+                    running[0] += 1
+                try:
+                    return self._star_run_single(task_params, in_set=True)
+                finally:
+                    with memory_cond:
+                        running[0] -= 1
+                        memory_cond.notify_all()
+
+            pool = ThreadPool(n_jobs)
+            try:
+                async_results = [pool.apply_async(run_task, (r,)) for r in reads_refs]
+                pool.close()
+                pool.join()
+            finally:
+                pool.terminate()
+        finally:
+            if shared_genome:
+                self.star_utils.remove_shared_genome(self.star_idx_dir)
+
+        # 3. Collect the results in the order of the reads
+        alignment_items = []
+        alignment_objs = []
+        rds_names = []
+        for (r, async_result) in zip(reads_refs, async_results):
+            try:
+                single_ret = async_result.get()
+            except RuntimeError as rer:
+                log("Error from STAR_Aligner._star_run_single().")
+                raise
+            item = single_ret['alignment_objs'][0]
+            alignment_objs.append(item)
+            alignment_items.append({
+                    'ref': item['AlignmentObj']['ref'],
+                    'label': r.get('condition', input_params.get('condition', 'unspecified'))
+            })
+            rds_names.append(r['alignment_output_name'].replace(
+                                input_params['alignment_suffix'], ''))
+
+        # 4. Process all the results after mapping is done
+        return self._build_batch_result(alignment_items, alignment_objs, rds_names, input_params)
+
+    def _star_map_first_pass(self, input_params, rds, first_pass_dir, n_threads=None):
+        """
+        _star_map_first_pass: map the reads rds for their junctions only, without writing any
+        alignment or counts. Returns the path of the SJ.out.tab STAR wrote, in use until the
+        junctions of the set are pooled.
+        The reads are downloaded rather than streamed, and kept on scratch for the second pass
+        while there is room for them.
+        """
+        sj_file = self._get_journaled(rds, 'first_pass')
+        if sj_file is not None:
+            log('Reads {} went through the first pass in an earlier run'.format(rds['ref']))
+            self.scratch_manager.track(sj_file, 'first_pass')
+            return sj_file
+
+        rds_name = rds['alignment_output_name'].replace(input_params['alignment_suffix'], '')
+        params = copy.deepcopy(input_params)
+        params[STARUtils.PARAM_IN_READS] = rds['ref']
+        params[STARUtils.PARAM_IN_OUTFILE_PREFIX] = rds_name + '_pass1_'
+        params['outSAMtype'] = 'None'
+        params.pop('quantMode', None)
+        params.pop('twopassMode', None)
+        if n_threads is not None:
+            params[STARUtils.PARAM_IN_THREADN] = n_threads
+
+        # tracked, and journaled as downloaded for the second pass to pick up
+        reads_info = self._fetch_reads(rds)
+        rds_files = [f for f in [reads_info['file_fwd'], reads_info.get('file_rev', None)] if f]
+
+        try:
+            params_mp = self.star_utils.get_mapping_params(
+                            params, rds_files, rds_name, self.star_idx_dir, first_pass_dir)
+            self.star_utils.run_mapping_with_retry(params_mp)
+        except Exception:
+            for reads_file in rds_files:
+                self.scratch_manager.delete(reads_file)
+            raise
+        if self._has_room_for_reads(rds_files):
+            # evicted, and downloaded again by the second pass, if room is needed
+            for reads_file in rds_files:
+                self.scratch_manager.release(reads_file)
+        else:
+            log('Not enough room on scratch to keep the reads {} for the second pass'.format(
+                rds['ref']))
+            for reads_file in rds_files:
+                self.scratch_manager.delete(reads_file)
+
+        sj_file = os.path.join(params_mp['align_output'],
+                               params[STARUtils.PARAM_IN_OUTFILE_PREFIX] + 'SJ.out.tab')
+        self.scratch_manager.track(sj_file, 'first_pass')
+        self._journal(rds, 'first_pass', sj_file, [sj_file])
+        return sj_file
+
+    def _has_room_for_reads(self, rds_files):
+        '''
+        _has_room_for_reads: whether scratch can keep the reads files rds_files until they are
+        mapped again, leaving room for their alignment and for the reads downloaded meanwhile
+        '''
+        reads_size = sum([os.path.getsize(f) for f in rds_files if os.path.isfile(f)])
+        return (resource_util.get_free_disk_space(self.scratch) >=
+                Reads_Prefetcher.MIN_FREE_BYTES + 2 * reads_size)
+
+    def _star_run_batch_first_pass(self, input_params):
+        """
+        _star_run_batch_first_pass: the first pass of the batch two-pass mode. Maps all the reads
+        of the set (concurrently if concurrent_local_tasks allows it), pools the novel junctions
+        found in any of them and inserts those into the genome index, that the second pass maps
+        against. STAR's own two-pass mode inserts the junctions into the genome again for
+        every reads library; this inserts them once for the whole set.
+        """
+        reads_refs = input_params[STARUtils.SET_READS]
+        first_pass_dir = os.path.join(self.star_out_dir, self.FIRST_PASS_DIR)
+        self.star_utils._mkdir_p(first_pass_dir)
+
+        # 1. Map all the reads for their junctions
+        max_jobs = input_params.get('concurrent_local_tasks', None) or 1
+        (n_jobs, n_threads, job_ram) = self._plan_local_jobs(len(reads_refs), max_jobs, False)
+        log('Running the first pass over {} reads libraries, {} at a time'.format(
+            len(reads_refs), n_jobs))
+        pool = ThreadPool(n_jobs)
+        try:
+            sj_files = pool.map(
+                lambda r: self._star_map_first_pass(input_params, r, first_pass_dir,
+                                                    n_threads if n_jobs > 1 else None),
+                reads_refs)
+        finally:
+            pool.terminate()
+
+        # 2. Pool their junctions
+        sj_file = os.path.join(first_pass_dir, 'pooled_SJ.out.tab')
+        n_junctions = merge_junction_files(sj_files, sj_file)
+        for first_pass_sj_file in sj_files:
+            self.scratch_manager.release(first_pass_sj_file)
+        log('The first pass found {} novel junctions'.format(n_junctions))
+        self.star_utils.run_manifest.set('pooled_junctions', n_junctions)
+        if n_junctions == 0:
+            log('Mapping the second pass against the same genome index')
+            return
+
+        # 3. Insert the junctions into the genome index, for the second pass to map against
+        idx_params = copy.deepcopy(input_params)
+        idx_params['sjdbFileChrStartEnd'] = sj_file
+        two_pass_idx_dir = os.path.join(self.scratch, STARUtils.STAR_IDX_DIR + '_two_pass')
+        self.scratch_manager.make_room()
+        try:
+            self.star_idx_dir = self.star_utils.insert_junctions(
+                                    self.star_idx_dir,
+                                    {'sjdbFileChrStartEnd': sj_file,
+                                     'sjdbOverhang': input_params.get('sjdbOverhang'),
+                                     STARUtils.PARAM_IN_THREADN:
+                                        input_params[STARUtils.PARAM_IN_THREADN]},
+                                    two_pass_idx_dir)
+        except RuntimeError as ierr:
+            log('Failed to insert the junctions into {}, '.format(self.star_idx_dir) +
+                'generating the whole index instead:\n' + str(ierr))
+            shutil.rmtree(two_pass_idx_dir, ignore_errors=True)
+            self.star_utils._mkdir_p(two_pass_idx_dir)
+            (idx_ret, self.star_idx_dir) = self._run_star_indexing(idx_params, two_pass_idx_dir)
+        self.scratch_manager.track(two_pass_idx_dir, 'indexing')
+        # a cached first index and the outputs of the first pass may be evicted from now on
+        self._release_cached_index()
+        self.scratch_manager.track(first_pass_dir, 'first_pass', in_use=False)
+
     def _star_run_batch_parallel(self, input_params):
         """
         _star_run_batch_parallel: running the STAR align in batch parallelly
@@ -257,7 +712,7 @@ class STAR_Aligner(object):
 
         result_obj_ref = save_result['set_ref']
 
-        index_dir = os.path.join(self.scratch, STARUtils.STAR_IDX_DIR)
+        index_dir = self.star_idx_dir
         output_dir = os.path.join(self.scratch, STARUtils.STAR_OUT_DIR)
 
         # 2. Extract the ReadsPerGene counts if necessary
@@ -267,7 +722,8 @@ class STAR_Aligner(object):
         report_info = {'name': None, 'ref': None}
 
         # 4. run qualimap
-        qualimap_report = self.qualimap.run_bamqc({'input_ref': result_obj_ref})
+        with self.star_utils.run_manifest.span('qualimap'):
+            qualimap_report = self.qualimap.run_bamqc({'input_ref': result_obj_ref})
         qc_result_zip_info = qualimap_report['qc_result_zip_info']
         qc_result = [{'shock_id': qc_result_zip_info['shock_id'],
                       'name': qc_result_zip_info['index_html_file_name'],
@@ -343,7 +799,7 @@ class STAR_Aligner(object):
 
         result_obj_ref = save_result['set_ref']
 
-        index_dir = os.path.join(self.scratch, STARUtils.STAR_IDX_DIR)
+        index_dir = self.star_idx_dir
         output_dir = os.path.join(self.scratch, STARUtils.STAR_OUT_DIR)
 
         # Extract the ReadsPerGene counts if necessary
@@ -353,7 +809,8 @@ class STAR_Aligner(object):
         report_info = {'name': None, 'ref': None}
 
         # run qualimap
-        qualimap_report = self.qualimap.run_bamqc({'input_ref': result_obj_ref})
+        with self.star_utils.run_manifest.span('qualimap'):
+            qualimap_report = self.qualimap.run_bamqc({'input_ref': result_obj_ref})
         qc_result_zip_info = qualimap_report['qc_result_zip_info']
         qc_result = [{'shock_id': qc_result_zip_info['shock_id'],
                       'name': qc_result_zip_info['index_html_file_name'],
@@ -384,20 +841,47 @@ class STAR_Aligner(object):
 
         return result
 
+    def _counts_genes(self, params):
+        '''check if STAR counts the reads per gene with the quantMode in params'''
+        return (params.get('quantMode', None) is not None and
+                (params['quantMode'] == 'Both' or 'GeneCounts' in params['quantMode']))
+
+    def _new_gene_count_matrix(self, params):
+        '''
+        _new_gene_count_matrix: create the Gene_Count_Matrix the samples of the set in params
+        are added to as they finish mapping, or None if STAR does not count genes
+        '''
+        if not self._counts_genes(params):
+            return None
+        rds_names = [r['alignment_output_name'].replace(params['alignment_suffix'], '')
+                     for r in params[STARUtils.SET_READS]]
+        # only the counts of an earlier run of the same request are picked up
+        (run_key, resume) = (None, False)
+        if self.run_journal is not None:
+            (run_key, resume) = (self.run_journal.key, self.run_journal.resumed)
+        return Gene_Count_Matrix(self.star_out_dir, rds_names,
+                                 params.get('strandedness', None) or 'unstranded',
+                                 run_key, resume)
+
     def _extract_readsPerGene(self, params, rds_names, output_dir):
         """
         _extract_readsPerGene: Extract the ReadsPerGene counts if 'quantMode' was set
         during the STAR run.
         """
         gene_count_files = []
-        if (params.get('quantMode', None) is not None and
-                (params['quantMode'] == 'Both'
-                    or 'GeneCounts' in params['quantMode'])):
+        if self._counts_genes(params):
+            if (self.gene_count_matrix is not None and self.gene_count_matrix.is_complete()
+                    and output_dir == self.gene_count_matrix.output_dir):
+                # the matrix was assembled while the samples were mapped
+                self.gene_count_matrix.write()
+                return
+
             for reads_name in rds_names:
                 gene_count_files.append(
                     '{}/{}_ReadsPerGene.out.tab'.format(reads_name, reads_name))
 
-            extract_geneCount_matrix(gene_count_files, output_dir)
+            extract_geneCount_matrix(gene_count_files, output_dir,
+                                     params.get('strandedness', None) or 'unstranded')
 
     def _build_single_execution_task(self, rds_ref, params):
         """
@@ -407,6 +891,10 @@ class STAR_Aligner(object):
 
         task_params[STARUtils.PARAM_IN_READS] = rds_ref
         task_params['create_report'] = 0 
+        # let the node running the task size the threads from its own CPUs
+        if self.star_utils.auto_threads:
+            task_params[STARUtils.PARAM_IN_THREADN] = 0
+            task_params.pop('outBAMsortingThreadN', None)
 
         if 'condition' in rds_ref:
             task_params['condition'] = rds_ref['condition']
@@ -436,24 +924,26 @@ class STAR_Aligner(object):
         # again, default to setting this to release
         return 'release'
 
-    def _run_star_indexing(self, input_params):
+    def _run_star_indexing(self, input_params, idx_dir=None):
         """
         _run_star_indexing: Runs STAR in genomeGenerate mode to build the index files and directory
         for subsequent STAR mapping. It creates a directory as defined by self.star_idx_dir in the
-        scratch area that houses the index files.
+        scratch area that houses the index files, unless another idx_dir is given.
         """
+        if idx_dir is None:
+            idx_dir = self.star_idx_dir
+
         ret_params = copy.deepcopy(input_params)
         ret_params[STARUtils.PARAM_IN_STARMODE] = 'genomeGenerate'
 
         # build the indexing parameters
-        params_idx = self.star_utils.get_indexing_params(ret_params, self.star_idx_dir)
+        params_idx = self.star_utils.get_indexing_params(ret_params, idx_dir)
 
         ret = 1
         try:
-            ret = self.star_utils.exec_indexing(params_idx)
-            while(ret != 0 or not os.path.isfile(
-                    os.path.join(self.star_idx_dir, 'genomeParameters.txt'))):
-                time.sleep(1)
+            self.star_utils.run_indexing_with_retry(params_idx)
+            if not os.path.isfile(os.path.join(idx_dir, 'genomeParameters.txt')):
+                raise RuntimeError('STAR did not write genomeParameters.txt into ' + idx_dir)
         except Exception as eidx:
             raise RuntimeError('STAR genome indexing raised error:\n' + repr(eidx))
         else:
@@ -461,10 +951,11 @@ class STAR_Aligner(object):
 
         return (ret, params_idx[STARUtils.STAR_IDX_DIR])
 
-    def _run_star_mapping(self, params, rds_files, rds_name):
+    def _run_star_mapping(self, params, rds_files, rds_name, retry=True):
         """
         _run_star_mapping: Runs STAR in alignReads mode for STAR mapping. It creates a directory
         as defined by self.star_out_dir with a subfolder named after the reads.
+        Failures that may go away on another attempt are retried, unless retry is False.
         """
         params_mp = self.star_utils.get_mapping_params(
                         params, rds_files, rds_name, self.star_idx_dir, self.star_out_dir)
@@ -472,9 +963,7 @@ class STAR_Aligner(object):
         retVal = {}
         params_mp[STARUtils.PARAM_IN_STARMODE] = 'alignReads'
         try:
-            ret = self.star_utils.exec_mapping(params_mp)
-            while(ret != 0):
-                time.sleep(1)
+            self.star_utils.run_mapping_with_retry(params_mp, retry)
         except Exception as emp:
             raise RuntimeError('STAR mapping raised error:\n' + repr(emp))
         else:  # no exception raised and STAR returns 0, then move to saving and reporting
@@ -482,28 +971,358 @@ class STAR_Aligner(object):
 
         return retVal
 
+    def _shards_reads(self, params, streamed):
+        '''
+        _shards_reads: whether the reads are mapped in read_shards shards, see
+        _run_star_mapping_sharded, rather than in one run. With outFilterType BySJout the
+        alignments STAR keeps depend on the junctions of the whole library, which no shard sees,
+        and with twopassMode Basic the second pass maps against the first-pass junctions of the
+        whole library, where each shard would insert only its own.
+        '''
+        if ((params.get('read_shards', None) or 1) <= 1 or streamed or
+                params.get('outSAMtype', None) != 'BAM'):
+            return False
+        if self.star_utils.filters_alignments_by_junctions(params):
+            log('outFilterType BySJout filters the alignments by the junctions of the whole '
+                'library, mapping it in one run instead of {} shards'.format(
+                    params['read_shards']))
+            return False
+        if params.get('twopassMode', None) == 'Basic':
+            log('twopassMode Basic inserts the first-pass junctions of the whole library, '
+                'mapping it in one run instead of {} shards'.format(params['read_shards']))
+            return False
+        return True
+
+    def _get_records_per_file(self, reads_info):
+        '''the number of reads in each file of reads_info from its metadata, or None'''
+        if not reads_info.get('read_count', None):
+            return None
+        if reads_info.get('file_rev', None) is not None:
+            # the metadata counts the reads of both mates
+            return reads_info['read_count'] // 2
+        return reads_info['read_count']
+
+    def _run_star_mapping_sharded(self, params, rds_files, rds_name, n_records=None):
+        """
+        _run_star_mapping_sharded: split the reads files into read_shards shards, map them
+        concurrently against the genome in shared memory, and merge their outputs into those of
+        the whole library, named as _run_star_mapping names them. A single STAR run stops
+        scaling at about 16 threads, several smaller ones keep all the CPUs of a big node busy.
+        Each read is aligned the same as in one run. The shards keep all their junctions, which
+        are filtered once merged, as STAR filters those of the whole library.
+        n_records: the number of reads in each file from the metadata of the reads, counted from
+        the files when not known or wrong
+        """
+        aligndir = os.path.join(self.star_out_dir, rds_name)
+        shards_dir = os.path.join(aligndir, 'shards')
+        try:
+            with self.star_utils.run_manifest.span('split_reads', rds_name) as span:
+                try:
+                    shards = split_fastq_files(rds_files, shards_dir, params['read_shards'],
+                                               n_records)
+                except ValueError as split_err:
+                    if n_records is None:
+                        raise
+                    log('{}, counting the reads of {}'.format(split_err, rds_name))
+                    shutil.rmtree(shards_dir, ignore_errors=True)
+                    shards = split_fastq_files(rds_files, shards_dir, params['read_shards'])
+                for shard_files in shards:
+                    for shard_file in shard_files:
+                        span.add_file(shard_file)
+            log('Split the reads of {} into {} shards'.format(rds_name, len(shards)))
+
+            # load the genome into shared memory, unless a batch run has done it already
+            own_shared_genome = False
+            shared_genome = params.get('genomeLoad', 'NoSharedMemory') != 'NoSharedMemory'
+            if not shared_genome and len(shards) > 1:
+                shared_genome = own_shared_genome = self.star_utils.load_shared_genome(
+                                                                self.star_idx_dir, params)
+            (n_jobs, n_threads, job_ram) = self._plan_local_jobs(len(shards), len(shards),
+                                                                 shared_genome)
+            log('Mapping {} shards, {} at a time with {} threads each'.format(
+                len(shards), n_jobs, n_threads))
+
+            def run_shard(shard_idx):
+                shard_params = copy.deepcopy(params)
+                shard_params[STARUtils.PARAM_IN_OUTFILE_PREFIX] = '{}_shard_{}_'.format(
+                                                                    rds_name, shard_idx)
+                shard_params[STARUtils.PARAM_IN_THREADN] = n_threads
+                if shard_params.get('outBAMsortingThreadN', None):
+                    shard_params['outBAMsortingThreadN'] = n_threads
+                # the shards are decompressed
+                shard_params.pop('readFilesCommand', None)
+                shard_params.update(STARUtils.SJ_COUNT_FILTERS_OFF)
+                if shared_genome:
+                    shard_params['genomeLoad'] = 'LoadAndKeep'
+                    shard_params['limitBAMsortRAM'] = self.PARALLEL_BAM_SORT_RAM
+                params_mp = self.star_utils.get_mapping_params(
+                                shard_params, shards[shard_idx], rds_name, self.star_idx_dir,
+                                self.star_out_dir)
+                self.star_utils.run_mapping_with_retry(params_mp)
+                return os.path.join(aligndir, shard_params[STARUtils.PARAM_IN_OUTFILE_PREFIX])
+
+            pool = ThreadPool(n_jobs)
+            try:
+                shard_prefixes = pool.map(run_shard, range(len(shards)))
+            finally:
+                pool.terminate()
+                if own_shared_genome:
+                    self.star_utils.remove_shared_genome(self.star_idx_dir)
+
+            self.star_utils.merge_shard_outputs(shard_prefixes,
+                                                os.path.join(aligndir, rds_name + '_'),
+                                                self.star_idx_dir,
+                                                resource_util.get_cpu_count(),
+                                                self.star_utils.get_sj_filters(params))
+            # the logs of the shards are kept, their alignments are merged
+            for prefix in shard_prefixes:
+                for suffix in ['Aligned.sortedByCoord.out.bam', 'Aligned.out.bam',
+                               'Aligned.toTranscriptome.out.bam']:
+                    if os.path.isfile(prefix + suffix):
+                        os.remove(prefix + suffix)
+        except Exception as emp:
+            raise RuntimeError('STAR mapping of the shards raised error:\n' + repr(emp))
+        finally:
+            shutil.rmtree(shards_dir, ignore_errors=True)
+
+        return {'star_idx': self.star_idx_dir, 'star_output': aligndir}
+
     def _get_index(self, input_params):
         '''
-        _get_index: generate the index if not yet existing
+        _get_index: generate the index if not yet existing, reusing a cached one when available.
+        With the cache, an annotated index missing from it is derived from the cached
+        annotation-free index of the same genome when possible.
         '''
-        # generate the indices
+        if self.index_cache is None:
+            # generate the indices
+            self.scratch_manager.make_room()
+            try:
+                (idx_ret, idx_dir) = self._run_star_indexing(input_params)
+            except RuntimeError as rerr:
+                log("Failed to generate genome indices.")
+                raise
+            self.scratch_manager.track(idx_dir, 'indexing')
+            return
+
+        self.index_cache.sweep_staging()
+        genome_params = dict([(p, input_params.get(p))
+                              for p in STARUtils.GENOME_GENERATE_PARAMS])
+        cache_key = self.index_cache.make_key(input_params[STARUtils.PARAM_IN_FASTA_FILES],
+                                              input_params.get('sjdbGTFfile'),
+                                              input_params.get('sjdbOverhang'),
+                                              STARUtils.STAR_VERSION,
+                                              genome_params)
+        with self.index_cache.lock(cache_key):
+            cached_dir = self.index_cache.lookup(cache_key)
+            if cached_dir is not None:
+                log('Reusing cached STAR genome index {}'.format(cached_dir))
+                sparse_d = self.index_cache.get_info(cache_key).get('genomeSAsparseD') or 1
+                if sparse_d > 1:
+                    log('The cached index has a sparse suffix array (genomeSAsparseD ' +
+                        '{}), mapping will need less memory but run slower'.format(sparse_d))
+                self.star_idx_dir = cached_dir
+                self.index_cache_use = self.index_cache.acquire(cache_key)
+                return
+
+            log('No cached STAR genome index found for key {}'.format(cache_key))
+            idx_dir = None
+            if input_params.get('sjdbGTFfile'):
+                idx_dir = self._derive_cached_index(cache_key, input_params, genome_params)
+            if idx_dir is None:
+                idx_dir = self._build_cached_index(cache_key, input_params, genome_params)
+            self.star_idx_dir = idx_dir
+            self.index_cache_use = self.index_cache.acquire(cache_key)
+
+    def _get_cache_info(self, input_params, genome_params):
+        cache_info = {'genome_ref': input_params.get(STARUtils.PARAM_IN_GENOME),
+                      'genomeFastaFiles': input_params[STARUtils.PARAM_IN_FASTA_FILES],
+                      'sjdbGTFfile': input_params.get('sjdbGTFfile'),
+                      'sjdbOverhang': input_params.get('sjdbOverhang'),
+                      'star_version': STARUtils.STAR_VERSION}
+        cache_info.update(genome_params)
+        # the index was built sparse to fit in the memory of this node
+        cache_info['limitGenomeGenerateRAM'] = input_params.get('limitGenomeGenerateRAM')
+        cache_info['low_memory'] = (input_params.get('genomeSAsparseD') or 1) > 1
+        return cache_info
+
+    def _build_cached_index(self, cache_key, input_params, genome_params):
+        '''
+        _build_cached_index: generate the index of input_params and cache it under cache_key,
+        returns the directory of the cache entry. Call with the lock of cache_key held.
+        '''
+        self.scratch_manager.make_room()
+        staging_dir = self.index_cache.new_staging_dir(cache_key)
         try:
-            (idx_ret, idx_dir) = self._run_star_indexing(input_params)
+            (idx_ret, idx_dir) = self._run_star_indexing(input_params, staging_dir)
         except RuntimeError as rerr:
             log("Failed to generate genome indices.")
+            self.index_cache.discard(staging_dir)
             raise
 
+        return self.index_cache.publish(cache_key, staging_dir,
+                                        self._get_cache_info(input_params, genome_params))
+
+    def _derive_cached_index(self, cache_key, input_params, genome_params):
+        '''
+        _derive_cached_index: cache under cache_key the index of input_params made by inserting
+        the junctions of its annotations into the annotation-free index of its genome, itself
+        cached (and generated first if it is not), so that a new annotation or sjdbOverhang for
+        a genome indexed before does not generate its suffix array again.
+        Returns the directory of the cache entry, or None if the junctions could not be
+        inserted. Call with the lock of cache_key held.
+        '''
+        base_params = copy.deepcopy(input_params)
+        for sjdb_param in ['sjdbGTFfile', 'sjdbFileChrStartEnd', 'sjdbOverhang']:
+            base_params.pop(sjdb_param, None)
+        base_key = self.index_cache.make_key(base_params[STARUtils.PARAM_IN_FASTA_FILES],
+                                             None, None, STARUtils.STAR_VERSION, genome_params)
+        with self.index_cache.lock(base_key):
+            base_dir = self.index_cache.lookup(base_key)
+            if base_dir is None:
+                log('Generating the annotation-free STAR genome index {}'.format(base_key))
+                base_dir = self._build_cached_index(base_key, base_params, genome_params)
+            else:
+                log('Inserting the annotation junctions into the cached annotation-free STAR ' +
+                    'genome index {}'.format(base_dir))
+            base_use = self.index_cache.acquire(base_key)
+
+        self.scratch_manager.make_room()
+        work_dir = self.index_cache.new_staging_dir(cache_key)
+        try:
+            idx_dir = self.star_utils.insert_junctions(base_dir, input_params, work_dir)
+            cache_info = self._get_cache_info(input_params, genome_params)
+            cache_info['base_key'] = base_key
+            return self.index_cache.publish(cache_key, idx_dir, cache_info)
+        except RuntimeError as ierr:
+            log('Failed to insert the annotation junctions into {}, '.format(base_dir) +
+                'generating the whole index instead:\n' + str(ierr))
+            return None
+        finally:
+            self.index_cache.release(base_use)
+            self.index_cache.discard(work_dir)
+
+    def _sample_read_lengths(self, reads_ref):
+        '''
+        _sample_read_lengths: the read length distribution of the first reads of reads_ref,
+        streamed from Shock, or None if they cannot be streamed
+        '''
+        streamer = Reads_Streamer(self.workspace_url, self.scratch)
+        try:
+            sources = streamer.get_stream_sources(reads_ref)
+            if sources is None:
+                return None
+            return streamer.sample_read_lengths(sources, self.read_length_sample_size)
+        except Exception as e:
+            log('Failed to sample the reads of {}: {}'.format(reads_ref, repr(e)))
+            return None
+
+    def _set_sjdb_overhang(self, params):
+        '''
+        _set_sjdb_overhang: unless params give it, set sjdbOverhang to the longest read - 1 of the
+        reads in params, from the first reads of each library (or the read_size of the libraries
+        that cannot be sampled). A single overhang for all the libraries of a set, so that a
+        single (cached) index serves the whole set. Left to STAR's default if no read length is
+        known, and not sampled at all when params insert no splice junctions, as STAR uses
+        sjdbOverhang for nothing else.
+        '''
+        if params.get('sjdbOverhang', None) is not None or self.read_length_sample_size <= 0:
+            return
+        if not self.star_utils.uses_sjdb(params):
+            log('No splice junctions to insert, not sampling the read lengths for sjdbOverhang')
+            return
+        reads_refs = [r['ref'] for r in params[STARUtils.SET_READS]]
+        if not reads_refs:
+            return
+
+        pool = ThreadPool(min(len(reads_refs), self.READ_SAMPLING_THREADS))
+        try:
+            distributions = pool.map(self._sample_read_lengths, reads_refs)
+        finally:
+            pool.close()
+            pool.join()
+
+        read_lengths = dict()
+        unsampled = [ref for (ref, d) in zip(reads_refs, distributions) if not d]
+        if unsampled:
+            objs = self.star_utils.ws_client.get_objects2(
+                        {'objects': [{'ref': ref, 'included': ['/read_size']}
+                                     for ref in unsampled]})['data']
+            for (ref, obj) in zip(unsampled, objs):
+                if (obj['data'] or {}).get('read_size', None):
+                    read_lengths[ref] = {'max': obj['data']['read_size'], 'source': 'read_size'}
+        for (ref, distribution) in zip(reads_refs, distributions):
+            if distribution:
+                n_sampled = sum(distribution.values())
+                n_bases = sum([length * n for (length, n) in distribution.items()])
+                read_lengths[ref] = {'min': min(distribution), 'max': max(distribution),
+                                     'mean': n_bases / float(n_sampled), 'sampled': n_sampled,
+                                     'source': 'sample'}
+        run_manifest = self.star_utils.run_manifest
+        run_manifest.set('read_lengths', read_lengths)
+
+        if not read_lengths:
+            log('The read lengths of {} are unknown, '.format(params[STARUtils.PARAM_IN_READS]) +
+                'leaving sjdbOverhang to the default of STAR')
+            return
+        for ref in reads_refs:
+            if ref not in read_lengths:
+                log('The read length of {} is unknown, it may be longer than sjdbOverhang '
+                    'allows for'.format(ref))
+        params['sjdbOverhang'] = max([info['max'] for info in read_lengths.values()]) - 1
+        log('Set sjdbOverhang to {} from the read lengths of {} reads libraries'.format(
+            params['sjdbOverhang'], len(read_lengths)))
+        run_manifest.set('sjdbOverhang', params['sjdbOverhang'])
+
+    def _release_cached_index(self):
+        '''_release_cached_index: stop using the cached genome index, so that it may be evicted'''
+        if self.index_cache_use is not None:
+            self.index_cache.release(self.index_cache_use)
+            self.index_cache_use = None
+
+    def plan_align(self, params):
+        """
+        plan_align: the dry run of run_align. Estimates the memory, scratch and time the request
+        in params needs from the metadata of its genome and reads, without downloading them, and
+        picks how run_align would run it on this node. Returns the plan, see Run_Planner.plan.
+        """
+        validated_params = self.star_utils.process_params(params)
+        input_obj_info = self.star_utils.determine_input_info(validated_params)
+        reads_refs = self.star_utils._get_reads_refs_from_setref(validated_params)
+
+        if input_obj_info['run_mode'] == 'sample_set':
+            n_tasks = len(reads_refs)
+            max_jobs = validated_params.get('concurrent_local_tasks', None) or 1
+        elif self._shards_reads(validated_params, False):
+            n_tasks = max_jobs = validated_params['read_shards']
+        else:
+            n_tasks = max_jobs = 1
+        planner = Run_Planner(self.star_utils, self.MAPPING_OVERHEAD_RAM,
+                              self.PARALLEL_BAM_SORT_RAM)
+        plan = planner.plan(validated_params, reads_refs, n_tasks, max_jobs,
+                            self._plan_local_jobs, self.prefetch_depth)
+        log('Run plan:\n' + json.dumps(plan, indent=1, sort_keys=True))
+
+        return plan
+
     def run_align(self, params):
         # 0. create the star folders
         if self.star_idx_dir is None:
             (self.star_idx_dir, self.star_out_dir) = self.star_utils.create_star_dirs(self.scratch)
 
         # 1. validate & process the input parameters
-        validated_params = self.star_utils.process_params(params)
-        input_obj_info = self.star_utils.determine_input_info(validated_params)
+        run_manifest = self.star_utils.run_manifest
+        with run_manifest.span('process_params'):
+            validated_params = self.star_utils.process_params(params)
+            input_obj_info = self.star_utils.determine_input_info(validated_params)
+        run_manifest.set('run_mode', input_obj_info['run_mode'])
+        run_manifest.set('star_version', STARUtils.STAR_VERSION)
 
         # 2. convert the input parameters (from refs to file paths, especially)
-        input_params = self.star_utils.convert_params(validated_params)
+        input_params = self.star_utils.convert_params(validated_params, tune=False)
+        # the genome annotations (sjdbGTFfile) are known once converted
+        with run_manifest.span('sample_read_lengths'):
+            self._set_sjdb_overhang(input_params)
+        input_params = self.star_utils.tune_genome_generate_params(input_params)
 
         ret = {
             "report_ref": None,
@@ -518,19 +1337,43 @@ class STAR_Aligner(object):
             traceback.print_exc()
         else:
             try:  # 4. aligning reads
+                self.gene_count_matrix = None
                 if input_obj_info['run_mode'] == 'single_library':
                     print("aligning a single_library...")
+                    if input_params.get('twopassMode', None) == 'Batch':
+                        # a set of one gains nothing from pooling junctions
+                        input_params['twopassMode'] = 'Basic'
                     ret = self._star_run_single(input_params)
 
                 if input_obj_info['run_mode'] == 'sample_set':
                     print("aligning a sample_set...")
+                    # pick up the samples an earlier run of the same request got through
+                    self.run_journal = Run_Journal(
+                                        os.path.join(self.scratch, Run_Journal.DIR_NAME),
+                                        validated_params)
+                    if input_params.get('twopassMode', None) == 'Batch':
+                        self._star_run_batch_first_pass(input_params)
+                    self.gene_count_matrix = self._new_gene_count_matrix(input_params)
                     # ret = self._star_run_batch_parallel(input_params)
-                    ret = self._star_run_batch_sequential(input_params)
+                    if (input_params.get('concurrent_local_tasks', None) or 1) > 1:
+                        ret = self._star_run_batch_local_parallel(input_params)
+                    else:
+                        ret = self._star_run_batch_sequential(input_params)
+                    if ret.get('alignmentset_ref', None) is not None:
+                        self.run_journal.discard()
 
             except RuntimeError as map_err:
                 log('STAR aligning failed...\n')
                 traceback.print_exc()
+                if self.run_journal is not None:
+                    log('The samples done so far are recorded in {}, '.format(
+                        self.run_journal.journal_file) +
+                        'running the same request again resumes from them')
         finally:
+            self._release_cached_index()
+            run_manifest.set('scratch', self.scratch_manager.summarize())
+            log('Run summary:\n' + run_manifest.format_summary())
+            log('Run manifest written to ' + run_manifest.write(self.star_out_dir))
             return ret
 
 
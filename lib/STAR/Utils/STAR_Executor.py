@@ -0,0 +1,126 @@
+import os
+import copy
+import time
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+FAILURE_OUT_OF_MEMORY = 'out of memory'
+FAILURE_DISK_FULL = 'disk full'
+FAILURE_SHARED_MEMORY = 'shared memory error'
+FAILURE_HUNG = 'no progress'
+FAILURE_BAD_INPUT = 'bad input'
+FAILURE_UNKNOWN = 'unknown error'
+
+# exit codes defined in STAR's ErrorWarning.h
+STAR_EXIT_CODES = {102: FAILURE_BAD_INPUT,       # EXIT_CODE_PARAMETER
+                   104: FAILURE_BAD_INPUT,       # EXIT_CODE_INPUT_FILES
+                   105: FAILURE_BAD_INPUT,       # EXIT_CODE_GENOME_FILES
+                   106: FAILURE_SHARED_MEMORY,   # EXIT_CODE_SHM
+                   108: FAILURE_OUT_OF_MEMORY,   # EXIT_CODE_MEMORY_ALLOCATION
+                   110: FAILURE_DISK_FULL,       # EXIT_CODE_FILE_WRITE
+                   111: FAILURE_BAD_INPUT}       # EXIT_CODE_INCONSISTENT_DATA
+
+# messages STAR (or the system) writes for each kind of failure, checked in this order
+FAILURE_MESSAGES = [(FAILURE_DISK_FULL, ['no space left on device', 'disk quota exceeded',
+                                         'could not write']),
+                    (FAILURE_OUT_OF_MEMORY, ['not enough memory', 'bad_alloc',
+                                             'could not allocate', 'cannot allocate memory']),
+                    (FAILURE_SHARED_MEMORY, ['shared memory']),
+                    (FAILURE_BAD_INPUT, ['fatal input', 'fatal parameter', 'fatal error in input',
+                                         'fatal error in reads input', 'could not open',
+                                         'no valid exon lines'])]
+
+RETRYABLE_FAILURES = [FAILURE_OUT_OF_MEMORY, FAILURE_DISK_FULL, FAILURE_SHARED_MEMORY,
+                      FAILURE_HUNG]
+
+
+def _read_log_tail(log_file, max_bytes=65536):
+    if not log_file or not os.path.isfile(log_file):
+        return ''
+    with open(log_file) as f:
+        f.seek(max(0, os.path.getsize(log_file) - max_bytes))
+        return f.read()
+
+
+def classify_failure(run_result, log_file=None):
+    """
+    classify_failure: tell from a failed Program_Runner Run_Result, and the Log.out STAR wrote,
+    why STAR failed
+    """
+    if run_result.timed_out:
+        return FAILURE_HUNG
+
+    output = ('\n'.join(run_result.output_tail) + '\n' + _read_log_tail(log_file)).lower()
+    for (failure, messages) in FAILURE_MESSAGES:
+        for message in messages:
+            if message in output:
+                return failure
+
+    if run_result.exit_code in STAR_EXIT_CODES:
+        return STAR_EXIT_CODES[run_result.exit_code]
+    # killed by the kernel OOM killer
+    if run_result.exit_code == -9 or run_result.exit_code == 137:
+        return FAILURE_OUT_OF_MEMORY
+
+    return FAILURE_UNKNOWN
+
+
+class STAR_Executor:
+    """
+    STAR_Executor: runs STAR through a STARUtils run_* method, and retries the failures that may
+    go away on another attempt (out of memory, disk full, no progress) with exponential backoff,
+    with fewer threads and less RAM after running out of memory. Every other failure is raised
+    right away, so that the job frees its slot instead of waiting on a STAR that will never
+    succeed.
+    """
+    def __init__(self, max_retries=2, backoff=30):
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def _reduce_resources(self, params, failure):
+        params = copy.deepcopy(params)
+        if failure == FAILURE_OUT_OF_MEMORY:
+            # fewer threads need fewer buffers, when sorting BAM in particular
+            params['runThreadN'] = max(1, params.get('runThreadN', 1) // 2)
+            if params.get('outBAMsortingThreadN', None):
+                params['outBAMsortingThreadN'] = max(1, params['outBAMsortingThreadN'] // 2)
+            if params.get('limitBAMsortRAM', None):
+                params['limitBAMsortRAM'] = params['limitBAMsortRAM'] // 2
+        if failure == FAILURE_SHARED_MEMORY:
+            params['genomeLoad'] = 'NoSharedMemory'
+            params.pop('limitBAMsortRAM', None)
+        return params
+
+    def execute(self, run_func, params, log_file=None, max_retries=None):
+        """
+        execute: call run_func(params) until STAR succeeds. Returns the Run_Result of the
+        successful run, or raises a RuntimeError describing the failure.
+        max_retries: overrides the max_retries of the executor for this run
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            run_result = run_func(params)
+            if run_result.exit_code == 0:
+                return run_result
+
+            failure = classify_failure(run_result, log_file)
+            message = 'STAR failed with exit code {} ({})'.format(run_result.exit_code, failure)
+            if failure not in RETRYABLE_FAILURES:
+                raise RuntimeError(message + ', not retrying:\n' +
+                                   '\n'.join(run_result.output_tail[-20:]))
+            if attempt >= max_retries:
+                raise RuntimeError(message + ', giving up after {} attempts:\n'.format(
+                                   attempt + 1) + '\n'.join(run_result.output_tail[-20:]))
+
+            wait_time = self.backoff * (2 ** attempt)
+            attempt += 1
+            params = self._reduce_resources(params, failure)
+            log(message + ', retrying in {} seconds (attempt {} of {})'.format(
+                wait_time, attempt + 1, max_retries + 1))
+            time.sleep(wait_time)
@@ -0,0 +1,191 @@
+import os
+import time
+import shutil
+import threading
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+def _get_size(path):
+    '''the bytes taken by the file or the directory tree path'''
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Scratch_Manager:
+    """
+    Scratch_Manager: keeps track of the artifacts a run leaves on the scratch disk (genome
+    indexes, downloaded reads, STAR outputs), with their size, the stage that made them and the
+    sample they belong to, if any.
+    An artifact is in use from when it is tracked until it is released. When the scratch disk gets
+    fuller than the high-water mark, the artifacts not in use are evicted, the least recently used
+    first, along with the least recently used entries of the genome index cache when it is on the
+    same disk. The intermediates of a sample are deleted once its alignment is uploaded and the
+    report packaging them, if any, is built.
+    """
+
+    def __init__(self, scratch_dir, high_water_mark=0, index_cache=None):
+        """
+        high_water_mark: the fraction of the scratch disk used above which artifacts are evicted,
+        0 to never evict any
+        """
+        self.scratch_dir = scratch_dir
+        self.high_water_mark = high_water_mark
+        # the cached indexes are only evicted to make room on scratch if they share its disk
+        self.index_cache = None
+        if (index_cache is not None and
+                os.stat(index_cache.cache_dir).st_dev == os.stat(scratch_dir).st_dev):
+            self.index_cache = index_cache
+        # the tracked artifacts, by path
+        self.artifacts = dict()
+        self.lock = threading.Lock()
+        self.evicted_bytes = 0
+        self.deleted_bytes = 0
+        self.peak_usage = 0.0
+
+    def track(self, path, stage, owner=None, in_use=True):
+        """
+        track: start tracking the file or directory path, made by stage for the sample owner
+        (None for the artifacts shared by all the samples). Returns the tracked path, or None
+        if there is nothing at path.
+        """
+        if not path or not os.path.exists(path):
+            return None
+        path = os.path.abspath(path)
+        size = _get_size(path)
+        with self.lock:
+            artifact = self.artifacts.setdefault(path, {'path': path, 'users': 0})
+            artifact.update({'stage': stage, 'owner': owner, 'size': size,
+                             'last_used': time.time()})
+            if in_use:
+                artifact['users'] += 1
+        return path
+
+    def release(self, path):
+        '''release: stop using the artifact path, it is evicted when room is needed'''
+        if not path:
+            return
+        with self.lock:
+            artifact = self.artifacts.get(os.path.abspath(path), None)
+            if artifact is not None:
+                artifact['users'] = max(0, artifact['users'] - 1)
+                artifact['last_used'] = time.time()
+
+    def release_owned(self, owner):
+        '''release_owned: stop using all the artifacts of the sample owner'''
+        with self.lock:
+            paths = [p for (p, a) in self.artifacts.items() if a['owner'] == owner]
+        for path in paths:
+            self.release(path)
+
+    def delete(self, path):
+        '''delete: delete path right away, tracked or not, returns the bytes freed'''
+        if not path:
+            return 0
+        path = os.path.abspath(path)
+        with self.lock:
+            self.artifacts.pop(path, None)
+        size = _get_size(path)
+        _remove(path)
+        with self.lock:
+            self.deleted_bytes += size
+        return size
+
+    def delete_owned(self, owner):
+        '''delete_owned: delete all the artifacts of the sample owner, returns the bytes freed'''
+        with self.lock:
+            paths = [p for (p, a) in self.artifacts.items() if a['owner'] == owner]
+        freed = sum([self.delete(p) for p in paths])
+        if freed:
+            log('Deleted {} bytes of intermediates of {} from scratch'.format(freed, owner))
+        return freed
+
+    def get_usage(self):
+        '''the fraction of the scratch disk in use'''
+        stat = os.statvfs(self.scratch_dir)
+        if stat.f_blocks == 0:
+            return 0.0
+        return 1.0 - float(stat.f_bavail) / stat.f_blocks
+
+    def _eviction_candidates(self):
+        # (last used, size, path, key of the cache entry or None) of whatever may be evicted
+        with self.lock:
+            candidates = [(a['last_used'], a['size'], a['path'], None)
+                          for a in self.artifacts.values() if a['users'] == 0]
+        if self.index_cache is not None:
+            candidates += [(last_used, _get_size(entry_dir), entry_dir, key)
+                           for (key, entry_dir, last_used) in self.index_cache.list_entries()]
+        return sorted(candidates)
+
+    def make_room(self):
+        """
+        make_room: evict artifacts not in use, the least recently used first, until the scratch
+        disk is no fuller than the high-water mark. Returns the bytes freed.
+        """
+        usage = self.get_usage()
+        self.peak_usage = max(self.peak_usage, usage)
+        if self.high_water_mark <= 0 or usage <= self.high_water_mark:
+            return 0
+
+        log('Scratch disk is {:.1%} full, evicting the least recently used artifacts'.format(
+            usage))
+        freed = 0
+        # the leftovers of the index builds that did not finish come first
+        if self.index_cache is not None and self.index_cache.sweep_staging():
+            usage = self.get_usage()
+        for (last_used, size, path, cache_key) in self._eviction_candidates():
+            if usage <= self.high_water_mark:
+                break
+            if cache_key is not None:
+                if not self.index_cache.evict(cache_key):
+                    continue
+            else:
+                with self.lock:
+                    artifact = self.artifacts.get(path, None)
+                    # put back in use since the candidates were listed
+                    if artifact is None or artifact['users'] > 0:
+                        continue
+                    del self.artifacts[path]
+                _remove(path)
+                log('Evicted {} ({} bytes, {})'.format(path, size, artifact['stage']))
+            freed += size
+            usage = self.get_usage()
+
+        with self.lock:
+            self.evicted_bytes += freed
+        if usage > self.high_water_mark:
+            log('Scratch disk is still {:.1%} full, nothing more can be evicted'.format(usage))
+        return freed
+
+    def summarize(self):
+        """
+        summarize: the bytes tracked on scratch by stage, the bytes evicted and deleted so far and
+        the peak fraction of the scratch disk used, for the run manifest
+        """
+        self.peak_usage = max(self.peak_usage, self.get_usage())
+        with self.lock:
+            tracked = dict()
+            for artifact in self.artifacts.values():
+                tracked[artifact['stage']] = tracked.get(artifact['stage'], 0) + artifact['size']
+            return {'tracked_bytes': tracked,
+                    'evicted_bytes': self.evicted_bytes,
+                    'deleted_bytes': self.deleted_bytes,
+                    'peak_usage': self.peak_usage,
+                    'high_water_mark': self.high_water_mark}
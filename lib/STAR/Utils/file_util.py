@@ -4,9 +4,11 @@ Utility functions to fetch files from various Workspace object types.
 Depends on the more general util.py that's here, too.
 """
 import re
-import fileinput
 import os.path
 import sys
+import bz2
+import gzip
+import numpy as np
 from pprint import pprint
 from SetAPI.SetAPIClient import SetAPI
 from AssemblyUtil.AssemblyUtilClient import AssemblyUtil
@@ -14,11 +16,11 @@ from ReadsUtils.ReadsUtilsClient import ReadsUtils
 from Workspace.WorkspaceClient import Workspace
 
 
-def fetch_fasta_from_genome(genome_ref, ws_url, callback_url):
+def fetch_fasta_from_genome(genome_ref, ws_url, callback_url, info_cache=None):
     """
     Returns an assembly or contigset as FASTA.
     """
-    if not check_ref_type(genome_ref, ['KBaseGenomes.Genome'], ws_url):
+    if not check_ref_type(genome_ref, ['KBaseGenomes.Genome'], ws_url, info_cache):
         raise ValueError("The given genome_ref {} is not a KBaseGenomes.Genome type!")
     # test if genome references an assembly type
     # do get_objects2 without data. get list of refs
@@ -42,13 +44,13 @@ def fetch_fasta_from_genome(genome_ref, ws_url, callback_url):
             assembly_ref.append(";".join(ref_info.get('paths')[idx]))
 
     if len(assembly_ref) == 1:
-        return fetch_fasta_from_assembly(assembly_ref[0], ws_url, callback_url)
+        return fetch_fasta_from_assembly(assembly_ref[0], ws_url, callback_url, info_cache)
     else:
         raise ValueError("Multiple assemblies found associated with the given genome ref {}! "
                          "Unable to continue.")
 
 
-def fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url):
+def fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url, info_cache=None):
     """
     From an assembly or contigset, this uses a data file util to build a FASTA file and return the
     path to it.
@@ -56,30 +58,30 @@ def fetch_fasta_from_assembly(assembly_ref, ws_url, callback_url):
     allowed_types = ['KBaseFile.Assembly',
                      'KBaseGenomeAnnotations.Assembly',
                      'KBaseGenomes.ContigSet']
-    if not check_ref_type(assembly_ref, allowed_types, ws_url):
+    if not check_ref_type(assembly_ref, allowed_types, ws_url, info_cache):
         raise ValueError("The reference {} cannot be used to fetch a FASTA file".format(assembly_ref))
     au = AssemblyUtil(callback_url)
     return au.get_assembly_as_fasta({'ref': assembly_ref})
 
 
-def fetch_fasta_from_object(ref, ws_url, callback_url):
+def fetch_fasta_from_object(ref, ws_url, callback_url, info_cache=None):
     """
     From the object given in ref, if it's either a KBaseGenomes.Genome or a
     KBaseGenomeAnnotations.Assembly, or a KBaseGenomes.ContigSet, this will download and return
     the path to a FASTA file made from its sequence.
     """
-    obj_type = get_object_type(ref, ws_url)
+    obj_type = get_object_type(ref, ws_url, info_cache)
     if "KBaseGenomes.Genome" in obj_type:
-        return fetch_fasta_from_genome(ref, ws_url, callback_url)
+        return fetch_fasta_from_genome(ref, ws_url, callback_url, info_cache)
     elif ("KBaseGenomeAnnotations.Assembly" in obj_type or 
           "KBaseGenomeAnnotations.Assembly-5.0" in obj_type or 
           "KBaseGenomes.ContigSet" in obj_type):
-        return fetch_fasta_from_assembly(ref, ws_url, callback_url)
+        return fetch_fasta_from_assembly(ref, ws_url, callback_url, info_cache)
     else:
         raise ValueError("Unable to fetch a FASTA file from an object of type {}".format(obj_type))
 
 
-def fetch_reads_refs_from_sampleset(ref, ws_url, callback_url, params):
+def fetch_reads_refs_from_sampleset(ref, ws_url, callback_url, params, info_cache=None):
     """
     From the given object ref, return a list of all reads objects that are a part of that
     object. E.g., if ref is a ReadsSet, return a list of all PairedEndLibrary or SingleEndLibrary
@@ -93,7 +95,7 @@ def fetch_reads_refs_from_sampleset(ref, ws_url, callback_url, params):
     for each reads object, but a single PairedEndLibrary may not have that info.
     If ref is already a Reads library, just returns a list with ref as a single element.
     """
-    obj_type = get_object_type(ref, ws_url)
+    obj_type = get_object_type(ref, ws_url, info_cache)
     ws = Workspace(ws_url)
     refs = list()
     refs_for_ws_info = list()
@@ -134,7 +136,10 @@ def fetch_reads_refs_from_sampleset(ref, ws_url, callback_url, params):
                          "which is a {}".format(ref, obj_type))
 
     # get object info so we can name things properly
-    infos = ws.get_object_info3({'objects': refs_for_ws_info})['infos']
+    if info_cache is not None:
+        infos = info_cache.get_infos([r['ref'] for r in refs_for_ws_info])
+    else:
+        infos = ws.get_object_info3({'objects': refs_for_ws_info})['infos']
 
     name_ext = '_alignment'
     if ('alignment_suffix' in params
@@ -175,7 +180,8 @@ def fetch_reads_from_reference(ref, callback_url):
         "file_fwd": path_to_file,
         "name": name of the reads,
         "file_rev": path_to_file, only if paired end,
-        "object_ref": reads reference for downstream convenience.
+        "object_ref": reads reference for downstream convenience,
+        "read_count": the number of reads (of all the mates) in the metadata, if known.
     }
     """
     try:
@@ -195,6 +201,8 @@ def fetch_reads_from_reference(ref, callback_url):
         }
         if reads_files.get("rev", None) is not None:
             ret_reads["file_rev"] = reads_files["rev"]
+        if reads_dl['files'][ref].get("read_count", None) is not None:
+            ret_reads["read_count"] = reads_dl['files'][ref]["read_count"]
         return ret_reads
     except:
         print("Unable to fetch a file from expected reads object {}".format(ref))
@@ -221,7 +229,7 @@ def check_reference(ref):
     return True
 
 
-def check_ref_type(ref, allowed_types, ws_url):
+def check_ref_type(ref, allowed_types, ws_url, info_cache=None):
     """
     Validates the object type of ref against the list of allowed types. If it passes, this
     returns True, otherwise False.
@@ -236,29 +244,136 @@ def check_ref_type(ref, allowed_types, ws_url):
     allowed_types = ["assembly", "genome"]
     returns True
     """
-    obj_type = get_object_type(ref, ws_url).lower()
+    obj_type = get_object_type(ref, ws_url, info_cache).lower()
     for t in allowed_types:
         if t.lower() in obj_type:
             return True
     return False
 
 
-def get_object_type(ref, ws_url):
+def get_object_type(ref, ws_url, info_cache=None):
     """
     Fetches and returns the typed object name of ref from the given workspace url.
     If that object doesn't exist, or there's another Workspace error, this raises a
     RuntimeError exception.
+    If an Object_Info_Cache is given, the object info is looked up through it.
     """
-    ws = Workspace(ws_url)
-    info = ws.get_object_info3({'objects': [{'ref': ref}]})
-    obj_info = info.get('infos', [[]])[0]
+    if info_cache is not None:
+        obj_info = info_cache.get_info(ref)
+    else:
+        ws = Workspace(ws_url)
+        info = ws.get_object_info3({'objects': [{'ref': ref}]})
+        obj_info = info.get('infos', [[]])[0]
     if len(obj_info) == 0:
         raise RuntimeError("An error occurred while fetching type info from the Workspace. "
                            "No information returned for reference {}".format(ref))
     return obj_info[2]
 
 
-def extract_geneCount_matrix(geneCount_filenames, output_dir):
+# ReadsPerGene.out.tab column holding the counts for each strandedness
+GENE_COUNT_COLUMNS = {'unstranded': 1, 'forward': 2, 'reverse': 3}
+# fraction of the stranded counts one strand must hold for 'auto' to call a sample stranded
+STRANDED_FRACTION = 0.8
+# number of genes converted to text at a time when writing the matrix
+WRITE_BLOCK_SIZE = 10000
+# counts below this are formatted through a lookup table
+COUNT_STR_TABLE_SIZE = 65536
+# novel junctions need this many uniquely mapped reads, over all the samples, to be inserted
+SJ_MIN_UNIQUE_READS = 3
+# the default limitSjdbInsertNsj of STAR, the most junctions it inserts into a genome
+SJ_MAX_JUNCTIONS = 1000000
+# SJ.out.tab strand codes, as sjdbFileChrStartEnd strands
+SJ_STRANDS = {'0': '.', '1': '+', '2': '-'}
+# bytes of FASTQ read at a time when counting and splitting reads files
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+# reads sampled from the head of a reads library for its read length distribution
+READ_LENGTH_SAMPLE_SIZE = 10000
+
+
+def get_fasta_stats(fasta_files):
+    """
+    Returns the total length (in bases) and the number of sequences of the given FASTA files.
+    """
+    genome_length = 0
+    n_contigs = 0
+    for fasta_file in fasta_files:
+        with open(fasta_file) as f:
+            for line in f:
+                if line.startswith('>'):
+                    n_contigs += 1
+                else:
+                    genome_length += len(line.rstrip())
+    return (genome_length, n_contigs)
+
+
+def read_geneCount_file(geneCount_file_path):
+    """
+    read_geneCount_file: read a STAR ReadsPerGene.out.tab file into its gene ids and an integer
+    array of its count columns (unstranded, forward, reverse), without the N_* summary lines
+    """
+    with open(geneCount_file_path) as f:
+        fields = f.read().split()
+    if len(fields) % 4 != 0:
+        raise ValueError("{} is not a STAR ReadsPerGene.out.tab file".format(geneCount_file_path))
+
+    gene_ids = fields[0::4]
+    # the summary lines (N_unmapped, N_multimapping, N_noFeature, N_ambiguous) come first
+    n_summary = 0
+    while n_summary < len(gene_ids) and gene_ids[n_summary].startswith('N_'):
+        n_summary += 1
+
+    del fields[0::4]
+    # let numpy parse all the counts at once
+    counts = np.fromstring(' '.join(fields[3 * n_summary:]), dtype=np.int32, sep=' ')
+    if counts.size != len(fields) - 3 * n_summary:
+        raise ValueError("{} holds counts that are not integers".format(geneCount_file_path))
+    return (gene_ids[n_summary:], counts.reshape((-1, 3)))
+
+
+def select_strandedness(counts, strandedness):
+    """
+    select_strandedness: pick the count column for strandedness ('unstranded', 'forward',
+    'reverse' or 'auto') from the counts returned by read_geneCount_file. 'auto' calls a sample
+    forward or reverse stranded if that strand holds most of its stranded counts, and falls back
+    to unstranded otherwise. Returns (strandedness, counts column).
+    """
+    if strandedness == 'auto':
+        forward = counts[:, GENE_COUNT_COLUMNS['forward'] - 1].sum(dtype=np.int64)
+        reverse = counts[:, GENE_COUNT_COLUMNS['reverse'] - 1].sum(dtype=np.int64)
+        strandedness = 'unstranded'
+        if forward + reverse > 0:
+            if forward >= STRANDED_FRACTION * (forward + reverse):
+                strandedness = 'forward'
+            elif reverse >= STRANDED_FRACTION * (forward + reverse):
+                strandedness = 'reverse'
+    if strandedness not in GENE_COUNT_COLUMNS:
+        raise ValueError("Unknown strandedness {}".format(strandedness))
+    return (strandedness, counts[:, GENE_COUNT_COLUMNS[strandedness] - 1])
+
+
+def write_geneCount_matrix(output_filename, sample_names, gene_ids, matrix):
+    """
+    write_geneCount_matrix: write the genes x samples count matrix as a TSV file, with the genes
+    in sorted order
+    """
+    order = sorted(range(len(gene_ids)), key=lambda i: gene_ids[i])
+    # most counts are small, so format them by looking up their text instead of one at a time
+    count_strs = np.array([str(i) for i in range(COUNT_STR_TABLE_SIZE)], dtype=object)
+    with open(output_filename, 'w') as fout:
+        fout.write("feature_ids\t" + "\t".join(sample_names) + "\n")
+        for start in range(0, len(order), WRITE_BLOCK_SIZE):
+            block_order = order[start:start + WRITE_BLOCK_SIZE]
+            block = matrix[block_order]
+            block_strs = count_strs[np.clip(block, 0, COUNT_STR_TABLE_SIZE - 1)]
+            large = (block < 0) | (block >= COUNT_STR_TABLE_SIZE)
+            if large.any():
+                block_strs[large] = [str(c) for c in block[large]]
+            fout.write("".join([gene_ids[i] + "\t" + "\t".join(row) + "\n"
+                                for (i, row) in zip(block_order, block_strs.tolist())]))
+    return output_filename
+
+
+def extract_geneCount_matrix(geneCount_filenames, output_dir, strandedness='unstranded'):
     """
     extract_expression_matrix: Grind through the ReadsPerGene.out.tab  files and output a single
     TSV file that shows the counts for each gene id across the input files
@@ -274,38 +389,288 @@ def extract_geneCount_matrix(geneCount_filenames, output_dir):
     count of antisense reads. With --quantMode TranscriptomeSAM GeneCounts, and get both the
     Aligned.toTranscriptome.out.bam and ReadsPerGene.out.tab outputs.
 
+    strandedness selects the column: 'unstranded', 'forward', 'reverse', or 'auto' to pick it
+    for each sample from its counts (see select_strandedness).
+
     Assuming each of the geneCount_filenames comes with its upper one level parent,
     i.e., in the pattern of '[reads_name]/ReadsPerGene.out.tab' as the way STAR outputs
     """
     print "\nExtracting geneCount results from these files:"
     pprint(geneCount_filenames)
 
-    counts = dict()
-
-    gene_count_file_paths = [os.path.join(output_dir, gcf) for gcf in geneCount_filenames]
-
-    fin = fileinput.input(files=set(gene_count_file_paths))
-    for line in fin:
-        if not line or line.startswith("N_"):
+    gene_ids = None
+    gene_index = None
+    matrix = None
+    for (sample_idx, gcf) in enumerate(geneCount_filenames):
+        (sample_gene_ids, counts) = read_geneCount_file(os.path.join(output_dir, gcf))
+        (sample_strandedness, column) = select_strandedness(counts, strandedness)
+        if strandedness == 'auto':
+            print "{}: using the {} counts".format(gcf, sample_strandedness)
+
+        if gene_ids is None:
+            gene_ids = sample_gene_ids
+            # filled one sample column at a time, so keep the columns contiguous
+            matrix = np.zeros((len(gene_ids), len(geneCount_filenames)), dtype=np.int32,
+                              order='F')
+
+        if sample_gene_ids == gene_ids:
+            # all the samples were quantified against the same annotations, in the same order
+            matrix[:, sample_idx] = column
             continue
-        line_arr = line.split("\t")
-        try:
-            counts[line_arr[0]][fileinput.filename()] = line_arr[1]
-        except KeyError:
-            counts[line_arr[0]] = dict()
-            counts[line_arr[0]][fileinput.filename()] = line_arr[1]
-    fin.close()
+
+        if gene_index is None:
+            gene_index = dict([(gid, i) for (i, gid) in enumerate(gene_ids)])
+        new_gene_ids = [gid for gid in sample_gene_ids if gid not in gene_index]
+        if new_gene_ids:
+            for gid in new_gene_ids:
+                gene_index[gid] = len(gene_ids)
+                gene_ids.append(gid)
+            matrix = np.asfortranarray(np.vstack([
+                        matrix, np.zeros((len(new_gene_ids), matrix.shape[1]), dtype=np.int32)]))
+        rows = np.array([gene_index[gid] for gid in sample_gene_ids], dtype=np.int64)
+        matrix[rows, sample_idx] = column
 
     output_filename = os.path.join(output_dir, 'ReadsPerGene_matrix.tsv')
-    fout = open(output_filename, 'w')
-    # print "feature_ids\t", "\t".join([os.path.dirname(fn) for fn in geneCount_filenames])
-    fout.write("feature_ids\t" + "\t".join(
-                            [os.path.dirname(fn) for fn in geneCount_filenames]) + "\n")
-    for fid in sorted(counts.iterkeys()):
-        counts2 = [counts[fid][filename] for filename in gene_count_file_paths]
-        # print fid, "\t", "\t".join(counts2)
-        fout.write(str(fid) + "\t" + "\t".join(counts2) + "\n")
-
-    fout.close()
-    return output_filename
+    return write_geneCount_matrix(output_filename,
+                                  [os.path.dirname(fn) for fn in geneCount_filenames],
+                                  gene_ids or [],
+                                  matrix if matrix is not None else np.zeros((0, 0), np.int32))
+
+
+def merge_junction_files(sj_files, output_file, min_unique_reads=SJ_MIN_UNIQUE_READS,
+                         max_junctions=SJ_MAX_JUNCTIONS):
+    """
+    merge_junction_files: pool the junctions of the STAR SJ.out.tab files of several samples into
+    one sjdbFileChrStartEnd file (chromosome, first and last intron base, strand), for inserting
+    them into a genome index. Only the novel canonical junctions are kept (the annotated ones are
+    in the index already), with at least min_unique_reads uniquely mapped reads over all the
+    samples; if there are more than max_junctions, the best supported ones.
+    Returns the number of junctions written.
+
+    SJ.out.tab columns: chromosome, intron start, intron end, strand (0: undefined, 1: +, 2: -),
+    intron motif (0: non-canonical), annotated (0/1), uniquely mapped reads, multi-mapping reads,
+    maximum spliced alignment overhang
+    """
+    unique_reads = dict()
+    for sj_file in sj_files:
+        with open(sj_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 9:
+                    continue
+                if fields[4] == '0' or fields[5] == '1':
+                    continue
+                junction = (fields[0], int(fields[1]), int(fields[2]), SJ_STRANDS[fields[3]])
+                unique_reads[junction] = unique_reads.get(junction, 0) + int(fields[6])
+
+    junctions = [j for j in unique_reads if unique_reads[j] >= min_unique_reads]
+    if len(junctions) > max_junctions:
+        junctions = sorted(junctions, key=lambda j: unique_reads[j],
+                           reverse=True)[:max_junctions]
+    with open(output_file, 'w') as f:
+        for junction in sorted(junctions):
+            f.write('{}\t{}\t{}\t{}\n'.format(*junction))
+    return len(junctions)
+
+
+def _open_fastq(fastq_file):
+    if fastq_file.endswith('.gz'):
+        return gzip.open(fastq_file, 'rb')
+    if fastq_file.endswith('.bz2'):
+        return bz2.BZ2File(fastq_file, 'rb')
+    return open(fastq_file, 'rb')
+
+
+def count_fastq_records(fastq_file):
+    """
+    count_fastq_records: the number of reads in a (possibly gzip or bzip2 compressed) FASTQ file
+    """
+    n_lines = 0
+    last_block = b''
+    with _open_fastq(fastq_file) as f:
+        for block in iter(lambda: f.read(FASTQ_BLOCK_SIZE), b''):
+            n_lines += block.count(b'\n')
+            last_block = block
+    if last_block and not last_block.endswith(b'\n'):
+        n_lines += 1
+    return n_lines // 4
+
+
+def sample_read_lengths(blocks, n_reads=READ_LENGTH_SAMPLE_SIZE):
+    """
+    sample_read_lengths: the read length distribution ({read length: number of reads}) of the
+    first n_reads reads of FASTQ content given as an iterable of blocks of it (e.g. the chunks
+    of a download), consuming no more blocks than those reads take
+    """
+    distribution = dict()
+    n_sampled = 0
+    line_no = 0
+    pending = b''
+    for block in blocks:
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line_no % 4 == 1:
+                length = len(line.rstrip(b'\r'))
+                distribution[length] = distribution.get(length, 0) + 1
+                n_sampled += 1
+                if n_sampled >= n_reads:
+                    return distribution
+            line_no += 1
+    if pending and line_no % 4 == 1:
+        # the last read of a file with no final newline
+        length = len(pending.rstrip(b'\r'))
+        distribution[length] = distribution.get(length, 0) + 1
+    return distribution
+
+
+def sample_fastq_read_lengths(fastq_file, n_reads=READ_LENGTH_SAMPLE_SIZE):
+    """
+    sample_fastq_read_lengths: the read length distribution of the first n_reads reads of a
+    (possibly gzip or bzip2 compressed) FASTQ file, see sample_read_lengths
+    """
+    with _open_fastq(fastq_file) as f:
+        return sample_read_lengths(iter(lambda: f.read(FASTQ_BLOCK_SIZE), b''), n_reads)
+
 
+def split_fastq_files(fastq_files, output_dir, n_shards, n_records=None):
+    """
+    split_fastq_files: split the FASTQ files of a reads library (one, or one per mate) into
+    n_shards shards of consecutive reads, decompressing them. The same reads of every mate file
+    go to the same shard, so that the mates stay paired and in order.
+    n_records: the number of reads in each file (e.g. from the metadata of the library), counted
+    by reading the first file when not given. Raises a ValueError if a file holds another number.
+    Returns the list of the shards, each the list of its FASTQ files in the order of fastq_files.
+    """
+    if n_records is None:
+        n_records = count_fastq_records(fastq_files[0])
+    n_shards = max(1, min(n_shards, n_records))
+    shard_lines = [4 * (n_records * (i + 1) // n_shards - n_records * i // n_shards)
+                   for i in range(n_shards)]
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    shards = [list() for i in range(n_shards)]
+    for fastq_file in fastq_files:
+        file_name = re.sub(r'\.(gz|bz2)$', '', os.path.basename(fastq_file))
+        shard = -1
+        lines_left = 0
+        fout = None
+        last_byte = b'\n'
+        with _open_fastq(fastq_file) as fin:
+            for block in iter(lambda: fin.read(FASTQ_BLOCK_SIZE), b''):
+                while block:
+                    if lines_left == 0:
+                        shard += 1
+                        if shard == n_shards:
+                            raise ValueError('{} holds more than {} reads'.format(
+                                             fastq_file, n_records))
+                        if fout is not None:
+                            fout.close()
+                        shards[shard].append(os.path.join(
+                            output_dir, 'shard_{}_{}'.format(shard, file_name)))
+                        fout = open(shards[shard][-1], 'wb')
+                        lines_left = shard_lines[shard]
+                    n_lines = block.count(b'\n')
+                    if n_lines < lines_left:
+                        fout.write(block)
+                        lines_left -= n_lines
+                        last_byte = block[-1:]
+                        block = b''
+                    else:
+                        # the end of this shard is in the block
+                        end = 0
+                        for i in range(lines_left):
+                            end = block.index(b'\n', end) + 1
+                        fout.write(block[:end])
+                        last_byte = block[end - 1:end]
+                        block = block[end:]
+                        lines_left = 0
+        if fout is not None:
+            if last_byte != b'\n':
+                fout.write(b'\n')
+                lines_left -= 1
+            fout.close()
+        if shard != n_shards - 1 or lines_left != 0:
+            raise ValueError('{} holds fewer than {} reads'.format(fastq_file, n_records))
+
+    return shards
+
+
+def merge_geneCount_files(geneCount_files, output_file):
+    """
+    merge_geneCount_files: add up the ReadsPerGene.out.tab files of the shards of a reads library,
+    mapped against the same genome index, into one with the counts of the whole library
+    """
+    gene_ids = None
+    counts = None
+    for geneCount_file in geneCount_files:
+        with open(geneCount_file) as f:
+            fields = f.read().split()
+        if len(fields) % 4 != 0:
+            raise ValueError("{} is not a STAR ReadsPerGene.out.tab file".format(geneCount_file))
+        if gene_ids is None:
+            gene_ids = fields[0::4]
+            counts = np.zeros((len(gene_ids), 3), dtype=np.int64)
+        elif fields[0::4] != gene_ids:
+            raise ValueError("{} does not count the same genes as {}".format(
+                             geneCount_file, geneCount_files[0]))
+        del fields[0::4]
+        counts += np.array(fields, dtype=np.int64).reshape((-1, 3))
+
+    with open(output_file, 'w') as f:
+        for (gene_id, row) in zip(gene_ids or [], counts.tolist() if counts is not None else []):
+            f.write('{}\t{}\t{}\t{}\n'.format(gene_id, *row))
+    return output_file
+
+
+def _passes_sj_filters(junction, reads, sj_filters):
+    # as STAR filters the junctions of SJ.out.tab, see its outSJfilter* parameters; annotated
+    # junctions always pass, the thresholds are by motif: non-canonical, GT/AG, GC/AG, AT/AC
+    if junction[5] == '1':
+        return True
+    motif = (int(junction[4]) + 1) // 2
+    (n_unique, n_total, overhang) = (reads[0], reads[0] + reads[1], reads[2])
+    intron_length = junction[2] - junction[1] + 1
+    intron_max = sj_filters['outSJfilterIntronMaxVsReadN']
+    return ((n_unique >= sj_filters['outSJfilterCountUniqueMin'][motif] or
+             n_total >= sj_filters['outSJfilterCountTotalMin'][motif]) and
+            overhang >= sj_filters['outSJfilterOverhangMin'][motif] and
+            (n_total > len(intron_max) or intron_length <= intron_max[n_total - 1]))
+
+
+def merge_sj_files(sj_files, output_file, chrom_names=None, sj_filters=None):
+    """
+    merge_sj_files: merge the SJ.out.tab files of the shards of a reads library, adding up the
+    reads of each junction and keeping the longest overhang. The junctions are written in the
+    order STAR writes them in: by chromosome, in the order of chrom_names (the chrName.txt of
+    the genome index), then by position.
+    sj_filters: the outSJfilterOverhangMin, outSJfilterCountUniqueMin, outSJfilterCountTotalMin
+    and outSJfilterIntronMaxVsReadN the merged junctions have to pass, as STAR would have applied
+    them to the whole library (the shards are mapped with filters every junction passes)
+    """
+    junctions = dict()
+    chrom_order = dict([(name, i) for (i, name) in enumerate(chrom_names or [])])
+    for sj_file in sj_files:
+        with open(sj_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 9:
+                    continue
+                chrom_order.setdefault(fields[0], len(chrom_order))
+                junction = (fields[0], int(fields[1]), int(fields[2])) + tuple(fields[3:6])
+                reads = [int(fields[6]), int(fields[7]), int(fields[8])]
+                if junction in junctions:
+                    merged = junctions[junction]
+                    reads = [merged[0] + reads[0], merged[1] + reads[1], max(merged[2], reads[2])]
+                junctions[junction] = reads
+
+    if sj_filters is not None:
+        junctions = dict([(j, reads) for (j, reads) in junctions.items()
+                          if _passes_sj_filters(j, reads, sj_filters)])
+
+    with open(output_file, 'w') as f:
+        for junction in sorted(junctions, key=lambda j: (chrom_order[j[0]], j[1], j[2])):
+            f.write('\t'.join([str(v) for v in junction] +
+                               [str(v) for v in junctions[junction]]) + '\n')
+    return output_file
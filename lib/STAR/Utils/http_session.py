@@ -0,0 +1,71 @@
+"""
+One requests Session shared by all the KBase service clients of this process, so that their calls
+reuse kept-alive connections instead of opening a new one each.
+The clients in lib/<module>/baseclient.py are generated by kb-sdk and call requests.post through
+their module-level _requests; install() points that at the shared session, which leaves the
+generated files as they are.
+"""
+import os
+import threading
+import importlib
+
+import requests
+
+# the maximum number of kept-alive connections per host, shared by all the clients
+POOL_SIZE = int(os.environ.get('KB_CLIENT_POOL_SIZE', 10))
+
+# the packages of the generated clients STAR calls
+CLIENT_PACKAGES = ['AssemblyUtil', 'DataFileUtil', 'ExpressionUtils', 'GenomeFileUtil',
+                   'KBParallel', 'KBaseReport', 'ReadsAlignmentUtils', 'ReadsUtils', 'STAR',
+                   'SetAPI', 'Workspace', 'kb_QualiMap']
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''
+    Returns the requests Session shared by this process. Its connection pools are thread-safe.
+    A forked process gets a new Session, as connections cannot be shared with the parent.
+    '''
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+                                                    pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+class _Session_Requests(object):
+    '''stands in for the requests module, sending its requests through the shared session'''
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return get_session().post(url, data=data, json=json, **kwargs)
+
+
+session_requests = _Session_Requests()
+
+
+def install(packages=CLIENT_PACKAGES):
+    '''
+    install: send the calls of the generated clients in packages through the shared session.
+    Returns the names of the baseclient modules it was installed into.
+    '''
+    installed = list()
+    for package in packages:
+        try:
+            baseclient = importlib.import_module(package + '.baseclient')
+        except ImportError:
+            continue
+        baseclient._requests = session_requests
+        installed.append(baseclient.__name__)
+    return installed
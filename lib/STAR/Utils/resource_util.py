@@ -0,0 +1,133 @@
+"""
+Utility functions to find out about the CPU, memory and disk resources available to this
+process, taking the limits of the container (cgroup) it runs in into account.
+"""
+import os
+import multiprocessing
+
+
+def _read_first_line(file_path):
+    try:
+        with open(file_path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_cgroup_cpu_limit():
+    """
+    Returns the number of CPUs allowed by the cgroup CPU quota, or None if there is no quota.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if cpu_max is not None:
+        (quota, period) = cpu_max.split()
+        if quota == 'max':
+            return None
+        return max(1, int(quota) // int(period))
+
+    # cgroup v1
+    quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return max(1, int(quota) // int(period))
+
+
+def get_cpu_count():
+    """
+    Returns the number of CPUs this process can use.
+    """
+    cpu_count = multiprocessing.cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_count = len(os.sched_getaffinity(0))
+
+    cgroup_cpus = get_cgroup_cpu_limit()
+    if cgroup_cpus is not None:
+        cpu_count = min(cpu_count, cgroup_cpus)
+
+    return cpu_count
+
+
+def _get_meminfo():
+    meminfo = dict()
+    with open('/proc/meminfo') as f:
+        for line in f:
+            fields = line.split()
+            # values are given in kB
+            meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    return meminfo
+
+
+def get_cgroup_memory_limit():
+    """
+    Returns the memory limit of the cgroup in bytes, or None if there is no limit.
+    """
+    # cgroup v2
+    limit = _read_first_line('/sys/fs/cgroup/memory.max')
+    if limit is None:
+        # cgroup v1, where no limit shows as a huge number
+        limit = _read_first_line('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if limit is None or limit == 'max':
+        return None
+
+    limit = int(limit)
+    if limit >= _get_meminfo()['MemTotal']:
+        return None
+    return limit
+
+
+def get_cgroup_memory_usage():
+    usage = _read_first_line('/sys/fs/cgroup/memory.current')
+    if usage is None:
+        usage = _read_first_line('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    if usage is None:
+        return None
+    return int(usage)
+
+
+def get_memory_limit():
+    """
+    Returns the total memory in bytes this process can use.
+    """
+    total_memory = _get_meminfo()['MemTotal']
+    cgroup_limit = get_cgroup_memory_limit()
+    if cgroup_limit is not None:
+        return min(total_memory, cgroup_limit)
+    return total_memory
+
+
+def get_available_memory():
+    """
+    Returns the memory in bytes that is currently available to this process.
+    """
+    meminfo = _get_meminfo()
+    available = meminfo.get('MemAvailable', meminfo['MemFree'])
+
+    cgroup_limit = get_cgroup_memory_limit()
+    cgroup_usage = get_cgroup_memory_usage()
+    if cgroup_limit is not None and cgroup_usage is not None:
+        available = min(available, max(0, cgroup_limit - cgroup_usage))
+
+    return available
+
+
+def get_free_disk_space(dir_path):
+    """
+    Returns the free disk space in bytes of the file system holding dir_path.
+    """
+    stat = os.statvfs(dir_path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_dir_size(dir_path):
+    """
+    Returns the total size in bytes of the files under dir_path.
+    """
+    total_size = 0
+    for root, folders, files in os.walk(dir_path):
+        for f in files:
+            file_path = os.path.join(root, f)
+            if os.path.isfile(file_path) and not os.path.islink(file_path):
+                total_size += os.path.getsize(file_path)
+    return total_size
@@ -2,9 +2,16 @@
 import unittest
 import os  # noqa: F401
 import os.path
+import sys
 import json  # noqa: F401
 import time
+import stat
+import threading
 import shutil
+import gzip
+import bz2
+import zipfile
+import requests
 
 from os import environ
 try:
@@ -19,12 +26,33 @@ from Workspace.WorkspaceClient import Workspace
 from STAR.STARImpl import STAR
 from STAR.Utils.STAR_Aligner import STAR_Aligner
 from STAR.Utils.STARUtils import STARUtils
+from STAR.Utils.Genome_Index_Cache import Genome_Index_Cache
+from STAR.Utils.STAR_Executor import STAR_Executor
+from STAR.Utils.Program_Runner import Program_Runner, Run_Result
+from STAR.Utils.Run_Manifest import Run_Manifest
+from STAR.Utils.Run_Journal import Run_Journal
+from STAR.Utils.Scratch_Manager import Scratch_Manager
+from STAR.Utils.Reads_Prefetcher import Reads_Prefetcher
+from STAR.Utils.Object_Info_Cache import Object_Info_Cache
+from STAR.Utils.Reads_Streamer import Reads_Streamer
+from STAR.Utils.Gene_Count_Matrix import Gene_Count_Matrix
+from STAR.Utils.file_util import (extract_geneCount_matrix, merge_junction_files,
+                                  split_fastq_files, merge_geneCount_files, merge_sj_files,
+                                  sample_read_lengths, sample_fastq_read_lengths,
+                                  fetch_reads_refs_from_sampleset, get_object_type)
+from STAR.Utils import resource_util
+from STAR.Utils import http_session
 from STAR.STARServer import MethodContext
 from STAR.authclient import KBaseAuth as _KBaseAuth
 from GenomeFileUtil.GenomeFileUtilClient import GenomeFileUtil
 from AssemblyUtil.AssemblyUtilClient import AssemblyUtil
 from ReadsUtils.ReadsUtilsClient import ReadsUtils
 
+# the fake KBase services of the benchmark stand in for Shock and the Workspace in unit tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark'))
+from fake_kbase import (Fake_KBase, start_server, PAIRED_END_TYPE,  # noqa: E402
+                        SINGLE_END_TYPE, ALIGNMENT_TYPE, READS_SET_TYPE)
+
 
 class STARTest(unittest.TestCase):
 
@@ -277,6 +305,39 @@ class STARTest(unittest.TestCase):
         self.assertNotEqual(res['output_directory'], None)
         self.assertNotEqual(res['output_info'], None)
 
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_STARImpl_plan_star")
+    def test_STARImpl_plan_star(self):
+        """
+        plan_star estimates the resources of a run_star request from the metadata of its inputs
+        """
+        genome_ref = self.loadGenome('./testReads/ecoli_genomic.gbff')
+        ss_ref = self.loadReadsSet()
+        params = {'readsset_ref': ss_ref,
+                  'genome_ref': genome_ref,
+                  'output_name': 'readsAlignment2',
+                  'output_workspace': self.getWsName(),
+                  'quantMode': 'Both',
+                  'alignmentset_suffix': '_alignment_set',
+                  'alignment_suffix': '_alignment',
+                  'concurrent_local_tasks': 2,
+                  'outSAMtype': 'BAM'}
+
+        plan = self.getImpl().plan_star(self.getContext(), params)[0]
+        pprint(plan)
+        self.assertEqual(plan['feasible'], 1)
+        self.assertEqual(plan['problems'], [])
+        # the E. coli genome
+        self.assertGreater(plan['genome_length'], 4000000)
+        self.assertGreaterEqual(plan['n_contigs'], 1)
+        self.assertEqual(plan['n_reads_libraries'], 2)
+        self.assertGreater(plan['index_ram'], plan['genome_length'])
+        self.assertGreaterEqual(plan['peak_ram'], plan['index_ram'])
+        self.assertGreater(plan['peak_scratch'], 0)
+        self.assertGreater(plan['wall_time'], 0)
+        self.assertIn(plan['concurrent_local_tasks'], [1, 2])
+        self.assertGreaterEqual(plan['runThreadN'], 1)
+
     # Uncomment to skip this test
     # @unittest.skip("skipped test_STARUtils_exec_index_map")
     def test_STARUtils_exec_index_map(self):
@@ -721,3 +782,1210 @@ class STARTest(unittest.TestCase):
         self.assertNotEqual(res['output_directory'], None)
         self.assertNotEqual(res['output_info'], None)
 
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Genome_Index_Cache")
+    def test_Genome_Index_Cache(self):
+        """
+        Genome_Index_Cache keys on the genome/annotation content and serves published entries
+        """
+        cache = Genome_Index_Cache(os.path.join(self.scratch, 'test_index_cache'))
+        genome_file1 = './testReads/test_long.fa'
+        genome_file2 = './testReads/test_reference.fa'
+
+        key1 = cache.make_key([genome_file1], None, None, STARUtils.STAR_VERSION)
+        self.assertEqual(key1, cache.make_key([genome_file1], None, 150,
+                                              STARUtils.STAR_VERSION))
+        self.assertNotEqual(key1, cache.make_key([genome_file2], None, None,
+                                                 STARUtils.STAR_VERSION))
+        self.assertNotEqual(key1, cache.make_key([genome_file1], None, None, 'STAR 2.7.0a'))
+        self.assertNotEqual(key1, cache.make_key([genome_file1], None, None,
+                                                 STARUtils.STAR_VERSION,
+                                                 {'genomeSAindexNbases': 8}))
+
+        self.assertIsNone(cache.lookup(key1))
+        with cache.lock(key1):
+            staging_dir = cache.new_staging_dir(key1)
+            open(os.path.join(staging_dir, 'genomeParameters.txt'), 'w').close()
+            entry_dir = cache.publish(key1, staging_dir, {'genomeFastaFiles': [genome_file1]})
+        self.assertEqual(cache.lookup(key1), entry_dir)
+        self.assertEqual(cache.get_info(key1)['key'], key1)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_STAR_Executor")
+    def test_STAR_Executor(self):
+        """
+        STAR_Executor retries out of memory failures with fewer threads and fails fast on bad input
+        """
+        executor = STAR_Executor(max_retries=2, backoff=0)
+        run_params = list()
+
+        def out_of_memory_once(params):
+            run_params.append(params)
+            if len(run_params) == 1:
+                return Run_Result(108, 1.0, 0, False, ['EXITING: fatal error trying to allocate ' +
+                                                       'genome arrays, exception thrown: ' +
+                                                       'std::bad_alloc'])
+            return Run_Result(0, 1.0, 0, False, [])
+
+        res = executor.execute(out_of_memory_once, {'runThreadN': 4})
+        self.assertEqual(res.exit_code, 0)
+        self.assertEqual([p['runThreadN'] for p in run_params], [4, 2])
+
+        def bad_input(params):
+            run_params.append(params)
+            return Run_Result(104, 1.0, 0, False, ['EXITING because of fatal input ERROR: ' +
+                                                   'could not open readFilesIn=missing.fastq'])
+
+        run_params = list()
+        with self.assertRaises(RuntimeError):
+            executor.execute(bad_input, {'runThreadN': 4})
+        self.assertEqual(len(run_params), 1)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_extract_geneCount_matrix")
+    def test_extract_geneCount_matrix(self):
+        """
+        extract_geneCount_matrix keeps the sample order and picks the requested count column
+        """
+        output_dir = os.path.join(self.scratch, 'test_geneCount_matrix')
+        tabs = {'reads_b': 'N_unmapped\t9\t9\t9\ngene_2\t10\t1\t9\ngene_1\t20\t2\t18\n',
+                'reads_a': 'N_unmapped\t9\t9\t9\ngene_1\t5\t5\t0\ngene_2\t7\t6\t1\n'}
+        gene_count_files = list()
+        for reads_name in ['reads_b', 'reads_a']:
+            os.makedirs(os.path.join(output_dir, reads_name))
+            gene_count_file = '{}/{}_ReadsPerGene.out.tab'.format(reads_name, reads_name)
+            with open(os.path.join(output_dir, gene_count_file), 'w') as f:
+                f.write(tabs[reads_name])
+            gene_count_files.append(gene_count_file)
+
+        matrix_file = extract_geneCount_matrix(gene_count_files, output_dir)
+        with open(matrix_file) as f:
+            self.assertEqual(f.read(), 'feature_ids\treads_b\treads_a\n' +
+                                       'gene_1\t20\t5\ngene_2\t10\t7\n')
+
+        matrix_file = extract_geneCount_matrix(gene_count_files, output_dir, 'auto')
+        with open(matrix_file) as f:
+            self.assertEqual(f.read(), 'feature_ids\treads_b\treads_a\n' +
+                                       'gene_1\t18\t5\ngene_2\t9\t6\n')
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Gene_Count_Matrix")
+    def test_Gene_Count_Matrix(self):
+        """
+        Gene_Count_Matrix picks up the samples checkpointed by an interrupted run of the same
+        request, and discards those checkpointed by any other run
+        """
+        output_dir = os.path.join(self.scratch, 'test_Gene_Count_Matrix')
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        tabs = {'reads_b': 'N_unmapped\t9\t9\t9\ngene_2\t10\t1\t9\ngene_1\t20\t2\t18\n',
+                'reads_a': 'N_unmapped\t9\t9\t9\ngene_1\t5\t5\t0\ngene_3\t7\t6\t1\n'}
+        gene_count_files = dict()
+        for (reads_name, tab) in tabs.items():
+            gene_count_files[reads_name] = os.path.join(output_dir,
+                                                        reads_name + '_ReadsPerGene.out.tab')
+            with open(gene_count_files[reads_name], 'w') as f:
+                f.write(tab)
+        sample_names = ['reads_b', 'reads_a']
+
+        matrix = Gene_Count_Matrix(output_dir, sample_names, 'unstranded', 'key_1', False)
+        matrix.add_sample('reads_b', gene_count_files['reads_b'])
+        self.assertFalse(matrix.is_complete())
+        self.assertRaises(RuntimeError, matrix.write)
+
+        # another request, or the same one not resumed, starts over
+        matrix = Gene_Count_Matrix(output_dir, sample_names, 'unstranded', 'key_2', True)
+        self.assertFalse(matrix.has_sample('reads_b'))
+        matrix.add_sample('reads_b', gene_count_files['reads_b'])
+        matrix = Gene_Count_Matrix(output_dir, sample_names, 'unstranded', 'key_2', False)
+        self.assertFalse(matrix.has_sample('reads_b'))
+        matrix.add_sample('reads_b', gene_count_files['reads_b'])
+
+        # the same request resumed picks up the counted samples
+        matrix = Gene_Count_Matrix(output_dir, sample_names, 'unstranded', 'key_2', True)
+        self.assertTrue(matrix.has_sample('reads_b'))
+        self.assertFalse(matrix.has_sample('reads_a'))
+        matrix.add_sample('reads_a', gene_count_files['reads_a'])
+        self.assertTrue(matrix.is_complete())
+        with open(matrix.write()) as f:
+            self.assertEqual(f.read(), 'feature_ids\treads_b\treads_a\n' +
+                                       'gene_1\t20\t5\ngene_2\t10\t0\ngene_3\t0\t7\n')
+        self.assertFalse(os.path.exists(os.path.join(output_dir,
+                                                     Gene_Count_Matrix.CHECKPOINT_DIR)))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Run_Manifest")
+    def test_Run_Manifest(self):
+        """
+        Run_Manifest sums up the spans of each stage and writes them to the manifest
+        """
+        run_manifest = Run_Manifest()
+        for reads_name in ['reads_a', 'reads_b']:
+            with run_manifest.span('mapping', reads_name) as span:
+                span.add_run(Run_Result(0, 1.0, 2000, False, [], 1.5))
+                span.add_bytes(100)
+        with self.assertRaises(ValueError):
+            with run_manifest.span('upload', 'reads_a'):
+                raise ValueError('upload failed')
+        run_manifest.set('runThreadN', 4)
+
+        stages = dict([(s['name'], s) for s in run_manifest.summarize()])
+        self.assertEqual(stages['mapping']['count'], 2)
+        self.assertEqual(stages['mapping']['bytes'], 200)
+        self.assertEqual(stages['mapping']['peak_rss'], 2000)
+        self.assertTrue(stages['mapping']['cpu_time'] >= 3.0)
+        self.assertEqual(stages['upload']['errors'], 1)
+
+        output_dir = os.path.join(self.scratch, 'test_Run_Manifest')
+        os.makedirs(output_dir)
+        with open(run_manifest.write(output_dir)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['settings'], {'runThreadN': 4})
+        self.assertEqual([s['label'] for s in manifest['spans']],
+                         ['reads_a', 'reads_b', 'reads_a'])
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_tune_genome_generate_params")
+    def test_tune_genome_generate_params(self):
+        """
+        tune_genome_generate_params sizes the index for a small genome and keeps given values
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        fasta_file = os.path.join(self.scratch, 'test_tune_genome.fa')
+        with open(fasta_file, 'w') as f:
+            for contig in ['contig_1', 'contig_2']:
+                f.write('>' + contig + '\n' + ('ACGTACGTAC' * 6 + '\n') * 1000)
+
+        params = star_utils.tune_genome_generate_params({'genomeFastaFiles': [fasta_file]})
+        # 120000 bases in 2 contigs
+        self.assertEqual(params['genomeSAindexNbases'], 7)
+        self.assertEqual(params['genomeChrBinNbits'], 15)
+        self.assertIsNone(params.get('genomeSAsparseD'))
+
+        params = star_utils.tune_genome_generate_params({'genomeFastaFiles': [fasta_file],
+                                                         'genomeSAindexNbases': 10,
+                                                         'runThreadN': 2})
+        self.assertEqual(params['genomeSAindexNbases'], 10)
+        self.assertIn('--genomeChrBinNbits', star_utils._construct_indexing_cmd(
+            star_utils.get_indexing_params(params, os.path.join(self.scratch, 'idx'))))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_select_sparse_sa")
+    def test_select_sparse_sa(self):
+        """
+        a genome too large for the available memory is indexed with a sparse suffix array
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        genome_length = 3000000000
+        self.assertGreater(star_utils.estimate_genome_generate_ram(genome_length, 14, 1),
+                           star_utils.estimate_genome_generate_ram(genome_length, 14, 2))
+
+        # a small genome is indexed as STAR would by default, whatever the memory
+        params = {'genomeSAindexNbases': 8}
+        star_utils._select_sparse_sa(params, 1000000)
+        self.assertEqual(params, {'genomeSAindexNbases': 8})
+
+        # pretend only a sixteenth of the memory can be used
+        star_utils.INDEX_RAM_FRACTION = 1.0 / 16
+        params = {'genomeSAindexNbases': 14}
+        star_utils._select_sparse_sa(params, genome_length)
+        self.assertEqual(params['limitGenomeGenerateRAM'],
+                         int(resource_util.get_memory_limit() / 16))
+        sparse_d = params['genomeSAsparseD']
+        self.assertTrue(sparse_d == star_utils.SPARSE_SA_STEPS[-1] or
+                        star_utils.estimate_genome_generate_ram(genome_length, 14, sparse_d) <=
+                        params['limitGenomeGenerateRAM'])
+        # the same on every run, whatever memory is free at the time
+        same_params = {'genomeSAindexNbases': 14}
+        star_utils._select_sparse_sa(same_params, genome_length)
+        self.assertEqual(same_params, params)
+
+        params = {'genomeSAindexNbases': 14, 'genomeSAsparseD': 2}
+        star_utils._select_sparse_sa(params, genome_length)
+        self.assertEqual(params['genomeSAsparseD'], 2)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_auto_threads")
+    def test_auto_threads(self):
+        """
+        runThreadN 0 or not given sizes the thread counts from the CPUs, given ones are kept
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        n_cpus = resource_util.get_cpu_count()
+
+        params = star_utils.set_auto_threads({}, n_concurrent=1)
+        self.assertEqual(params['runThreadN'], n_cpus)
+        self.assertEqual(params['outBAMsortingThreadN'], n_cpus)
+        params = star_utils.set_auto_threads({}, n_concurrent=n_cpus * 2)
+        self.assertEqual(params['runThreadN'], 1)
+
+        cmd = star_utils._construct_mapping_cmd({'STAR_Genome_index': self.scratch,
+                                                 'runThreadN': 4, 'outSAMtype': 'BAM',
+                                                 'outBAMsortingThreadN': 4})
+        self.assertEqual(cmd[cmd.index('--outBAMsortingThreadN') + 1], '4')
+
+        params = {'output_workspace': self.getWsName(), 'genome_ref': '1/1/1',
+                  'readsset_ref': '1/2/3', 'alignment_suffix': '_alignment',
+                  'set_reads_refs': []}
+        validated = star_utils.process_params(dict(params, runThreadN=0))
+        self.assertTrue(star_utils.auto_threads)
+        self.assertEqual(validated['runThreadN'], n_cpus)
+        self.assertEqual(star_utils.run_manifest.settings['mapping_threads'], n_cpus)
+
+        validated = star_utils.process_params(dict(params, runThreadN=3))
+        self.assertFalse(star_utils.auto_threads)
+        self.assertEqual(validated['runThreadN'], 3)
+        self.assertNotIn('outBAMsortingThreadN', validated)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_needs_sjdb_insertion")
+    def test_needs_sjdb_insertion(self):
+        """
+        a genome is only kept from being shared when the mappings would insert junctions into it
+        on the fly (two-pass mode, annotations not in the index), and mapping a shared genome
+        that way fails rather than leaving the junctions out
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        idx_dir = os.path.join(self.scratch, 'sjdb_insertion_index')
+        if os.path.isdir(idx_dir):
+            shutil.rmtree(idx_dir)
+        os.makedirs(idx_dir)
+        gtf_params = {'sjdbGTFfile': os.path.join(self.scratch, 'genome.gtf')}
+
+        self.assertFalse(star_utils.needs_sjdb_insertion(idx_dir, {}))
+        self.assertTrue(star_utils.needs_sjdb_insertion(idx_dir, gtf_params))
+        self.assertFalse(star_utils.load_shared_genome(idx_dir, gtf_params))
+
+        open(os.path.join(idx_dir, 'sjdbList.out.tab'), 'w').close()
+        self.assertFalse(star_utils.needs_sjdb_insertion(idx_dir, gtf_params))
+        self.assertFalse(star_utils.needs_sjdb_insertion(idx_dir, {}))
+        self.assertTrue(star_utils.needs_sjdb_insertion(idx_dir, {'twopassMode': 'Basic'}))
+
+        # a mapping that needs junctions inserted fails instead of running in one pass
+        map_params = {'STAR_Genome_index': idx_dir, 'runThreadN': 2,
+                      'genomeLoad': 'LoadAndKeep', 'twopassMode': 'Basic'}
+        with self.assertRaises(ValueError):
+            star_utils._construct_mapping_cmd(dict(map_params))
+        cmd = star_utils._construct_mapping_cmd(dict(map_params, genomeLoad='NoSharedMemory'))
+        self.assertEqual(cmd[cmd.index('--twopassMode') + 1], 'Basic')
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_merge_junction_files")
+    def test_merge_junction_files(self):
+        """
+        the novel canonical junctions of several samples are pooled into one
+        sjdbFileChrStartEnd file, counting their unique reads over all the samples
+        """
+        sj_dir = os.path.join(self.scratch, 'merge_junctions')
+        if not os.path.isdir(sj_dir):
+            os.makedirs(sj_dir)
+        sj_lines = [['chr1\t100\t200\t1\t1\t0\t2\t0\t30',   # novel, 2 + 2 unique reads
+                     'chr1\t300\t400\t2\t2\t1\t50\t0\t30',  # annotated
+                     'chr1\t500\t600\t0\t0\t0\t50\t0\t30',  # non-canonical
+                     'chr2\t100\t200\t1\t1\t0\t1\t9\t30'],  # too few unique reads
+                    ['chr1\t100\t200\t1\t1\t0\t2\t0\t30',
+                     'chr2\t700\t900\t2\t2\t0\t3\t0\t30']]
+        sj_files = list()
+        for (i, lines) in enumerate(sj_lines):
+            sj_files.append(os.path.join(sj_dir, 'sample_{}_SJ.out.tab'.format(i)))
+            with open(sj_files[-1], 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+        pooled_file = os.path.join(sj_dir, 'pooled_SJ.out.tab')
+        self.assertEqual(merge_junction_files(sj_files, pooled_file), 2)
+        with open(pooled_file) as f:
+            self.assertEqual(f.read(), 'chr1\t100\t200\t+\nchr2\t700\t900\t-\n')
+
+        self.assertEqual(merge_junction_files(sj_files, pooled_file, max_junctions=1), 1)
+        with open(pooled_file) as f:
+            self.assertEqual(f.read(), 'chr1\t100\t200\t+\n')
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Run_Journal")
+    def test_Run_Journal(self):
+        """
+        Run_Journal keeps the stages the samples got through across runs of the same request
+        """
+        journal_dir = os.path.join(self.scratch, 'run_journal_test')
+        if os.path.isdir(journal_dir):
+            shutil.rmtree(journal_dir)
+        params = {'readsset_ref': '1/2/3', 'genome_ref': '1/1/1', 'runThreadN': 4}
+        bam_file = os.path.join(self.scratch, 'run_journal_test.bam')
+        with open(bam_file, 'w') as f:
+            f.write('bam')
+
+        journal = Run_Journal(journal_dir, params)
+        self.assertFalse(journal.resumed)
+        journal.record('1/4/1', 'aligned', {'star_output': self.scratch}, [bam_file])
+        journal.record('1/4/1', 'uploaded', {'obj_ref': '1/5/1'})
+        journal.record('1/4/2', 'downloaded', {'file_fwd': 'gone.fq'}, ['gone.fq'])
+        with self.assertRaises(ValueError):
+            journal.record('1/4/2', 'counted')
+        # a run killed while writing a record
+        with open(journal.journal_file, 'a') as f:
+            f.write('{"sample": "1/4/2", "sta')
+
+        # the thread count does not change the results, so it does not change the journal
+        resumed = Run_Journal(journal_dir, dict(params, runThreadN=8))
+        self.assertEqual(resumed.journal_file, journal.journal_file)
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.get('1/4/1', 'uploaded'), {'obj_ref': '1/5/1'})
+        self.assertEqual(resumed.get('1/4/1', 'aligned'), {'star_output': self.scratch})
+        self.assertIsNone(resumed.get('1/4/2', 'downloaded'))
+        self.assertIsNone(resumed.get('1/4/3', 'aligned'))
+        os.remove(bam_file)
+        self.assertIsNone(resumed.get('1/4/1', 'aligned'))
+
+        other = Run_Journal(journal_dir, dict(params, genome_ref='1/1/2'))
+        self.assertIsNone(other.get('1/4/1', 'uploaded'))
+
+        resumed.discard()
+        self.assertFalse(os.path.exists(resumed.journal_file))
+        self.assertIsNone(Run_Journal(journal_dir, params).get('1/4/1', 'uploaded'))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_split_and_merge_shards")
+    def test_split_and_merge_shards(self):
+        """
+        a paired reads library is split into shards that keep the mates paired, and the gene
+        counts and junctions of the shards add up to those of the library
+        """
+        shard_dir = os.path.join(self.scratch, 'split_and_merge')
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+        fwd_file = os.path.join(shard_dir, 'reads_1.fastq.gz')
+        rev_file = os.path.join(shard_dir, 'reads_2.fastq')
+        fwd = ''.join(['@read_{0}/1\nACGT\n+\nIIII\n'.format(i) for i in range(10)])
+        rev = ''.join(['@read_{0}/2\nTGCA\n+\nIIII\n'.format(i) for i in range(10)])
+        with gzip.open(fwd_file, 'wb') as f:
+            f.write(fwd)
+        with open(rev_file, 'w') as f:
+            f.write(rev.rstrip('\n'))
+
+        shards = split_fastq_files([fwd_file, rev_file], os.path.join(shard_dir, 'shards'), 3)
+        self.assertEqual(len(shards), 3)
+        shard_text = [[open(shard_file).read() for shard_file in shard] for shard in shards]
+        self.assertEqual([t[0].count('@read_') for t in shard_text], [3, 3, 4])
+        self.assertEqual(''.join([t[0] for t in shard_text]), fwd)
+        self.assertEqual(''.join([t[1] for t in shard_text]), rev)
+        for (fwd_text, rev_text) in shard_text:
+            self.assertEqual(fwd_text.replace('/1\nACGT', ''), rev_text.replace('/2\nTGCA', ''))
+
+        # the number of reads given, as by the metadata of the library, is not counted again
+        self.assertEqual(split_fastq_files([fwd_file, rev_file],
+                                           os.path.join(shard_dir, 'shards'), 3, 10), shards)
+        with self.assertRaises(ValueError):
+            split_fastq_files([fwd_file, rev_file], os.path.join(shard_dir, 'shards'), 3, 9)
+        with self.assertRaises(ValueError):
+            split_fastq_files([fwd_file, rev_file], os.path.join(shard_dir, 'shards'), 3, 11)
+
+        with open(rev_file, 'a') as f:
+            f.write('\n@read_10/2\nTGCA\n+\nIIII\n')
+        with self.assertRaises(ValueError):
+            split_fastq_files([fwd_file, rev_file], os.path.join(shard_dir, 'shards'), 3)
+
+        gene_counts = ['N_unmapped\t1\t1\t1\ngene_1\t5\t3\t2\ngene_2\t4\t1\t3\n',
+                       'N_unmapped\t2\t2\t2\ngene_1\t1\t0\t1\ngene_2\t0\t0\t0\n']
+        junctions = ['chr2\t10\t20\t1\t1\t0\t2\t1\t30\n',
+                     'chr1\t10\t20\t2\t2\t1\t1\t0\t12\nchr2\t10\t20\t1\t1\t0\t3\t0\t40\n']
+        for i in range(2):
+            with open(os.path.join(shard_dir, 'shard_{}_ReadsPerGene.out.tab'.format(i)), 'w') as f:
+                f.write(gene_counts[i])
+            with open(os.path.join(shard_dir, 'shard_{}_SJ.out.tab'.format(i)), 'w') as f:
+                f.write(junctions[i])
+
+        merged_file = merge_geneCount_files(
+            [os.path.join(shard_dir, 'shard_{}_ReadsPerGene.out.tab'.format(i)) for i in range(2)],
+            os.path.join(shard_dir, 'ReadsPerGene.out.tab'))
+        with open(merged_file) as f:
+            self.assertEqual(f.read(),
+                             'N_unmapped\t3\t3\t3\ngene_1\t6\t3\t3\ngene_2\t4\t1\t3\n')
+        merged_file = merge_sj_files(
+            [os.path.join(shard_dir, 'shard_{}_SJ.out.tab'.format(i)) for i in range(2)],
+            os.path.join(shard_dir, 'SJ.out.tab'), ['chr1', 'chr2'])
+        with open(merged_file) as f:
+            self.assertEqual(f.read(), 'chr1\t10\t20\t2\t2\t1\t1\t0\t12\n' +
+                                       'chr2\t10\t20\t1\t1\t0\t5\t1\t40\n')
+
+        # the junctions are filtered as STAR filters those of the whole library: a non-canonical
+        # junction with 3 unique reads in all, but fewer in each shard, passes
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        sj_filters = star_utils.get_sj_filters({'outSJfilterOverhangMin': [30, 12, 12, 20]})
+        self.assertEqual(sj_filters['outSJfilterCountUniqueMin'], [3, 1, 1, 1])
+        junctions = ['chr1\t10\t20\t2\t0\t0\t2\t0\t31\nchr1\t30\t40\t1\t5\t0\t1\t0\t15\n' +
+                     'chr1\t50\t60\t1\t0\t0\t2\t0\t31\n',
+                     'chr1\t10\t20\t2\t0\t0\t1\t0\t12\nchr1\t70\t80\t1\t6\t1\t1\t0\t5\n' +
+                     'chr1\t100\t60100\t1\t1\t0\t1\t0\t40\n']
+        for i in range(2):
+            with open(os.path.join(shard_dir, 'shard_{}_SJ.out.tab'.format(i)), 'w') as f:
+                f.write(junctions[i])
+        merged_file = merge_sj_files(
+            [os.path.join(shard_dir, 'shard_{}_SJ.out.tab'.format(i)) for i in range(2)],
+            os.path.join(shard_dir, 'SJ.out.tab'), ['chr1'], sj_filters)
+        with open(merged_file) as f:
+            self.assertEqual(f.read(), 'chr1\t10\t20\t2\t0\t0\t3\t0\t31\n' +
+                                       'chr1\t70\t80\t1\t6\t1\t1\t0\t5\n')
+
+        # the shards keep every junction, and with BySJout a library is not split at all
+        cmd = star_utils._construct_mapping_cmd(dict(
+            STARUtils.SJ_COUNT_FILTERS_OFF, STAR_Genome_index=shard_dir, runThreadN=2,
+            readFilesIn=[fwd_file], outFileNamePrefix='shard_0_'))
+        self.assertEqual(cmd[cmd.index('--outSJfilterCountUniqueMin') + 1:][:4],
+                         ['1', '1', '1', '1'])
+        self.assertEqual(cmd[cmd.index('--outSJfilterIntronMaxVsReadN') + 1], '2147483647')
+        self.assertTrue(star_utils.filters_alignments_by_junctions({}))
+        self.assertTrue(star_utils.filters_alignments_by_junctions(
+                            {'outFilterType': '"BySJout"'}))
+        self.assertFalse(star_utils.filters_alignments_by_junctions({'outFilterType': 'Normal'}))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_sample_read_lengths")
+    def test_sample_read_lengths(self):
+        """
+        the read length distribution of the first reads of a FASTQ file, or of FASTQ content
+        split into blocks anywhere, reading no further than those reads
+        """
+        sample_dir = os.path.join(self.scratch, 'sample_read_lengths')
+        if os.path.isdir(sample_dir):
+            shutil.rmtree(sample_dir)
+        os.makedirs(sample_dir)
+        seqs = ['A' * (50 + i % 3) for i in range(10)]
+        reads = ''.join(['@read_{0}\n{1}\n+\n{2}\n'.format(i, seq, 'I' * len(seq))
+                         for (i, seq) in enumerate(seqs)])
+        fastq_file = os.path.join(sample_dir, 'reads.fastq.gz')
+        with gzip.open(fastq_file, 'wb') as f:
+            f.write(reads.rstrip('\n'))
+
+        self.assertEqual(sample_fastq_read_lengths(fastq_file), {50: 4, 51: 3, 52: 3})
+        self.assertEqual(sample_fastq_read_lengths(fastq_file, 4), {50: 2, 51: 1, 52: 1})
+
+        blocks = [reads[i:i + 7] for i in range(0, len(reads), 7)]
+        consumed = list()
+
+        def block_source():
+            for block in blocks:
+                consumed.append(block)
+                yield block
+        self.assertEqual(sample_read_lengths(block_source(), 2), {50: 1, 51: 1})
+        self.assertLess(len(''.join(consumed)), reads.index('@read_2') + 7)
+        self.assertEqual(sample_read_lengths(iter(blocks)), {50: 4, 51: 3, 52: 3})
+        self.assertEqual(sample_read_lengths(iter([])), {})
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_insert_junctions")
+    def test_insert_junctions(self):
+        """
+        junctions are inserted into an annotation-free index, as STAR does on the fly when
+        mapping, into a new index that leaves the one they were inserted into as it was
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        insert_dir = os.path.join(self.scratch, 'insert_junctions')
+        if os.path.isdir(insert_dir):
+            shutil.rmtree(insert_dir)
+        base_idx_dir = os.path.join(insert_dir, 'base_index')
+        os.makedirs(base_idx_dir)
+        star_utils.run_indexing_with_retry(star_utils.get_indexing_params(
+            {'runThreadN': 2, 'genomeFastaFiles': ['./testReads/test_reference.fa'],
+             'genomeSAindexNbases': 8}, base_idx_dir))
+        self.assertFalse(star_utils.index_has_annotations(base_idx_dir))
+
+        sj_file = os.path.join(insert_dir, 'SJ.tab')
+        with open(sj_file, 'w') as f:
+            f.write('SEQUENCE\t1000\t2000\t+\nSEQUENCE\t5000\t7000\t-\n')
+        params = {'runThreadN': 2, 'sjdbFileChrStartEnd': sj_file, 'sjdbOverhang': 49}
+        cmd = star_utils._construct_junction_insertion_cmd(dict(
+            params, STAR_Genome_index=base_idx_dir, readFilesIn=['reads.fastq'],
+            outFileNamePrefix=insert_dir + '/'))
+        self.assertEqual(cmd[cmd.index('--sjdbInsertSave') + 1], 'All')
+        self.assertEqual(cmd[cmd.index('--sjdbOverhang') + 1], '49')
+        self.assertNotIn('--sjdbGTFfile', cmd)
+
+        idx_dir = star_utils.insert_junctions(base_idx_dir, params,
+                                              os.path.join(insert_dir, 'inserted'))
+        self.assertEqual(idx_dir, os.path.join(insert_dir, 'inserted', '_STARgenome'))
+        self.assertTrue(os.path.isfile(os.path.join(idx_dir, 'genomeParameters.txt')))
+        self.assertTrue(star_utils.index_has_annotations(idx_dir))
+        self.assertFalse(star_utils.index_has_annotations(base_idx_dir))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Scratch_Manager")
+    def test_Scratch_Manager(self):
+        """
+        Scratch_Manager deletes the artifacts of a sample once asked to, and evicts the least
+        recently used artifacts and cached indexes not in use above the high-water mark
+        """
+        scratch_dir = os.path.join(self.scratch, 'test_scratch_manager')
+        if os.path.isdir(scratch_dir):
+            shutil.rmtree(scratch_dir)
+        os.makedirs(scratch_dir)
+        cache = Genome_Index_Cache(os.path.join(scratch_dir, 'index_cache'))
+        for key in ['old_index', 'used_index']:
+            with cache.lock(key):
+                staging_dir = cache.new_staging_dir(key)
+                with open(os.path.join(staging_dir, 'genomeParameters.txt'), 'w') as f:
+                    f.write('x' * 100)
+                cache.publish(key, staging_dir, {})
+        os.utime(cache.get_entry_dir('old_index'), (1, 1))
+        use_file = cache.acquire('used_index')
+
+        def make_file(name, size):
+            file_path = os.path.join(scratch_dir, name)
+            with open(file_path, 'w') as f:
+                f.write('x' * size)
+            return file_path
+
+        # above any high-water mark, so that everything that may be evicted is
+        scratch_manager = Scratch_Manager(scratch_dir, 1e-9, cache)
+        reads_file = scratch_manager.track(make_file('reads.fq', 10), 'download_reads', 'r1')
+        bam_file = scratch_manager.track(make_file('r1.bam', 20), 'mapping', 'r1')
+        index_dir = scratch_manager.track(make_file('index', 30), 'indexing')
+        first_pass = scratch_manager.track(make_file('first_pass', 40), 'first_pass',
+                                           in_use=False)
+        self.assertIsNone(scratch_manager.track(os.path.join(scratch_dir, 'none'), 'mapping'))
+
+        self.assertEqual(scratch_manager.delete_owned('r1'), 30)
+        self.assertFalse(os.path.exists(reads_file))
+        self.assertFalse(os.path.exists(bam_file))
+
+        # the entry of the cache holds its info besides the index
+        evicted_bytes = scratch_manager.make_room()
+        self.assertGreater(evicted_bytes, 140)
+        self.assertFalse(os.path.exists(first_pass))
+        self.assertTrue(os.path.exists(index_dir))
+        self.assertIsNone(cache.lookup('old_index'))
+        self.assertIsNotNone(cache.lookup('used_index'))
+
+        cache.release(use_file)
+        scratch_manager.release(index_dir)
+        evicted_bytes += scratch_manager.make_room()
+        self.assertFalse(os.path.exists(index_dir))
+        self.assertIsNone(cache.lookup('used_index'))
+
+        summary = scratch_manager.summarize()
+        self.assertEqual(summary['deleted_bytes'], 30)
+        self.assertEqual(summary['evicted_bytes'], evicted_bytes)
+        self.assertGreater(evicted_bytes, 270)
+        self.assertEqual(summary['tracked_bytes'], {})
+
+        # nothing is evicted below the high-water mark
+        scratch_manager = Scratch_Manager(scratch_dir, 1.0)
+        first_pass = scratch_manager.track(make_file('first_pass', 40), 'first_pass',
+                                           in_use=False)
+        self.assertEqual(scratch_manager.make_room(), 0)
+        self.assertTrue(os.path.exists(first_pass))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_single_run_report_keeps_bam")
+    def test_single_run_report_keeps_bam(self):
+        """
+        the intermediates of an uploaded alignment stay on scratch until the report of the run has
+        packaged them, and those of a member of a sample set until the report of the set has
+        """
+        star_aligner = STAR_Aligner(self.cfg, self.getContext().provenance())
+        (star_aligner.star_idx_dir, star_aligner.star_out_dir) = \
+            star_aligner.star_utils.create_star_dirs(
+                os.path.join(self.scratch, 'single_run_report'))
+        star_aligner.star_utils.run_indexing_with_retry(
+            star_aligner.star_utils.get_indexing_params(
+                {'runThreadN': 2, 'genomeFastaFiles': ['./testReads/test_reference.fa'],
+                 'genomeSAindexNbases': 8}, star_aligner.star_idx_dir))
+
+        # stand-ins for the workspace upload and the report, which packages the outputs
+        packaged = dict()
+
+        def upload_alignment(params, rds, reads_info, output_bam_file):
+            return {'obj_ref': '1/2/3'}
+
+        def generate_report(run_output_info, params):
+            output_files = star_aligner.star_utils._generate_output_file_list(
+                                run_output_info['index_dir'], run_output_info['output_dir'])
+            with zipfile.ZipFile(output_files[-1]['path']) as f:
+                packaged['star_output'] = [os.path.basename(name) for name in f.namelist()]
+            return {'name': 'report', 'ref': '1/3/1'}
+        star_aligner.star_utils.upload_STARalignment = upload_alignment
+        star_aligner.star_utils.generate_report_for_single_run = generate_report
+
+        params = {'alignment_suffix': '_alignment', 'outSAMtype': 'BAM', 'create_report': 1,
+                  'runThreadN': 2, STARUtils.PARAM_IN_READS: 'reads_ref',
+                  STARUtils.SET_READS: [{'ref': 'reads_ref',
+                                         'alignment_output_name': 'reads_alignment'}]}
+        # the reads are deleted once mapped, as if downloaded
+        reads_file = os.path.join(self.scratch, 'single_run_report', 'reads.fq')
+        shutil.copy('./testReads/small.forward.fq', reads_file)
+        ret = star_aligner._star_run_single(dict(params), {'file_fwd': reads_file})
+        bam_file = ret['output_info']['output_bam_file']
+        self.assertIn(os.path.basename(bam_file), packaged['star_output'])
+        self.assertFalse(os.path.exists(bam_file))
+
+        # the report of the set packages the outputs of its members
+        params['create_report'] = 0
+        shutil.copy('./testReads/small.forward.fq', reads_file)
+        ret = star_aligner._star_run_single(dict(params), {'file_fwd': reads_file},
+                                            in_set=True)
+        bam_file = ret['output_info']['output_bam_file']
+        self.assertTrue(os.path.exists(bam_file))
+        star_aligner.scratch_manager.delete_owned('reads_ref')
+        self.assertFalse(os.path.exists(bam_file))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_http_session")
+    def test_http_session(self):
+        """
+        the generated clients send their calls through the one session of the process once it is
+        installed into them
+        """
+        self.assertIs(http_session.get_session(), http_session.get_session())
+        self.assertIn('Workspace.baseclient', http_session.install())
+        self.assertEqual(http_session.install(['NoSuchClient']), [])
+
+        import Workspace.baseclient
+        self.assertIs(Workspace.baseclient._requests, http_session.session_requests)
+        # the rest of the requests module is still there for the generated code
+        self.assertIs(Workspace.baseclient._requests.utils, requests.utils)
+        adapter = http_session.get_session().get_adapter('https://kbase.us')
+        self.assertEqual(adapter._pool_maxsize, http_session.POOL_SIZE)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Reads_Streamer")
+    def test_Reads_Streamer(self):
+        """
+        Reads_Streamer decompresses gzip and bzip2 reads, made of several members or streams, into
+        named pipes as it downloads them, removes the pipes when closed, whether STAR read them
+        or not, and reports the reads it failed to stream
+        """
+        stream_dir = os.path.join(self.scratch, 'test_Reads_Streamer')
+        if os.path.isdir(stream_dir):
+            shutil.rmtree(stream_dir)
+        os.makedirs(stream_dir)
+        # more than a pipe holds, so that a writer only ends once its pipe is read or closed
+        reads = [''.join(['@read_{0}\n{1}\n+\n{2}\n'.format(i, 'ACGT' * 25, 'I' * 100)
+                          for i in range(j, 20000, 2)]) for j in range(2)]
+
+        def write_reads(name, content):
+            file_path = os.path.join(stream_dir, name)
+            if name.endswith('.gz'):
+                # concatenated gzip members, as written by parallel compressors
+                with open(file_path, 'wb') as f:
+                    for part in [content[:1000], content[1000:]]:
+                        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                            gz.write(part)
+            elif name.endswith('.bz2'):
+                with open(file_path, 'wb') as f:
+                    for part in [content[:1000], content[1000:]]:
+                        f.write(bz2.compress(part))
+            else:
+                with open(file_path, 'w') as f:
+                    f.write(content)
+            return file_path
+
+        fake_kbase = Fake_KBase(stream_dir)
+        server = start_server(fake_kbase)
+        try:
+            streamer = Reads_Streamer(fake_kbase.url, stream_dir)
+            for ext in ['', '.gz', '.bz2']:
+                data = {'lib1': {'file': fake_kbase.add_shock_node(
+                                    write_reads('reads_fwd.fq' + ext, reads[0]))},
+                        'lib2': {'file': fake_kbase.add_shock_node(
+                                    write_reads('reads_rev.fq' + ext, reads[1]))}}
+                reads_ref = fake_kbase.save_object('reads' + ext, PAIRED_END_TYPE, data)
+                sources = streamer.get_stream_sources(reads_ref)
+                self.assertEqual(sources['compression'], ext)
+
+                reads_info = streamer.open(sources)
+                self.assertEqual(reads_info['readFilesCommand'], 'cat')
+                for (key, content) in [('file_fwd', reads[0]), ('file_rev', reads[1])]:
+                    self.assertTrue(stat.S_ISFIFO(os.stat(reads_info[key]).st_mode))
+                    with open(reads_info[key]) as f:
+                        self.assertEqual(f.read(), content)
+                streamer.close()
+                self.assertFalse(os.path.exists(os.path.dirname(reads_info['file_fwd'])))
+
+            # STAR failed before it opened the pipes
+            reads_info = streamer.open(sources)
+            self.assertRaises(RuntimeError, streamer.close)
+            self.assertFalse(os.path.exists(os.path.dirname(reads_info['file_fwd'])))
+
+            # a reads file that cannot be downloaded
+            data = {'lib': {'file': fake_kbase.add_shock_node(
+                                os.path.join(stream_dir, 'missing.fq'))}}
+            data['lib']['file']['id'] = 'no_such_node'
+            sources = streamer.get_stream_sources(
+                            fake_kbase.save_object('missing', SINGLE_END_TYPE, data))
+            reads_info = streamer.open(sources)
+            self.assertNotIn('file_rev', reads_info)
+            with open(reads_info['file_fwd']) as f:
+                self.assertEqual(f.read(), '')
+            self.assertRaises(RuntimeError, streamer.close)
+            self.assertEqual(streamer.errors, [])
+
+            # interleaved reads are downloaded instead
+            data['interleaved'] = 1
+            self.assertIsNone(streamer.get_stream_sources(
+                                fake_kbase.save_object('interleaved', SINGLE_END_TYPE, data)))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_zip_folder")
+    def test_zip_folder(self):
+        """
+        _zip_folder stores the files that are compressed already and the dense files of a genome
+        index, compresses the others and keeps the folder layout and the contents of the files
+        """
+        star_utils = STARUtils(self.scratch, self.wsURL, self.callback_url, self.srv_wiz_url,
+                               self.getContext().provenance())
+        zip_dir = os.path.join(self.scratch, 'test_zip_folder')
+        if os.path.isdir(zip_dir):
+            shutil.rmtree(zip_dir)
+        out_dir = os.path.join(zip_dir, 'star_output')
+        os.makedirs(os.path.join(out_dir, 'reads_1'))
+        os.makedirs(os.path.join(out_dir, 'empty'))
+        os.makedirs(os.path.join(out_dir, 'star_index'))
+        contents = {'star_index/SA': os.urandom(50000),
+                    'star_index/chrName.txt': 'chr1\nchr2\n' * 1000,
+                    'reads_1/reads_1_Aligned.sortedByCoord.out.bam': os.urandom(100000),
+                    'reads_1/reads_1_SJ.out.tab': 'chr1\t10\t20\t1\t1\t0\t2\t0\t30\n' * 10000,
+                    'reads_1/reads_1_Log.final.out': 'Uniquely mapped reads % |\t90%\n' * 100,
+                    'manifest.json': ''}
+        for (name, content) in contents.items():
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                f.write(content)
+
+        zip_file = os.path.join(zip_dir, 'star_output.zip')
+        star_utils._zip_folder(out_dir, zip_file)
+        self.assertEqual(sorted(os.listdir(zip_dir)), ['star_output', 'star_output.zip'])
+        with zipfile.ZipFile(zip_file) as f:
+            self.assertIsNone(f.testzip())
+            infos = dict([(info.filename, info) for info in f.infolist()])
+            self.assertIn('star_output/empty/', infos)
+            for (name, content) in contents.items():
+                member = os.path.join(os.path.basename(os.path.dirname(
+                                        os.path.join(out_dir, name))), os.path.basename(name))
+                self.assertEqual(f.read(member), content)
+                self.assertEqual(infos[member].file_size, len(content))
+            bam_info = infos['reads_1/reads_1_Aligned.sortedByCoord.out.bam']
+            self.assertEqual(bam_info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos['star_index/SA'].compress_type, zipfile.ZIP_STORED)
+            for name in ['reads_1/reads_1_SJ.out.tab', 'star_index/chrName.txt']:
+                self.assertEqual(infos[name].compress_type, zipfile.ZIP_DEFLATED)
+                self.assertLess(infos[name].compress_size, infos[name].file_size / 10)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_set_sjdb_overhang")
+    def test_set_sjdb_overhang(self):
+        """
+        the read lengths are sampled for sjdbOverhang only when splice junctions are inserted and
+        sjdbOverhang is not given
+        """
+        star_aligner = STAR_Aligner(self.cfg, self.getContext().provenance())
+        sampled = list()
+
+        def sample_read_lengths(reads_ref):
+            sampled.append(reads_ref)
+            return {100: 5, 150: 3} if reads_ref == 'reads_1' else {75: 8}
+        star_aligner._sample_read_lengths = sample_read_lengths
+
+        def reads_params(**params):
+            params.update({STARUtils.PARAM_IN_READS: 'set_ref',
+                           STARUtils.SET_READS: [{'ref': 'reads_1'}, {'ref': 'reads_2'}]})
+            return params
+
+        # nothing to insert, sjdbOverhang is of no use
+        params = reads_params()
+        star_aligner._set_sjdb_overhang(params)
+        self.assertNotIn('sjdbOverhang', params)
+        self.assertEqual(sampled, [])
+
+        # given
+        params = reads_params(sjdbGTFfile='genome.gtf', sjdbOverhang=49)
+        star_aligner._set_sjdb_overhang(params)
+        self.assertEqual(params['sjdbOverhang'], 49)
+        self.assertEqual(sampled, [])
+
+        for sjdb_params in [{'sjdbGTFfile': 'genome.gtf'}, {'sjdbFileChrStartEnd': 'SJ.out.tab'},
+                            {'twopassMode': 'Basic'}, {'twopassMode': 'Batch'}]:
+            del sampled[:]
+            params = reads_params(**sjdb_params)
+            star_aligner._set_sjdb_overhang(params)
+            self.assertEqual(params['sjdbOverhang'], 149)
+            self.assertEqual(sorted(sampled), ['reads_1', 'reads_2'])
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Reads_Prefetcher")
+    def test_Reads_Prefetcher(self):
+        """
+        Reads_Prefetcher hands out the libraries in their order whatever order they download in,
+        prefetches only while scratch has room, re-raises a failed download when its turn comes
+        and removes the libraries it prefetched for a consumer that stopped
+        """
+        fetch_dir = os.path.join(self.scratch, 'prefetch')
+        if os.path.isdir(fetch_dir):
+            shutil.rmtree(fetch_dir)
+        os.makedirs(fetch_dir)
+        reads_refs = [{'ref': 'reads_{}'.format(idx)} for idx in range(5)]
+
+        def fake_fetcher(fetched, failing_ref=None, started=None):
+            '''
+            a fetch function that writes a reads file of 1000 bytes into fetch_dir, the later
+            libraries faster, records the refs it fetched in fetched, sets the started[ref] Event
+            as it starts and fails for failing_ref
+            '''
+            def fetch_reads(reads):
+                if started is not None:
+                    started[reads['ref']].set()
+                time.sleep(0.05 * (5 - int(reads['ref'].split('_')[-1])))
+                fetched.append(reads['ref'])
+                if reads['ref'] == failing_ref:
+                    raise ValueError('Failed to download {}'.format(failing_ref))
+                reads_file = os.path.join(fetch_dir, reads['ref'] + '.fq')
+                with open(reads_file, 'w') as f:
+                    f.write('A' * 1000)
+                return {'file_fwd': reads_file, 'file_rev': None}
+            return fetch_reads
+
+        # 1) the order of reads_refs, each fetched once
+        fetched = list()
+        prefetcher = Reads_Prefetcher(fake_fetcher(fetched),
+                                      reads_refs, 3, fetch_dir)
+        prefetcher.MIN_FREE_BYTES = 0
+        yielded = [(reads['ref'], os.path.basename(reads_info['file_fwd']))
+                   for (reads, reads_info) in prefetcher]
+        self.assertEqual(yielded, [(r['ref'], r['ref'] + '.fq') for r in reads_refs])
+        self.assertEqual(sorted(fetched), [r['ref'] for r in reads_refs])
+        self.assertEqual(prefetcher.largest_reads_size, 1000)
+
+        # 2) the room check: statvfs free space against the downloads in flight
+        fs_stat = os.statvfs(fetch_dir)
+        free_bytes = fs_stat.f_bavail * fs_stat.f_frsize
+        reads_size = 100 * 1024 * 1024
+        prefetcher = Reads_Prefetcher(None, reads_refs, 3, fetch_dir)
+        prefetcher.largest_reads_size = reads_size
+        prefetcher.MIN_FREE_BYTES = free_bytes - 3 * reads_size
+        self.assertTrue(prefetcher._has_room(0))
+        self.assertFalse(prefetcher._has_room(1))
+
+        # no room, each library is fetched when its turn comes
+        started = dict([(r['ref'], threading.Event()) for r in reads_refs])
+        fetched = list()
+        prefetcher = Reads_Prefetcher(
+                        fake_fetcher(fetched, started=started),
+                        reads_refs, 3, fetch_dir)
+        prefetcher.MIN_FREE_BYTES = free_bytes + 1024 * 1024 * 1024
+        for (idx, (reads, reads_info)) in enumerate(prefetcher):
+            time.sleep(0.1)
+            self.assertEqual([r['ref'] for r in reads_refs if started[r['ref']].is_set()],
+                             [r['ref'] for r in reads_refs[:idx + 1]])
+        # room for all, up to depth libraries are fetched ahead
+        started = dict([(r['ref'], threading.Event()) for r in reads_refs])
+        prefetcher = Reads_Prefetcher(
+                        fake_fetcher(list(), started=started),
+                        reads_refs, 3, fetch_dir)
+        prefetcher.MIN_FREE_BYTES = 0
+        for (reads, reads_info) in prefetcher:
+            for ref in ['reads_1', 'reads_2', 'reads_3']:
+                self.assertTrue(started[ref].wait(5))
+            self.assertFalse(started['reads_4'].is_set())
+            break
+
+        # 3) a failed download is raised when its turn comes, the prefetched ones are removed
+        shutil.rmtree(fetch_dir)
+        os.makedirs(fetch_dir)
+        prefetcher = Reads_Prefetcher(
+                        fake_fetcher(list(), failing_ref='reads_1'),
+                        reads_refs, 3, fetch_dir)
+        prefetcher.MIN_FREE_BYTES = 0
+        yielded = list()
+        with self.assertRaisesRegexp(ValueError, 'Failed to download reads_1'):
+            for (reads, reads_info) in prefetcher:
+                yielded.append(reads['ref'])
+        self.assertEqual(yielded, ['reads_0'])
+        self.assertEqual(os.listdir(fetch_dir), ['reads_0.fq'])
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Program_Runner")
+    def test_Program_Runner(self):
+        """
+        Program_Runner kills a program that stays silent for longer than inactivity_timeout,
+        with its children, and reports the peak RSS of a program from its own resource usage
+        """
+        runner_dir = os.path.join(self.scratch, 'program_runner')
+        if os.path.isdir(runner_dir):
+            shutil.rmtree(runner_dir)
+        os.makedirs(runner_dir)
+        prog_runner = Program_Runner(sys.executable, runner_dir, inactivity_timeout=1)
+        prog_runner.POLL_INTERVAL = 0.2
+
+        # 1) silent, with a child in its process group
+        sleeper = ("import subprocess, sys, time\n"
+                   "child = subprocess.Popen(['sleep', '60'])\n"
+                   "open('child.pid', 'w').write(str(child.pid))\n"
+                   "print('started'); sys.stdout.flush()\n"
+                   "time.sleep(60)\n")
+        run_result = prog_runner.execute([sys.executable, '-c', sleeper])
+        self.assertTrue(run_result.timed_out)
+        self.assertEqual(run_result.exit_code, -9)
+        self.assertLess(run_result.wall_time, 30)
+        self.assertEqual(run_result.output_tail, ['started'])
+        with open(os.path.join(runner_dir, 'child.pid')) as f:
+            child_stat = '/proc/{}/stat'.format(f.read())
+        # killed, if not reaped yet
+        for _ in range(50):
+            if not os.path.isfile(child_stat):
+                break
+            with open(child_stat) as f:
+                if f.read().split(')')[-1].split()[0] == 'Z':
+                    break
+            time.sleep(0.1)
+        else:
+            self.fail('The child of the killed program is still running')
+
+        # 2) the peak RSS of a program that fills 200 MB, not of this process
+        filler = "buf = b'x' * (200 * 1024 * 1024)\nprint(len(buf))\n"
+        run_result = prog_runner.execute([sys.executable, '-c', filler])
+        self.assertFalse(run_result.timed_out)
+        self.assertEqual(run_result.exit_code, 0)
+        self.assertEqual(run_result.output_tail, [str(200 * 1024 * 1024)])
+        self.assertGreaterEqual(run_result.peak_rss, 200 * 1024 * 1024)
+        self.assertLess(run_result.peak_rss, 1024 * 1024 * 1024)
+        self.assertGreaterEqual(run_result.cpu_time, 0)
+        run_result = prog_runner.execute([sys.executable, '-c', 'pass'])
+        self.assertEqual(run_result.exit_code, 0)
+        self.assertLess(run_result.peak_rss, 100 * 1024 * 1024)
+
+        # 3) output that is not ASCII, nor even UTF-8, more than a pipe holds, printed to a
+        # redirected stdout as in the SDK jobs
+        writer = ("import sys\n"
+                  "for i in range(2000):\n"
+                  "    sys.stdout.write('\\xc3\\xa9t\\xc3\\xa9 \\xff\\xfe %d ' % i)\n"
+                  "    sys.stdout.write('x' * 80 + '\\n')\n"
+                  "    sys.stderr.write('\\xe2\\x80\\x99 \\x80 %d\\n' % i)\n")
+        stdout = sys.stdout
+        sys.stdout = open(os.path.join(runner_dir, 'stdout.log'), 'w')
+        try:
+            run_result = prog_runner.execute([sys.executable, '-c', writer])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        self.assertFalse(run_result.timed_out)
+        self.assertEqual(run_result.exit_code, 0)
+        self.assertEqual(len(run_result.output_tail), Program_Runner.OUTPUT_TAIL_LINES)
+        self.assertIn('? 1999', '\n'.join(run_result.output_tail))
+        with open(os.path.join(runner_dir, 'stdout.log')) as f:
+            self.assertEqual(f.read().count('x' * 80), 2000)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_fill_html_trs")
+    def test_fill_html_trs(self):
+        """
+        _fill_html_trs looks up the items of a set with one get_object_info3 and one get_objects2
+        call, and fills the same rows as looking up each item on its own
+        """
+        fake_dir = os.path.join(self.scratch, 'fill_html_trs')
+        if os.path.isdir(fake_dir):
+            shutil.rmtree(fake_dir)
+        os.makedirs(fake_dir)
+        fake_kbase = Fake_KBase(fake_dir)
+        server = start_server(fake_kbase)
+        try:
+            star_utils = STARUtils(self.scratch, fake_kbase.url, fake_kbase.url, fake_kbase.url,
+                                   self.getContext().provenance())
+            item_refs = [fake_kbase.save_object('reads_{}_alignment'.format(idx), ALIGNMENT_TYPE,
+                                                {'condition': 'condition_{}'.format(idx % 2),
+                                                 'read_sample_id': 'reads_{}'.format(idx),
+                                                 'size': 1000 * idx})
+                         for idx in range(5)]
+            obj_data = {'items': [{'ref': ref} for ref in item_refs]}
+
+            # one full get_objects2 per item
+            expected = '<tr><th>Alignments</th><th>Condition</th></tr>'
+            for ref in item_refs:
+                item_obj = star_utils.ws_client.get_objects2(
+                                {'objects': [{'ref': ref}]})['data'][0]
+                expected += '<tr><td>{} ({})</td>'.format(item_obj['info'][1], ref)
+                expected += '<td>{}</td></tr>'.format(item_obj['data']['condition'])
+
+            fake_kbase.call_counts.clear()
+            self.assertEqual(star_utils._fill_html_trs('Alignments', obj_data), expected)
+            self.assertEqual(fake_kbase.call_counts, {'Workspace.get_object_info3': 1,
+                                                      'Workspace.get_objects2': 1})
+            self.assertEqual(star_utils._fill_html_trs('Alignments', {'items': []}),
+                             '<tr><th>Alignments</th><th>Condition</th></tr>')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Object_Info_Cache")
+    def test_Object_Info_Cache(self):
+        """
+        Object_Info_Cache returns the same infos as get_object_info3, looking up each object once
+        with a single call for all the refs it has not seen, and the lookups made through it
+        return the same as those made without it
+        """
+        fake_dir = os.path.join(self.scratch, 'object_info_cache')
+        if os.path.isdir(fake_dir):
+            shutil.rmtree(fake_dir)
+        os.makedirs(fake_dir)
+        fake_kbase = Fake_KBase(fake_dir)
+        server = start_server(fake_kbase)
+        try:
+            star_utils = STARUtils(self.scratch, fake_kbase.url, fake_kbase.url, fake_kbase.url,
+                                   self.getContext().provenance())
+            ws_client = star_utils.ws_client
+            reads_refs = [fake_kbase.save_object('reads_{}'.format(idx), SINGLE_END_TYPE, {})
+                          for idx in range(3)]
+            set_ref = fake_kbase.save_object(
+                            'reads_set', READS_SET_TYPE,
+                            {'description': '', 'items': [{'ref': ref, 'label': 'label_' + ref}
+                                                          for ref in reads_refs]})
+
+            # versioned, unversioned and named refs, and a repeated one
+            refs = [reads_refs[0], reads_refs[1].rsplit('/', 1)[0], 'star_benchmark/reads_2',
+                    set_ref, reads_refs[0]]
+            expected = ws_client.get_object_info3({'objects': [{'ref': r} for r in refs]})
+            info_cache = Object_Info_Cache(ws_client)
+            fake_kbase.call_counts.clear()
+            self.assertEqual(info_cache.get_infos(refs), expected['infos'])
+            self.assertEqual(info_cache.get_infos(refs[::-1]), expected['infos'][::-1])
+            self.assertEqual(info_cache.get_info(reads_refs[1]), expected['infos'][1])
+            self.assertEqual(info_cache.get_type(set_ref), expected['infos'][3][2])
+            self.assertEqual(info_cache.get_name(reads_refs[2]), 'reads_2')
+            self.assertEqual(fake_kbase.call_counts, {'Workspace.get_object_info3': 1})
+
+            # a new version is looked up by its versioned ref
+            new_ref = fake_kbase.save_object('reads_1', SINGLE_END_TYPE, {})
+            new_info = ws_client.get_object_info3({'objects': [{'ref': new_ref}]})['infos'][0]
+            self.assertEqual(info_cache.get_info(new_ref), new_info)
+            self.assertEqual(info_cache.get_info(refs[1]), expected['infos'][1])
+
+            # the lookups of the reads of a set
+            for ref in [set_ref, reads_refs[0]]:
+                self.assertEqual(get_object_type(ref, fake_kbase.url, info_cache),
+                                 get_object_type(ref, fake_kbase.url))
+            info_cache = Object_Info_Cache(ws_client)
+            params = {'alignment_suffix': '_alignment'}
+            expected = fetch_reads_refs_from_sampleset(set_ref, fake_kbase.url, fake_kbase.url,
+                                                       params)
+            self.assertEqual([r['ref'] for r in expected], reads_refs)
+            for _ in range(2):
+                fake_kbase.call_counts.clear()
+                self.assertEqual(fetch_reads_refs_from_sampleset(
+                                    set_ref, fake_kbase.url, fake_kbase.url, params, info_cache),
+                                 expected)
+            self.assertNotIn('Workspace.get_object_info3', fake_kbase.call_counts)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_shards_reads")
+    def test_shards_reads(self):
+        """
+        the reads are mapped in shards only when the shards align each read as one run does
+        """
+        star_aligner = STAR_Aligner(self.cfg, self.getContext().provenance())
+        params = {'read_shards': 4, 'outSAMtype': 'BAM', 'outFilterType': 'Normal'}
+        self.assertTrue(star_aligner._shards_reads(params, False))
+        # streamed reads cannot be split
+        self.assertFalse(star_aligner._shards_reads(params, True))
+        for (key, value) in [('read_shards', 1), ('read_shards', None), ('outSAMtype', 'SAM'),
+                             ('outFilterType', 'BySJout'), ('outFilterType', None),
+                             ('twopassMode', 'Basic')]:
+            shard_params = dict(params)
+            shard_params[key] = value
+            self.assertFalse(star_aligner._shards_reads(shard_params, False))
+        # the second pass of a batch maps against the pooled junctions of the set
+        self.assertTrue(star_aligner._shards_reads(dict(params, twopassMode='None'), False))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_Genome_Index_Cache_sweep_staging")
+    def test_Genome_Index_Cache_sweep_staging(self):
+        """
+        the staging directories of the builds that did not finish are removed from the index
+        cache, and those of the builds in progress kept
+        """
+        cache_dir = os.path.join(self.scratch, 'sweep_index_cache')
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        cache = Genome_Index_Cache(cache_dir)
+        (key_built, key_killed) = ('a' * 64, 'b' * 64)
+        with cache.lock(key_built):
+            building_dir = cache.new_staging_dir(key_built)
+        with cache.lock(key_killed):
+            killed_dir = cache.new_staging_dir(key_killed)
+            with open(os.path.join(killed_dir, 'SA'), 'w') as f:
+                f.write('x' * 1000)
+        entry_dir = cache.publish(key_killed, cache.new_staging_dir(key_killed), {})
+
+        with cache.lock(key_built):
+            self.assertEqual(cache.sweep_staging(), [killed_dir])
+            self.assertTrue(os.path.isdir(building_dir))
+            self.assertTrue(os.path.isdir(entry_dir))
+        self.assertEqual(cache.sweep_staging(), [building_dir])
+        self.assertEqual(cache.sweep_staging(), [])
+        self.assertEqual([e[0] for e in cache.list_entries()], [key_killed])
+
+        # eviction makes room by sweeping them first
+        abandoned_dir = cache.new_staging_dir(key_built)
+        scratch_manager = Scratch_Manager(self.scratch, 0.0001, cache)
+        scratch_manager.make_room()
+        self.assertFalse(os.path.exists(abandoned_dir))
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_batch_first_pass_keeps_junctions")
+    def test_batch_first_pass_keeps_junctions(self):
+        """
+        the junctions of the first pass of a sample stay on scratch, whatever room is needed,
+        until those of the whole set are pooled, and may be evicted after
+        """
+        star_aligner = STAR_Aligner(self.cfg, self.getContext().provenance())
+        first_pass_dir = os.path.join(self.scratch, 'batch_first_pass')
+        if os.path.isdir(first_pass_dir):
+            shutil.rmtree(first_pass_dir)
+        (star_aligner.star_idx_dir, star_aligner.star_out_dir) = \
+            star_aligner.star_utils.create_star_dirs(first_pass_dir)
+        star_aligner.star_utils.run_indexing_with_retry(
+            star_aligner.star_utils.get_indexing_params(
+                {'runThreadN': 2, 'genomeFastaFiles': ['./testReads/test_reference.fa'],
+                 'genomeSAindexNbases': 8}, star_aligner.star_idx_dir))
+
+        # the reads as if downloaded, the mapped ones are deleted
+        def get_reads_info(rds, reads_ref):
+            reads_file = os.path.join(first_pass_dir, reads_ref + '.fq')
+            shutil.copy('./testReads/small.forward.fq', reads_file)
+            return {'file_fwd': reads_file}
+        star_aligner.star_utils.get_reads_info = get_reads_info
+
+        # evict whatever is not in use after each first pass
+        scratch_manager = star_aligner.scratch_manager
+        scratch_manager.high_water_mark = 0.0001
+        map_first_pass = star_aligner._star_map_first_pass
+        sj_files = list()
+
+        def evicting_first_pass(*args, **kwargs):
+            sj_files.append(map_first_pass(*args, **kwargs))
+            scratch_manager.make_room()
+            for sj_file in sj_files:
+                self.assertTrue(os.path.isfile(sj_file))
+            return sj_files[-1]
+        star_aligner._star_map_first_pass = evicting_first_pass
+
+        params = {'alignment_suffix': '_alignment', 'runThreadN': 2,
+                  STARUtils.SET_READS: [{'ref': 'reads_{}'.format(idx),
+                                         'alignment_output_name': 'reads_{}_alignment'.format(idx)}
+                                        for idx in range(3)]}
+        star_aligner._star_run_batch_first_pass(params)
+        self.assertEqual(len(sj_files), 3)
+        # released once pooled, so evicted by the room made for inserting the junctions
+        for sj_file in sj_files:
+            self.assertFalse(os.path.exists(sj_file))
@@ -0,0 +1,319 @@
+"""
+A local stand-in for the KBase services STAR_Aligner.run_align talks to: the SDK callback server
+(AssemblyUtil, GenomeFileUtil, ReadsUtils, ReadsAlignmentUtils, SetAPI, kb_QualiMap,
+KBaseReport), the Workspace and the Service Wizard. All of them are served as JSON-RPC by one
+HTTP server, dispatching on the module name of the called method, which also serves the files
+of the reads as Shock nodes.
+It keeps the Workspace objects in memory and serves the files of a synthetic dataset.
+"""
+import os
+import json
+import time
+import shutil
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # py2
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # py3
+    from socketserver import ThreadingMixIn
+
+WS_ID = 1
+WS_NAME = 'star_benchmark'
+
+GENOME_TYPE = 'KBaseGenomes.Genome-14.1'
+ASSEMBLY_TYPE = 'KBaseGenomeAnnotations.Assembly-5.0'
+READS_SET_TYPE = 'KBaseSets.ReadsSet-2.0'
+PAIRED_END_TYPE = 'KBaseFile.PairedEndLibrary-2.1'
+SINGLE_END_TYPE = 'KBaseFile.SingleEndLibrary-2.1'
+ALIGNMENT_TYPE = 'KBaseRNASeq.RNASeqAlignment-11.0'
+ALIGNMENT_SET_TYPE = 'KBaseSets.ReadsAlignmentSet-2.0'
+REPORT_TYPE = 'KBaseReport.Report-3.0'
+
+
+def _include(data, included, steps):
+    # copy the part of data at the path steps into included, as the Workspace does for the
+    # 'included' paths of get_objects2; [*] steps into every item of a list
+    if isinstance(data, list):
+        while len(included) < len(data):
+            included.append(dict())
+        for (item, included_item) in zip(data, included):
+            _include(item, included_item, steps[1:])
+        return
+    if not isinstance(data, dict) or steps[0] not in data:
+        return
+    if len(steps) == 1 or not isinstance(data[steps[0]], (dict, list)):
+        included[steps[0]] = data[steps[0]]
+        return
+    included.setdefault(steps[0], [] if isinstance(data[steps[0]], list) else dict())
+    _include(data[steps[0]], included[steps[0]], steps[1:])
+
+
+class Fake_KBase(object):
+    """
+    Fake_KBase: the state and the methods of the fake services. Files handed out to the code
+    under test are copied into scratch_dir, as the real callback server does.
+    """
+    def __init__(self, scratch_dir):
+        self.scratch_dir = scratch_dir
+        self.objects = dict()
+        self.names = dict()
+        self.lock = threading.Lock()
+        self.url = None
+        # number of calls per method, to spot chatty code
+        self.call_counts = dict()
+        # results of the jobs submitted through the callback server, by job id
+        self.jobs = dict()
+        self.n_jobs = 0
+        # the files served as Shock nodes, by node id
+        self.shock_nodes = dict()
+
+    def save_object(self, name, obj_type, data, refs=None, files=None):
+        """
+        save_object: save a new version of the object name, returns its ref. files are the
+        local files the object stands for (e.g. the FASTA of an assembly).
+        """
+        with self.lock:
+            if name in self.names:
+                obj_id = self.names[name]
+                version = self.objects[self.names[name]]['info'][4] + 1
+            else:
+                obj_id = len(self.names) + 1
+                version = 1
+            self.names[name] = obj_id
+            info = [obj_id, name, obj_type, time.strftime('%Y-%m-%dT%H:%M:%S+0000'), version,
+                    'benchmark', WS_ID, WS_NAME, '', len(json.dumps(data)), {}]
+            self.objects[obj_id] = {'info': info, 'data': data, 'refs': refs or [],
+                                    'files': files or {}}
+        return '{}/{}/{}'.format(WS_ID, obj_id, version)
+
+    def add_shock_node(self, file_path):
+        '''add_shock_node: serve file_path as a Shock node, returns its file handle'''
+        with self.lock:
+            node_id = 'node_{}'.format(len(self.shock_nodes) + 1)
+            self.shock_nodes[node_id] = file_path
+        return {'id': node_id, 'url': self.url, 'file_name': os.path.basename(file_path)}
+
+    def _get_object(self, ref):
+        # the last step of a ref path is the object
+        steps = ref.split(';')[-1].split('/')
+        obj_id = int(steps[1]) if steps[1].isdigit() else self.names[steps[1]]
+        return self.objects[obj_id]
+
+    def _copy_to_scratch(self, file_path, target_dir=None):
+        target_dir = target_dir or os.path.join(self.scratch_dir, 'fake_kbase_' + str(
+                                                    int(time.time() * 1000000)))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        target = os.path.join(target_dir, os.path.basename(file_path))
+        shutil.copyfile(file_path, target)
+        return target
+
+    # Workspace
+    def Workspace_get_object_info3(self, params):
+        infos = [self._get_object(o['ref'])['info'] for o in params['objects']]
+        paths = [[o['ref']] for o in params['objects']]
+        return {'infos': infos, 'paths': paths}
+
+    def Workspace_get_objects2(self, params):
+        data = list()
+        for o in params['objects']:
+            obj = self._get_object(o['ref'])
+            obj_data = obj['data']
+            if params.get('no_data'):
+                obj_data = None
+            elif o.get('included'):
+                included = dict()
+                for path in o['included']:
+                    _include(obj_data, included, path.strip('/').split('/'))
+                obj_data = included
+            data.append({'info': obj['info'], 'data': obj_data, 'refs': obj['refs']})
+        return {'data': data}
+
+    # Service Wizard: every dynamic service is served by this server too
+    def ServiceWizard_get_service_status(self, params):
+        return {'module_name': params['module_name'], 'url': self.url}
+
+    # callback services
+    def AssemblyUtil_get_assembly_as_fasta(self, params):
+        obj = self._get_object(params['ref'])
+        return {'path': self._copy_to_scratch(obj['files']['fasta']),
+                'assembly_name': obj['info'][1]}
+
+    def GenomeFileUtil_genome_to_gff(self, params):
+        obj = self._get_object(params['genome_ref'])
+        return {'file_path': self._copy_to_scratch(obj['files']['gtf'], params['target_dir'])}
+
+    def ReadsUtils_download_reads(self, params):
+        files = dict()
+        for ref in params['read_libraries']:
+            obj = self._get_object(ref)
+            reads_files = {'type': 'paired' if 'rev' in obj['files'] else 'single',
+                           'fwd': self._copy_to_scratch(obj['files']['fwd']),
+                           'fwd_name': os.path.basename(obj['files']['fwd']),
+                           'rev': None,
+                           'otype': 'paired' if 'rev' in obj['files'] else 'single'}
+            if 'rev' in obj['files']:
+                reads_files['rev'] = self._copy_to_scratch(obj['files']['rev'])
+            # the reads of all the mates, as in the metadata of the library
+            read_count = 0
+            for reads_file in obj['files'].values():
+                with open(reads_file) as f:
+                    read_count += sum(1 for line in f) // 4
+            files[ref] = {'files': reads_files, 'ref': ref, 'read_count': read_count}
+        return {'files': files}
+
+    def SetAPI_get_reads_set_v1(self, params):
+        obj = self._get_object(params['ref'])
+        return {'data': obj['data'], 'info': obj['info']}
+
+    def SetAPI_save_reads_alignment_set_v1(self, params):
+        ref = self.save_object(params['output_object_name'], ALIGNMENT_SET_TYPE, params['data'])
+        return {'set_ref': ref, 'set_info': self._get_object(ref)['info']}
+
+    def ReadsAlignmentUtils_upload_alignment(self, params):
+        name = params['destination_ref'].split('/')[-1]
+        data = {'condition': params['condition'],
+                'read_sample_id': params['read_library_ref'],
+                'size': os.path.getsize(params['file_path'])}
+        return {'obj_ref': self.save_object(name, ALIGNMENT_TYPE, data)}
+
+    def kb_QualiMap_run_bamqc(self, params):
+        return {'qc_result_zip_info': {'shock_id': 'fake_shock_id',
+                                       'index_html_file_name': 'qualimapReport.html',
+                                       'name': 'qualimap_report.zip'}}
+
+    def KBaseReport_create_extended_report(self, params):
+        for file_link in params.get('file_links', []) + params.get('html_links', []):
+            if file_link.get('path') and not os.path.exists(file_link['path']):
+                raise ValueError('Report file {} does not exist'.format(file_link['path']))
+        ref = self.save_object(params['report_object_name'], REPORT_TYPE,
+                               {'text_message': params.get('message', '')})
+        return {'name': params['report_object_name'], 'ref': ref}
+
+    def call(self, method, params):
+        (module, func_name) = method.split('.')
+        # the callback server runs SDK methods as jobs: Module._method_submit returns a job id
+        # that Module._check_job is polled with. Jobs are run right away, at submit time.
+        if func_name == '_check_job':
+            with self.lock:
+                return {'finished': 1, 'result': [self.jobs.pop(params[0])]}
+        is_job = func_name.startswith('_') and func_name.endswith('_submit')
+        if is_job:
+            func_name = func_name[1:-len('_submit')]
+
+        with self.lock:
+            name = module + '.' + func_name
+            self.call_counts[name] = self.call_counts.get(name, 0) + 1
+        func = getattr(self, module + '_' + func_name, None)
+        if func is None:
+            raise NotImplementedError('Method {} is not served by Fake_KBase'.format(name))
+        result = func(*params)
+
+        if not is_job:
+            return result
+        with self.lock:
+            self.n_jobs += 1
+            job_id = 'job_{}'.format(self.n_jobs)
+            self.jobs[job_id] = result
+        return job_id
+
+
+class _RPC_Handler(BaseHTTPRequestHandler):
+    # connections are kept alive as by the real services, and closed after idling for timeout
+    # seconds, so that no handler thread outlives the benchmark for long
+    protocol_version = 'HTTP/1.1'
+    timeout = 1
+
+    def do_GET(self):
+        # Shock: /node/<node id>?download_raw
+        node_id = self.path.split('?')[0].split('/')[-1]
+        file_path = self.server.fake_kbase.shock_nodes.get(node_id, None)
+        if file_path is None:
+            self.send_error(404)
+            return
+        # downloads may be hung up on once the client read as much as it needs
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('content-type', 'application/octet-stream')
+        self.send_header('content-length', str(os.path.getsize(file_path)))
+        self.send_header('connection', 'close')
+        self.end_headers()
+        try:
+            with open(file_path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+        except (IOError, OSError):
+            pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        try:
+            result = self.server.fake_kbase.call(request['method'], request['params'])
+            status = 200
+            response = {'version': '1.1', 'id': request.get('id'), 'result': [result]}
+        except Exception as e:
+            status = 500
+            response = {'version': '1.1', 'id': request.get('id'),
+                        'error': {'name': type(e).__name__, 'code': -32000,
+                                  'message': str(e), 'error': repr(e)}}
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Threading_HTTP_Server(ThreadingMixIn, HTTPServer):
+    pass
+
+
+def start_server(fake_kbase, port=0):
+    """
+    start_server: serve fake_kbase on localhost in a background thread, returns the server;
+    its url is set on fake_kbase
+    """
+    server = _Threading_HTTP_Server(('127.0.0.1', port), _RPC_Handler)
+    server.fake_kbase = fake_kbase
+    fake_kbase.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def load_dataset(fake_kbase, dataset):
+    """
+    load_dataset: save the synthetic dataset made by synthetic_data.make_dataset as a genome, its
+    assembly, the reads libraries and a reads set. Returns (genome ref, reads set ref).
+    """
+    (dna_size, num_contigs) = (0, 0)
+    with open(dataset['fasta']) as f:
+        for line in f:
+            if line.startswith('>'):
+                num_contigs += 1
+            else:
+                dna_size += len(line.strip())
+    assembly_ref = fake_kbase.save_object('benchmark_assembly', ASSEMBLY_TYPE,
+                                          {'dna_size': dna_size, 'num_contigs': num_contigs},
+                                          files={'fasta': dataset['fasta']})
+    genome_ref = fake_kbase.save_object('benchmark_genome', GENOME_TYPE,
+                                        {'assembly_ref': assembly_ref},
+                                        refs=[assembly_ref],
+                                        files={'gtf': dataset['gtf']})
+    items = list()
+    for reads in dataset['reads']:
+        reads_type = PAIRED_END_TYPE if 'rev' in reads else SINGLE_END_TYPE
+        files = dict([(k, reads[k]) for k in ['fwd', 'rev'] if k in reads])
+        libs = [('lib1', 'fwd'), ('lib2', 'rev')] if 'rev' in reads else [('lib', 'fwd')]
+        data = dict([(lib, {'file': fake_kbase.add_shock_node(reads[k]),
+                            'size': os.path.getsize(reads[k])}) for (lib, k) in libs])
+        reads_ref = fake_kbase.save_object(reads['name'], reads_type, data, files=files)
+        items.append({'ref': reads_ref, 'label': 'condition_{}'.format(len(items) % 2 + 1)})
+    reads_set_ref = fake_kbase.save_object('benchmark_reads_set', READS_SET_TYPE,
+                                           {'description': 'benchmark', 'items': items})
+    return (genome_ref, reads_set_ref)
@@ -0,0 +1,328 @@
+"""
+Offline benchmark of STAR_Aligner.run_align: aligns a synthetic reads set against a synthetic
+genome end to end, with the KBase services replaced by a local fake server (see fake_kbase.py),
+and reports the wall time of each stage, the peak memory of STAR and the peak scratch usage.
+The numbers can be saved as the baseline of a profile, and later runs are checked against it.
+
+Usage (with a STAR binary on the machine):
+    python test/benchmark/run_benchmark.py --profile small --star-bin $(which STAR)
+    python test/benchmark/run_benchmark.py --profile small --star-bin $(which STAR) --save-baseline
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import threading
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', '..', 'lib'))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from STAR.Utils.STARUtils import STARUtils
+from STAR.Utils.STAR_Aligner import STAR_Aligner
+from STAR.Utils import resource_util
+from fake_kbase import WS_NAME, Fake_KBase, start_server, load_dataset
+from synthetic_data import make_dataset
+
+# genome_size in bases, n_reads per sample
+PROFILES = {'tiny': {'genome_size': 2000000, 'n_contigs': 2, 'n_samples': 2,
+                     'n_reads': 20000, 'read_length': 100, 'paired': True},
+            'small': {'genome_size': 20000000, 'n_contigs': 8, 'n_samples': 4,
+                      'n_reads': 500000, 'read_length': 100, 'paired': True},
+            'medium': {'genome_size': 200000000, 'n_contigs': 20, 'n_samples': 8,
+                       'n_reads': 5000000, 'read_length': 150, 'paired': True}}
+
+DEFAULT_BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baselines.json')
+
+# regressions smaller than these are noise, whatever the tolerance
+WALL_TIME_SLACK = 2.0
+BYTES_SLACK = 16 * 1024 * 1024
+
+
+def log(message, prefix_newline=False):
+    """Logging function, provides a hook to suppress or redirect log messages."""
+    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
+
+
+class Stage_Timer:
+    """
+    Stage_Timer: accumulates the wall time and the number of calls of each stage of a run, and
+    the peak RSS of the STAR runs, by wrapping the methods that make up the stages
+    """
+    def __init__(self):
+        self.stages = dict()
+        self.peak_rss = 0
+        self.lock = threading.Lock()
+
+    def wrap(self, obj, method_name, stage):
+        func = getattr(obj, method_name)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                ret = func(*args, **kwargs)
+            finally:
+                self._add(stage, time.time() - start)
+            # Program_Runner Run_Results carry the peak RSS of the STAR run
+            if hasattr(ret, 'peak_rss'):
+                with self.lock:
+                    self.peak_rss = max(self.peak_rss, ret.peak_rss or 0)
+            return ret
+        setattr(obj, method_name, timed)
+
+    def _add(self, stage, wall_time):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'wall_time': 0.0, 'calls': 0})
+            stats['wall_time'] += wall_time
+            stats['calls'] += 1
+
+
+class Scratch_Sampler(threading.Thread):
+    """
+    Scratch_Sampler: samples the size of the scratch directory every interval seconds and keeps
+    the peak
+    """
+    def __init__(self, scratch_dir, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        try:
+            self.peak_bytes = max(self.peak_bytes, resource_util.get_dir_size(self.scratch_dir))
+        except OSError:
+            # files come and go while STAR runs
+            pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def _instrument(aligner, timer):
+    star_utils = aligner.star_utils
+    timer.wrap(star_utils, 'convert_params', 'fetch_genome')
+    timer.wrap(aligner, '_get_index', 'index')
+    timer.wrap(star_utils, 'run_indexing', 'star_genomeGenerate')
+    timer.wrap(star_utils, 'get_reads_info', 'fetch_reads')
+    timer.wrap(star_utils, 'run_mapping', 'star_alignReads')
+    timer.wrap(star_utils, 'upload_STARalignment', 'upload_alignment')
+    timer.wrap(aligner, '_extract_readsPerGene', 'gene_count_matrix')
+    timer.wrap(star_utils, '_generate_output_file_list', 'package_outputs')
+    timer.wrap(star_utils, 'generate_star_report', 'report')
+
+
+def run_benchmark(profile, work_dir, star_bin, threads=2, concurrent_local_tasks=1,
+                  index_cache=False, keep_scratch=False, seed=1, twopass_mode=None,
+                  read_shards=1, samtools_bin=None, scratch_high_water_mark=0, plan=False):
+    """
+    run_benchmark: align the synthetic dataset of profile with STAR_Aligner.run_align, returns
+    the measurements
+    """
+    data_dir = os.path.join(work_dir, 'data', '_'.join(
+                    ['{}{}'.format(k, profile[k]) for k in sorted(profile)] + [str(seed)]))
+    log('Generating the synthetic dataset in {}'.format(data_dir))
+    dataset = make_dataset(data_dir, seed=seed, **profile)
+
+    scratch_dir = os.path.join(work_dir, 'scratch')
+    if os.path.isdir(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    os.makedirs(scratch_dir)
+
+    fake_kbase = Fake_KBase(scratch_dir)
+    server = start_server(fake_kbase)
+    (genome_ref, reads_set_ref) = load_dataset(fake_kbase, dataset)
+
+    os.environ['SDK_CALLBACK_URL'] = fake_kbase.url
+    os.environ.setdefault('KB_AUTH_TOKEN', 'fake_token')
+    STARUtils.STAR_BIN = star_bin
+    config = {'workspace-url': fake_kbase.url,
+              'srv-wiz-url': fake_kbase.url,
+              'scratch': scratch_dir,
+              'stream-reads': 'false',
+              'scratch-high-water-mark': str(scratch_high_water_mark),
+              'star-index-cache-dir': (os.path.join(work_dir, 'star_index_cache')
+                                       if index_cache else '')}
+    params = {'readsset_ref': reads_set_ref,
+              'genome_ref': genome_ref,
+              'output_workspace': WS_NAME,
+              'alignment_suffix': '_alignment',
+              'alignmentset_suffix': '_alignment_set',
+              'outSAMtype': 'BAM',
+              'quantMode': 'GeneCounts',
+              'runThreadN': threads,
+              'concurrent_local_tasks': concurrent_local_tasks}
+    if twopass_mode is not None:
+        params['twopassMode'] = twopass_mode
+    if read_shards > 1:
+        # BySJout filters by the junctions of the whole library, which shards cannot do
+        params['read_shards'] = read_shards
+        params['outFilterType'] = 'Normal'
+    if samtools_bin is not None:
+        STARUtils.SAMTOOLS_BIN = samtools_bin
+
+    timer = Stage_Timer()
+    sampler = Scratch_Sampler(scratch_dir)
+    run_plan = None
+    try:
+        if plan:
+            # what plan_star predicts, to compare with what the run measures
+            run_plan = STAR_Aligner(config, []).plan_align(copy.deepcopy(params))
+        aligner = STAR_Aligner(config, [])
+        _instrument(aligner, timer)
+        sampler.start()
+        start = time.time()
+        ret = aligner.run_align(params)
+        total_wall_time = time.time() - start
+    finally:
+        sampler.stop()
+        server.shutdown()
+        server.server_close()
+        if not keep_scratch:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return {'succeeded': bool(ret and ret.get('report_ref')),
+            'total_wall_time': total_wall_time,
+            'stages': timer.stages,
+            'peak_rss': timer.peak_rss,
+            'peak_scratch_bytes': sampler.peak_bytes,
+            'service_calls': fake_kbase.call_counts,
+            # the spans recorded by the run itself, with their CPU time and bytes moved
+            'run_manifest_stages': aligner.star_utils.run_manifest.summarize(),
+            'plan': run_plan}
+
+
+def get_metrics(result):
+    """
+    get_metrics: flatten the measurements of a run into the metrics compared to the baseline
+    """
+    metrics = {'total_wall_time': result['total_wall_time'],
+               'peak_rss': result['peak_rss'],
+               'peak_scratch_bytes': result['peak_scratch_bytes']}
+    for (stage, stats) in result['stages'].items():
+        metrics['stage.{}.wall_time'.format(stage)] = stats['wall_time']
+    return metrics
+
+
+def compare_to_baseline(metrics, baseline, tolerance):
+    """
+    compare_to_baseline: returns the list of (metric, baseline value, value) of the metrics that
+    got worse than the baseline by more than the tolerance (a fraction of the baseline value)
+    """
+    regressions = list()
+    for metric in sorted(baseline):
+        if metric not in metrics:
+            continue
+        slack = WALL_TIME_SLACK if metric.endswith('wall_time') else BYTES_SLACK
+        if metrics[metric] > baseline[metric] * (1 + tolerance) + slack:
+            regressions.append((metric, baseline[metric], metrics[metric]))
+    return regressions
+
+
+def _load_baselines(baseline_file):
+    if not os.path.isfile(baseline_file):
+        return dict()
+    with open(baseline_file) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of STAR_Aligner.run_align')
+    parser.add_argument('--profile', default='tiny', choices=sorted(PROFILES))
+    for (key, value_type) in [('genome_size', int), ('n_contigs', int), ('n_samples', int),
+                              ('n_reads', int), ('read_length', int)]:
+        parser.add_argument('--' + key.replace('_', '-'), dest=key, type=value_type,
+                            help='overrides the {} of the profile'.format(key))
+    parser.add_argument('--single-end', action='store_true',
+                        help='use single end instead of paired end reads')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--star-bin', default=STARUtils.STAR_BIN)
+    parser.add_argument('--threads', type=int, default=2, help='runThreadN of STAR, 0 to size it from the CPUs')
+    parser.add_argument('--concurrent-local-tasks', type=int, default=1)
+    parser.add_argument('--twopass-mode', choices=STARUtils.TWOPASS_MODES)
+    parser.add_argument('--read-shards', type=int, default=1,
+                        help='number of shards each reads library is split into')
+    parser.add_argument('--samtools-bin', default=STARUtils.SAMTOOLS_BIN)
+    parser.add_argument('--scratch-high-water-mark', type=float, default=0,
+                        help='fraction of the scratch disk above which artifacts are evicted')
+    parser.add_argument('--plan', action='store_true',
+                        help='plan the run with plan_star first, and report the plan with it')
+    parser.add_argument('--index-cache', action='store_true',
+                        help='build the index through the genome index cache')
+    parser.add_argument('--work-dir', default=os.path.join(BENCHMARK_DIR, 'work'))
+    parser.add_argument('--keep-scratch', action='store_true')
+    parser.add_argument('--baseline-file', default=DEFAULT_BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the baseline of the profile')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction of a baseline value a metric may exceed it by')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    profile = dict(PROFILES[args.profile])
+    for key in profile:
+        if getattr(args, key, None) is not None:
+            profile[key] = getattr(args, key)
+    if args.single_end:
+        profile['paired'] = False
+    # a baseline only applies to the exact same profile and settings
+    profile_name = '_'.join([args.profile] + ['{}{}'.format(k, profile[k])
+                                              for k in sorted(profile)] +
+                            ['threads{}'.format(args.threads),
+                             'tasks{}'.format(args.concurrent_local_tasks),
+                             'cache' if args.index_cache else 'nocache'] +
+                            (['twopass{}'.format(args.twopass_mode)] if args.twopass_mode else []) +
+                            (['shards{}'.format(args.read_shards)] if args.read_shards > 1 else []))
+
+    result = run_benchmark(profile, args.work_dir, args.star_bin, args.threads,
+                           args.concurrent_local_tasks, args.index_cache, args.keep_scratch,
+                           args.seed, args.twopass_mode, args.read_shards, args.samtools_bin,
+                           args.scratch_high_water_mark, args.plan)
+    result['profile'] = profile_name
+    metrics = get_metrics(result)
+    result['metrics'] = metrics
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    if not result['succeeded']:
+        log('The benchmark run failed, see the log above')
+        return 2
+
+    baselines = _load_baselines(args.baseline_file)
+    if args.save_baseline:
+        baselines[profile_name] = metrics
+        with open(args.baseline_file, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        log('Saved the baseline of {} to {}'.format(profile_name, args.baseline_file))
+        return 0
+
+    if profile_name not in baselines:
+        log('No baseline for {} in {}, run with --save-baseline to save one'.format(
+            profile_name, args.baseline_file))
+        return 0
+
+    regressions = compare_to_baseline(metrics, baselines[profile_name], args.tolerance)
+    for (metric, baseline_value, value) in regressions:
+        log('Regression in {}: {} (baseline {})'.format(metric, value, baseline_value))
+    if regressions:
+        return 1
+    log('No regressions against the baseline of {}'.format(profile_name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Generators of the synthetic genomes, annotations and reads libraries the offline benchmark
+aligns. Everything is derived from a seed, so that a benchmark profile always produces the same
+data.
+"""
+import os
+import numpy as np
+
+BASES = 'ACGT'
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def _reverse_complement(seq):
+    return ''.join([COMPLEMENT[b] for b in reversed(seq)])
+
+
+def _random_seq(rng, length):
+    return np.frombuffer(BASES.encode('ascii'), dtype='S1')[
+                rng.randint(0, 4, length)].tostring().decode('ascii')
+
+
+def make_genome(rng, genome_size, n_contigs):
+    """
+    make_genome: returns a list of (contig name, sequence) adding up to genome_size bases
+    """
+    contig_size = max(1, genome_size // n_contigs)
+    return [('contig_{}'.format(i + 1), _random_seq(rng, contig_size))
+            for i in range(n_contigs)]
+
+
+def write_fasta(contigs, fasta_file, line_width=60):
+    with open(fasta_file, 'w') as f:
+        for (name, seq) in contigs:
+            f.write('>{}\n'.format(name))
+            for start in range(0, len(seq), line_width):
+                f.write(seq[start:start + line_width] + '\n')
+    return fasta_file
+
+
+def make_genes(rng, contigs, gene_length=1500, n_exons=3):
+    """
+    make_genes: lay out genes of n_exons exons along the contigs, every other gene on the minus
+    strand. Returns a list of dicts with the gene id, contig, strand and exon coordinates
+    (1-based, inclusive).
+    """
+    genes = list()
+    exon_length = gene_length // (2 * n_exons - 1)
+    for (name, seq) in contigs:
+        pos = 1 + rng.randint(0, gene_length + 1)
+        while pos + gene_length < len(seq):
+            exons = [(pos + 2 * i * exon_length, pos + (2 * i + 1) * exon_length - 1)
+                     for i in range(n_exons)]
+            genes.append({'gene_id': 'gene_{}'.format(len(genes) + 1),
+                          'contig': name,
+                          'strand': '+' if len(genes) % 2 == 0 else '-',
+                          'exons': exons})
+            pos += gene_length + rng.randint(gene_length // 2, gene_length * 2 + 1)
+    return genes
+
+
+def write_gtf(genes, gtf_file):
+    with open(gtf_file, 'w') as f:
+        for gene in genes:
+            attributes = 'gene_id "{0}"; transcript_id "{0}.t1";'.format(gene['gene_id'])
+            for (start, end) in gene['exons']:
+                f.write('\t'.join([gene['contig'], 'synthetic', 'exon', str(start), str(end),
+                                   '.', gene['strand'], '.', attributes]) + '\n')
+    return gtf_file
+
+
+def _transcript(contig_seqs, gene):
+    seq = ''.join([contig_seqs[gene['contig']][start - 1:end]
+                   for (start, end) in gene['exons']])
+    if gene['strand'] == '-':
+        seq = _reverse_complement(seq)
+    return seq
+
+
+def _mutate(rng, seq, error_rate):
+    n_errors = rng.poisson(len(seq) * error_rate) if error_rate > 0 else 0
+    if n_errors == 0:
+        return seq
+    bases = list(seq)
+    for i in rng.randint(0, len(bases), n_errors):
+        bases[i] = BASES[rng.randint(0, 4)]
+    return ''.join(bases)
+
+
+def write_reads(rng, contigs, genes, n_reads, read_length, fwd_file, rev_file=None,
+                fragment_length=300, error_rate=0.005):
+    """
+    write_reads: sample n_reads reads (or read pairs, if rev_file is given) of read_length bases
+    from the spliced transcripts of genes, with random sequencing errors
+    """
+    contig_seqs = dict(contigs)
+    transcripts = [_transcript(contig_seqs, gene) for gene in genes]
+    transcripts = [t for t in transcripts if len(t) >= max(fragment_length, read_length)]
+    if not transcripts:
+        raise ValueError('The genes are too short for reads of {} bases'.format(read_length))
+
+    quality = 'I' * read_length
+    fwd = open(fwd_file, 'w')
+    rev = open(rev_file, 'w') if rev_file else None
+    try:
+        for i in range(n_reads):
+            transcript = transcripts[rng.randint(0, len(transcripts))]
+            frag_len = min(len(transcript), max(read_length, fragment_length))
+            start = rng.randint(0, len(transcript) - frag_len + 1)
+            fragment = transcript[start:start + frag_len]
+            name = 'read_{}'.format(i + 1)
+            fwd.write('@{}/1\n{}\n+\n{}\n'.format(
+                name, _mutate(rng, fragment[:read_length], error_rate), quality))
+            if rev is not None:
+                mate = _reverse_complement(fragment)[:read_length]
+                rev.write('@{}/2\n{}\n+\n{}\n'.format(
+                    name, _mutate(rng, mate, error_rate), quality))
+    finally:
+        fwd.close()
+        if rev is not None:
+            rev.close()
+
+
+def make_dataset(data_dir, genome_size, n_contigs, n_samples, n_reads, read_length,
+                 paired, seed):
+    """
+    make_dataset: write a synthetic genome (FASTA and GTF) and n_samples reads libraries into
+    data_dir. Returns the paths as a dict; data already in data_dir is reused.
+    """
+    dataset = {'fasta': os.path.join(data_dir, 'genome.fa'),
+               'gtf': os.path.join(data_dir, 'genome.gtf'),
+               'reads': list()}
+    for i in range(n_samples):
+        reads = {'name': 'sample_{}'.format(i + 1),
+                 'fwd': os.path.join(data_dir, 'sample_{}.fwd.fastq'.format(i + 1))}
+        if paired:
+            reads['rev'] = os.path.join(data_dir, 'sample_{}.rev.fastq'.format(i + 1))
+        dataset['reads'].append(reads)
+
+    done_file = os.path.join(data_dir, '.done')
+    if os.path.isfile(done_file):
+        return dataset
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    rng = np.random.RandomState(seed)
+    contigs = make_genome(rng, genome_size, n_contigs)
+    genes = make_genes(rng, contigs)
+    write_fasta(contigs, dataset['fasta'])
+    write_gtf(genes, dataset['gtf'])
+    for reads in dataset['reads']:
+        write_reads(rng, contigs, genes, n_reads, read_length, reads['fwd'],
+                    reads.get('rev', None))
+    open(done_file, 'w').close()
+
+    return dataset